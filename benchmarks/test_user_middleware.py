@@ -0,0 +1,106 @@
+# benchmarks/test_user_middleware.py
+# Стоимость UserMiddleware на одно обновление: защита от регрессий.
+# Запуск: python -m pytest benchmarks  или  python benchmarks/test_user_middleware.py
+# Токен бота и сеть не нужны: события - заглушки, хранилище - во временном каталоге.
+import os
+import sys
+import time
+import types
+import asyncio
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("STORAGE_PATH", os.path.join(tempfile.mkdtemp(prefix="bench_"), "bot.sqlite3"))
+
+# Список провайдеров создаёт provider_check.py; для замера подходит любой
+try:
+    import providers.fully_working  # noqa: F401
+except ImportError:
+    providers = types.ModuleType("providers")
+    fully_working = types.ModuleType("providers.fully_working")
+    fully_working.AVAILABLE_PROVIDERS = ["Qwen_Qwen_2_5"]
+    providers.fully_working = fully_working
+    sys.modules["providers"] = providers
+    sys.modules["providers.fully_working"] = fully_working
+
+from middlewares.user_middleware import UserMiddleware
+from utils.activity import activity
+
+# Потолок средней стоимости обновления (мкс); с запасом для медленных машин
+MAX_US_PER_UPDATE = float(os.getenv("BENCH_MIDDLEWARE_MAX_US", "50"))
+UPDATES = int(os.getenv("BENCH_MIDDLEWARE_UPDATES", "20000"))
+# Пользователи бенчмарка не пересекаются с реальными id
+BASE_USER_ID = 10 ** 12
+
+
+async def _noop_answer(*args, **kwargs):
+    return None
+
+
+def make_update(user_id: int, text: str = "привет") -> tuple:
+    """Заглушка обновления с текстом и данные, которые передаёт aiogram"""
+    user = types.SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Bench", last_name=None)
+    message = types.SimpleNamespace(
+        from_user=user, text=text, photo=None, document=None, voice=None, audio=None, answer=_noop_answer
+    )
+    return types.SimpleNamespace(message=message, callback_query=None), {"event_from_user": user}
+
+
+async def _handler(event, data):
+    return None
+
+
+async def run(updates: list) -> float:
+    """Средняя стоимость вызова мидлвари в микросекундах"""
+    middleware = UserMiddleware()
+    # Прогрев: загрузка тарифов квот и первое появление пользователей
+    for event, data in updates[:100]:
+        await middleware(_handler, event, data)
+    started = time.perf_counter_ns()
+    for event, data in updates:
+        await middleware(_handler, event, data)
+    return (time.perf_counter_ns() - started) / len(updates) / 1000
+
+
+# Сценарии: (описание, функция номер -> обновление)
+SCENARIOS = {
+    # Частый случай: активный пользователь пишет подряд, профиль не меняется
+    "repeat_user": ("повторный пользователь", lambda i: make_update(BASE_USER_ID + i % 50, "/help")),
+    # Текст без команды проходит проверку квоты
+    "quota_path": ("проверка квоты", lambda i: make_update(BASE_USER_ID + 1000 + i % 500)),
+    # Каждое обновление - новый пользователь
+    "new_users": ("новые пользователи", lambda i: make_update(BASE_USER_ID + 100000 + i, "/start")),
+}
+
+
+def measure(scenario: str) -> float:
+    _, make = SCENARIOS[scenario]
+    average = asyncio.run(run([make(i) for i in range(UPDATES)]))
+    # Накопленные профили переносятся в user_info, как это делает фоновая задача
+    activity.flush()
+    return average
+
+
+def test_repeat_user_cost():
+    average = measure("repeat_user")
+    assert average < MAX_US_PER_UPDATE, f"{average:.1f} мкс на обновление"
+
+
+def test_quota_path_cost():
+    average = measure("quota_path")
+    assert average < MAX_US_PER_UPDATE, f"{average:.1f} мкс на обновление"
+
+
+def test_new_users_cost():
+    average = measure("new_users")
+    assert average < MAX_US_PER_UPDATE, f"{average:.1f} мкс на обновление"
+
+
+if __name__ == "__main__":
+    failed = False
+    for scenario, (name, _) in SCENARIOS.items():
+        average = measure(scenario)
+        failed |= average >= MAX_US_PER_UPDATE
+        print(f"{name}: {average:.1f} мкс на обновление (потолок {MAX_US_PER_UPDATE})")
+    sys.exit(1 if failed else 0)
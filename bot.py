@@ -2,38 +2,41 @@
 import os
 import asyncio
 import logging
+import config
 from PIL import Image
 from io import BytesIO
 from services.tgapi import bot
 from aiogram import Bot, Dispatcher
-from utils import cleanup, commands
+from utils import cleanup, commands, webhook, sharding
+from database import load_users, save_users, load_blocked_users, configure_shard, attach_shared_stores
+from utils.quota import quota, quota_persist_task, quota_tiers_task
+from utils.jobqueue import jobs
+from utils.lifecycle import lifecycle, notify_interrupted
+from utils.dispatch import state_dispatcher
+from utils.activity import activity, activity_flush_task
+from utils.history_stats import history_stats, stats_publish_task
+from utils.tts_cache import tts_cache, tts_cache_flush_task
+from utils.group_quiz import group_quiz
 from services import (admin, image_gen,audio_transcribeapi, retry,
                       audio_transcribe, imageanalysis, textmessages,
-                      generateaudio, quiz)
+                      generateaudio, quiz, voicechat)
 from middlewares.user_middleware import UserMiddleware
+from middlewares.outbound import outbound
 dp = Dispatcher()
 
 # Добавляем мидлварь
+dp.update.outer_middleware(lifecycle.track_update)
 dp.update.middleware(UserMiddleware())
 
-# Регистрируем роутеры
-dp.include_router(commands.router)
-dp.include_router(admin.router)
-dp.include_router(audio_transcribe.router)
-dp.include_router(audio_transcribeapi.router)
-dp.include_router(generateaudio.router)
-dp.include_router(imageanalysis.router)
-dp.include_router(image_gen.router)
-dp.include_router(quiz.router)
-dp.include_router(textmessages.router)
+# Регистрируем роутеры: обработчик выбирается по индексу (команда, состояние, тип содержимого)
+for module in (commands, admin, voicechat, audio_transcribe, audio_transcribeapi,
+               generateaudio, imageanalysis, image_gen, quiz, textmessages):
+    state_dispatcher.include_router(module.router)
+dp.include_router(state_dispatcher.router)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
-# Создаем папку temp, если она не существует
-if not os.path.exists('temp'):
-    os.makedirs('temp')
-
 # Функция для очистки папки temp
 def clear_temp_folder():
     for filename in os.listdir('temp'):
@@ -43,14 +46,97 @@ def clear_temp_folder():
                 os.remove(file_path)
         except Exception as e:
             print(f"Ошибка при удалении файла {file_path}: {str(e)}")
-# Вызов функции очистки при запуске
-clear_temp_folder()
+
+# Папку temp готовит только главный процесс до запуска воркеров:
+# воркеры (spawn) заново импортируют этот модуль и не должны удалять файлы соседних шардов
+def prepare_temp_folder():
+    if not os.path.exists('temp'):
+        os.makedirs('temp')
+    clear_temp_folder()
+
+# Данные, которые нужно сохранить при остановке
+def register_shutdown_hooks():
+    lifecycle.on_shutdown(activity.flush)
+    lifecycle.on_shutdown(group_quiz.save_all)
+    lifecycle.on_shutdown(save_users)
+    lifecycle.on_shutdown(tts_cache.save_index)
+    lifecycle.on_shutdown(quota.save_state)
+    lifecycle.on_shutdown(bot.session.close)
+
+# Фоновые задачи процесса, который обрабатывает обновления
+def start_background_tasks():
+    lifecycle.spawn(cleanup.cleanup_temp_store(), "cleanup")
+    lifecycle.spawn(quota_persist_task(), "quota")
+    lifecycle.spawn(quota_tiers_task(), "quota_tiers")
+    lifecycle.spawn(activity_flush_task(), "activity")
+    lifecycle.spawn(tts_cache_flush_task(), "tts_cache")
+    # Фоновые задачи, в том числе не завершённые до перезапуска
+    lifecycle.spawn(jobs.run(), "jobs", stop=jobs.close)
+    lifecycle.spawn(notify_interrupted(bot), "interrupted")
+    # Идущие групповые викторины продолжаются с того же этапа
+    group_quiz.restore()
+    lifecycle.spawn(group_quiz.wheel.run(), "group_quiz")
+    quiz.request_initial_refill()
+
+# Воркер шарда: обрабатывает обновления своих чатов
+async def run_worker(queue):
+    # Останавливает воркер главный процесс; SIGTERM самому воркеру - та же штатная остановка
+    lifecycle.setup(handle_sigint=False)
+    register_shutdown_hooks()
+    start_background_tasks()
+    # Счётчики шарда для сводной статистики админки
+    lifecycle.spawn(stats_publish_task(), "stats")
+    await lifecycle.serve(
+        sharding.run_shard_worker(dp, bot, queue, tasks=lifecycle.updates),
+        stop_intake=lambda: queue.put(None)
+    )
+
+def shard_worker_main(index: int, count: int, queue):
+    logging.basicConfig(level=logging.INFO, format=f"[shard-{index}] %(levelname)s:%(name)s:%(message)s")
+    configure_shard(index, count)
+    tts_cache.configure_shard(index, count)
+    outbound.configure_shard(count)
+    attach_shared_stores()
+    load_users()
+    history_stats.rebuild()
+    quota.load_state()
+    asyncio.run(run_worker(queue))
+
+# Главный процесс в многопроцессном режиме: только принимает и раздаёт обновления
+async def run_master():
+    router = sharding.ShardRouter(config.SHARD_WORKERS, shard_worker_main)
+    router.start()
+    # Упавший воркер перезапускается; если он падает снова и снова - останавливаем бота
+    lifecycle.spawn(router.watch(lifecycle.request_stop), "shards")
+    lifecycle.on_shutdown(lambda: asyncio.to_thread(router.stop, config.SHARD_DRAIN_TIMEOUT))
+    lifecycle.on_shutdown(bot.session.close)
+    if config.BOT_MODE == "webhook":
+        await lifecycle.serve(webhook.run_sharded_webhook(bot, router))
+    else:
+        await lifecycle.serve(sharding.run_polling_master(dp, bot, router))
 
 # Запуск бота
 async def main():
-    # Запуск задачи очистки
-    asyncio.create_task(cleanup.cleanup_temp_store())
-    await dp.start_polling(bot)
+    prepare_temp_folder()
+    lifecycle.setup()
+    load_blocked_users()
+    if config.SHARD_WORKERS > 1:
+        # Общие данные переносим в хранилище до запуска воркеров
+        attach_shared_stores(publish=True)
+        await run_master()
+        return
+    load_users()
+    history_stats.rebuild()
+    quota.load_state()
+    register_shutdown_hooks()
+    start_background_tasks()
+    if config.BOT_MODE == "webhook":
+        await lifecycle.serve(webhook.run_webhook(dp, bot, tasks=lifecycle.updates))
+    else:
+        await lifecycle.serve(
+            dp.start_polling(bot, handle_signals=False, close_bot_session=False),
+            stop_intake=dp.stop_polling
+        )
 
 if __name__ == "__main__":
     import asyncio
@@ -42,6 +42,8 @@ FUSIONBRAIN_APISECRET = os.getenv("FUSIONBRAIN_APISECRET", "FUSIONBRAIN_APISECRE
 # Speechmatics API
 SPEECHMATICS_API = os.getenv("SPEECHMATICS_API", "SPEECHMATICS_APIKEY")
 TRANSCRIPTION_LANGUAGE = os.getenv("TRANSCRIPTION_LANGUAGE", "ru")
+SPEECHMATICS_POLL_INTERVAL = 15  # Как часто проверять готовность транскрипции (сек)
+SPEECHMATICS_WAIT_LIMIT = 6 * 3600  # Сколько ждать результат Speechmatics (сек)
 
 # Настройки анализа изображений
 ANALYZE_SUGGESTION = "Вы хотите проанализировать изображение? Используйте команду /analyze"
@@ -76,4 +78,157 @@ SPEECH_TO_TEXT_MODEL = "openai-audio"  # Модель транскрибации
 TEXT_TO_SPEECH_MODEL = "openai-audio"  # Модель генерации аудио
 MAX_AUDIO_DURATION = 300  # Максимальная длительность аудио в секундах
 SUPPORTED_AUDIO_FORMATS = ['mp3', 'ogg', 'wav', 'webm']
-DEFAULT_AUDIO_FORMAT = 'mp3'
\ No newline at end of file
+DEFAULT_AUDIO_FORMAT = 'mp3'
+
+# Кеш результатов анализа изображений (pHash)
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "5000"))  # Максимум записей
+ANALYSIS_CACHE_MAX_DISTANCE = int(os.getenv("ANALYSIS_CACHE_MAX_DISTANCE", "4"))  # Допустимое расстояние Хэмминга
+
+# Параллельный синтез длинных текстов
+TTS_CHUNK_SIZE = int(os.getenv("TTS_CHUNK_SIZE", "1000"))  # Максимальная длина части (символов)
+TTS_MAX_PARALLEL = int(os.getenv("TTS_MAX_PARALLEL", "3"))  # Одновременных запросов синтеза
+TTS_MAX_GET_URL_LENGTH = 4096  # Длиннее - используем POST
+
+# Дисковый кеш озвучки
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join("cache", "tts"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_MB", "200")) * 1024 * 1024
+TTS_CACHE_SAVE_INTERVAL = 10  # Как часто записывать изменившийся индекс кеша озвучки (сек)
+VOICE_CHAT_MIN_SENTENCE = 40  # Минимальная длина фрагмента ответа для озвучки
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # Например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Проверяется по заголовку X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SET_ON_STARTUP = os.getenv("WEBHOOK_SET_ON_STARTUP", "1") == "1"
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "64"))  # Одновременно обрабатываемых обновлений
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+LIVENESS_PATH = "/healthz"
+READINESS_PATH = "/readyz"
+
+# Лимиты исходящих запросов к Telegram
+OUTBOUND_GLOBAL_RATE = 30          # Сообщений в секунду на бота
+OUTBOUND_PRIVATE_CHAT_RATE = 1.0   # Сообщений в секунду в личный чат
+OUTBOUND_GROUP_CHAT_RATE = 20 / 60 # Сообщений в секунду в группу
+OUTBOUND_CHAT_BURST = 3            # Допустимый всплеск в одном чате
+OUTBOUND_CHAT_ACTION_TTL = 4       # Сколько секунд не повторять одинаковый chat action
+OUTBOUND_MAX_RETRIES = 3           # Повторов после RetryAfter
+OUTBOUND_MAX_TRACKED_CHATS = 10000 # После этого простаивающие чаты забываются
+
+# Общее локальное хранилище (SQLite) для данных, общих для всех процессов
+STORAGE_PATH = os.getenv("STORAGE_PATH", os.path.join("data", "bot.sqlite3"))
+STORAGE_BUSY_TIMEOUT = 5  # Сколько ждать блокировку записи другого процесса (сек); запросы идут в цикле событий
+SHARED_CACHE_CHECK_INTERVAL = 1  # Как часто общие словари с кешем проверяют версию в хранилище (сек)
+
+# Многопроцессный режим: обновления распределяются по воркерам по id чата
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))  # 1 - обычный режим в одном процессе
+SHARD_WORKER_CONCURRENCY = int(os.getenv("SHARD_WORKER_CONCURRENCY", "64"))  # Одновременных обновлений в воркере
+SHARD_DRAIN_TIMEOUT = 30  # Сколько главный процесс ждёт остановки воркера (больше SHUTDOWN_DRAIN_TIMEOUT)
+SHARD_CHECK_INTERVAL = 5  # Как часто главный процесс проверяет, живы ли воркеры (сек)
+SHARD_MAX_RESTARTS = 3  # Перезапусков воркера за окно, после которых бот останавливается
+SHARD_RESTART_WINDOW = 300  # Окно подсчёта перезапусков (сек)
+
+# Планировщик запросов: одновременных запросов к провайдерам в каждом пуле
+SCHEDULER_POOLS = {
+    "chat": int(os.getenv("POOL_CHAT", "8")),
+    "image": int(os.getenv("POOL_IMAGE", "4")),
+    "analyze": int(os.getenv("POOL_ANALYZE", "3")),
+    "tts": int(os.getenv("POOL_TTS", "4")),
+    "transcribe": int(os.getenv("POOL_TRANSCRIBE", "2")),
+}
+SCHEDULER_MAX_QUEUED_PER_USER = 3  # Сколько запросов одного пользователя может ждать в пуле
+SCHEDULER_NOTICE_INTERVAL = 3  # Не чаще раза в столько секунд обновлять позицию в очереди у одного запроса
+
+# Квоты пользователей: для каждого сервиса [ёмкость корзины, пополнение в час]
+# Пополнение 0 - сервис без ограничений. Правки из админки хранятся в общем хранилище
+QUOTA_TIERS = {
+    "free": {
+        "chat": [20, 60],
+        "image": [5, 10],
+        "tts": [5, 10],
+        "analyze": [5, 10],
+        "transcribe": [3, 5],
+    },
+    "premium": {
+        "chat": [60, 300],
+        "image": [20, 60],
+        "tts": [20, 60],
+        "analyze": [20, 60],
+        "transcribe": [10, 30],
+    },
+    "unlimited": {},
+}
+QUOTA_DEFAULT_TIER = "free"
+QUOTA_TIERS_REFRESH = 30  # Как часто перечитывать тарифы из хранилища (сек)
+QUOTA_STATE_FILE = "quota_state.bin"  # Состояние неполных корзин
+QUOTA_SAVE_INTERVAL = 60  # Как часто сохранять состояние квот (сек)
+
+# Объединение быстрых сообщений подряд в один запрос к модели
+CHAT_DEBOUNCE_SECONDS = float(os.getenv("CHAT_DEBOUNCE_SECONDS", "1.5"))  # Пауза, после которой отвечаем
+CHAT_DEBOUNCE_MAX_WAIT = 6  # Дольше этого ответ не откладываем, даже если сообщения продолжают приходить
+
+# Фоновые задачи (транскрибация, длинная озвучка, ожидание Speechmatics)
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))  # Одновременно выполняемых задач в процессе
+JOBS_LEASE_SECONDS = 120  # Аренда задачи; не продлённая аренда означает, что воркер упал
+JOBS_MAX_ATTEMPTS = 5  # После стольких ошибок задача получает статус dead
+JOBS_BACKOFF_BASE = 10  # Первая пауза перед повтором (сек), дальше удваивается
+JOBS_BACKOFF_MAX = 600  # Максимальная пауза перед повтором (сек)
+JOBS_POLL_INTERVAL = 2  # Как часто проверять очередь без новых задач (сек)
+JOBS_RETENTION_DAYS = 7  # Сколько хранить выполненные задачи
+
+# Штатная остановка по SIGTERM/SIGINT
+SHUTDOWN_DRAIN_TIMEOUT = int(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))  # Сколько секунд дорабатывают начатые запросы
+
+# Учёт активности пользователей
+ACTIVITY_GRANULARITY = 60  # Время последней активности обновляется не чаще (сек)
+ACTIVITY_FLUSH_INTERVAL = 30  # Как часто переносить активность и профили в user_info (сек)
+
+# Временные данные пользователей: время жизни записей (сек)
+EPHEMERAL_TTL = {
+    "user_states": 3600,              # Ожидание ввода (описание изображения и т.п.)
+    "admin_states": 1800,             # Ожидание ввода в админке
+    "user_analysis_states": 3600,
+    "user_transcribe_states": 3600,
+    "last_image_requests": 86400,     # Для кнопки перегенерации
+    "image_analysis_requests": 3600,
+    "user_quiz_data": 6 * 3600,       # С момента последнего ответа
+    "temp_file_store": 86400,
+    "temp_image_store": 86400,
+}
+EPHEMERAL_MAX_SIZE = int(os.getenv("EPHEMERAL_MAX_SIZE", "100000"))  # Максимум записей в одном словаре
+EPHEMERAL_SWEEP_INTERVAL = 60  # Как часто удалять истёкшие записи (сек)
+
+# Статистика админки
+STATS_TOP_USERS = 5  # Размер топа активных пользователей
+STATS_DAYS = 30  # Сколько дней хранить суточную статистику использования
+STATS_PUBLISH_INTERVAL = 30  # Как часто шард публикует свои счётчики для сводной статистики (сек)
+ADMIN_USERS_PAGE_SIZE = 10  # Пользователей на странице списка в админке
+
+# Рассылка администратора
+BROADCAST_CHUNK_SIZE = 50  # Сообщений в порции; после каждой порции сохраняется прогресс
+BROADCAST_SLICE_SECONDS = 60  # Сколько задача рассылки занимает воркер до передышки
+BROADCAST_PROGRESS_INTERVAL = 5  # Как часто обновлять прогресс у администратора (сек)
+
+# Банк вопросов викторины
+QUIZ_BANK_BATCH_SIZE = 10  # Вопросов за один запрос к модели
+QUIZ_BANK_TARGET = 40  # До скольки вопросов пополнять категорию
+QUIZ_BANK_LOW_WATER = 15  # Ниже этого запускается пополнение
+QUIZ_BANK_MAX_BATCHES = 6  # Запросов к модели за одно пополнение
+QUIZ_BANK_REFILL_COOLDOWN = 60  # Пополнение категории не чаще (сек)
+QUIZ_BANK_SCAN_LIMIT = 200  # Сколько вопросов банка просматривать в поисках невиденного
+QUIZ_SEEN_LIMIT = 500  # Сколько последних вопросов пользователя в категории помнить
+QUIZ_MINHASH_SIZE = 32  # Длина MinHash-подписи вопроса
+QUIZ_DEDUPE_THRESHOLD = 0.6  # Сходство подписей, с которого вопрос считается перефразом
+
+# Групповая викторина
+GROUP_QUIZ_QUESTIONS = 10  # Вопросов в игре
+GROUP_QUIZ_LOBBY_SECONDS = 60  # Сбор игроков до автоматического начала (сек)
+GROUP_QUIZ_ANSWER_SECONDS = 30  # Время на ответ (сек)
+GROUP_QUIZ_PAUSE_SECONDS = 3  # Пауза между показом ответа и следующим вопросом (сек)
+GROUP_QUIZ_BOARD_INTERVAL = 3  # Сообщение игры обновляется не чаще (сек)
+GROUP_QUIZ_RETRY_DELAY = 5  # Повтор этапа игры после ошибки через (сек, растёт вдвое)
+GROUP_QUIZ_MAX_RETRIES = 3  # Неудачных повторов этапа, после которых игра завершается
+GROUP_QUIZ_RESULTS_TOP = 10  # Мест в итоговой таблице
+GROUP_QUIZ_TICK = 0.5  # Шаг колеса таймеров (сек)
+GROUP_QUIZ_WHEEL_SLOTS = 512  # Ячеек в колесе таймеров
@@ -1,13 +1,20 @@
 # database.py
 import json
 import os
+import glob
+import time
 import logging
 from datetime import datetime
+from config import EPHEMERAL_TTL, EPHEMERAL_MAX_SIZE
+from utils.storage import SharedDict, storage
+from utils.expiring import ExpiringDict, register_expiring
+from utils.sharding import shard_for
 
 logger = logging.getLogger(__name__)
 
 ###################################################
 ########### Словари для хранения данных ###########
+# Временные состояния - ExpiringDict: записи удаляются по истечении EPHEMERAL_TTL
 # Словарь для хранения информации о пользователях
 user_info = {}
 # Словарь для хранения истории сообщений пользователей
@@ -15,38 +22,42 @@ user_history = {}
 # Словарь для хранения настроек пользователей
 user_settings = {}
 # Словарь для состояний пользователей
-user_states = {}
-# Словарь для состояний админов
-admin_states = {}
+user_states = ExpiringDict("user_states", EPHEMERAL_TTL["user_states"], EPHEMERAL_MAX_SIZE)
+# Словарь для состояний админов (общий для всех процессов: ответ пользователя
+# на сообщение админа может прийти в другой шард)
+admin_states = register_expiring(SharedDict("admin_states", ttl=EPHEMERAL_TTL["admin_states"]))
+# Последний поиск администратора в списке пользователей
+admin_user_searches = ExpiringDict("admin_user_searches", EPHEMERAL_TTL["admin_states"], EPHEMERAL_MAX_SIZE)
 
 # Словарь для хранения истории запросов на генерацию изображений
 image_requests = {}
 # Словарь для хранения данных о последнем запросе на изображение
-last_image_requests = {}
+last_image_requests = ExpiringDict("last_image_requests", EPHEMERAL_TTL["last_image_requests"], EPHEMERAL_MAX_SIZE)
 # Словарь для хранения истории генерации изображений
 image_history = {}
-# Словарь для хранения заблокированных пользователей
-blocked_users = {}
+# Словарь для хранения заблокированных пользователей (общий для всех процессов)
+# Проверяется на каждое сообщение, поэтому читается из копии в памяти процесса
+blocked_users = SharedDict("blocked_users", cached=True)
+# Глобальные настройки, изменяемые во время работы (общие для всех процессов)
+shared_settings = SharedDict("shared_settings", cached=True)
 
 # Хранилище для временного хранения file_id
-temp_file_store = {}
+temp_file_store = ExpiringDict("temp_file_store", EPHEMERAL_TTL["temp_file_store"], EPHEMERAL_MAX_SIZE)
 # Хранилище временных file_id
-temp_image_store = {}
+temp_image_store = ExpiringDict("temp_image_store", EPHEMERAL_TTL["temp_image_store"], EPHEMERAL_MAX_SIZE)
 
 # Словарь для хранения состояний анализа изображений
-user_analysis_states = {}
+user_analysis_states = ExpiringDict("user_analysis_states", EPHEMERAL_TTL["user_analysis_states"], EPHEMERAL_MAX_SIZE)
 # Словарь для хранения настроек анализа
 user_analysis_settings = {}
 # Словарь для хранения текущих запросов анализа
-image_analysis_requests = {}
+image_analysis_requests = ExpiringDict("image_analysis_requests", EPHEMERAL_TTL["image_analysis_requests"], EPHEMERAL_MAX_SIZE)
 # Словарь для хранения состояний транскрибации
-user_transcribe_states = {}
-
-# Хранилище уже заданных вопросов для каждого пользователя
-used_questions = {}  
+user_transcribe_states = ExpiringDict("user_transcribe_states", EPHEMERAL_TTL["user_transcribe_states"], EPHEMERAL_MAX_SIZE)
 
 # Файл для хранения данных пользователей
-USER_DATA_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), 'user_data.json'))
+BASE_USER_DATA_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__), 'user_data.json'))
+USER_DATA_FILE = BASE_USER_DATA_FILE
 # Файл для хранения заблокированных пользователей
 BLOCKED_USERS_FILE = 'blocked_users.json'
 
@@ -54,9 +65,100 @@ BLOCKED_USERS_FILE = 'blocked_users.json'
 REGENERATE_CALLBACK_PREFIX = "regenerate:"
 regenerate_cb = REGENERATE_CALLBACK_PREFIX 
 
-user_quiz_data = {}  # Хранилище для викторины
-group_quiz_data = {}  # Хранилище для групповой викторины
+user_quiz_data = ExpiringDict("user_quiz_data", EPHEMERAL_TTL["user_quiz_data"], EPHEMERAL_MAX_SIZE, sliding=True)  # Хранилище для викторины
+# Сообщения пользователя, ожидающие объединения в один запрос к модели; ключ - (chat_id, user_id)
+pending_chat_messages = {}
+
+# Текущий шард процесса (при запуске в несколько процессов)
+shard_state = {"index": 0, "count": 1}
+
+
+###################################################
+################## Шардирование ###################
+
+def shard_data_file(index: int) -> str:
+    base, ext = os.path.splitext(BASE_USER_DATA_FILE)
+    return f"{base}.shard{index}{ext}"
+
+def configure_shard(index: int, count: int):
+    """Настраивает процесс как шард: свой файл данных и только свои пользователи"""
+    global USER_DATA_FILE
+    shard_state["index"] = index
+    shard_state["count"] = count
+    USER_DATA_FILE = shard_data_file(index) if count > 1 else BASE_USER_DATA_FILE
+
+def attach_shared_stores(publish: bool = False):
+    """Переключает общие словари на хранилище SQLite"""
+    for shared in (blocked_users, admin_states, shared_settings):
+        shared.attach(storage, publish=publish)
+
+def owns_key(key) -> bool:
+    if shard_state["count"] <= 1:
+        return True
+    return shard_for(int(key), shard_state["count"]) == shard_state["index"]
+
+def _replace_dict(target: dict, source: dict):
+    # Обновляем словари на месте: они импортированы в других модулях по ссылке
+    target.clear()
+    target.update(source)
+
+# Словари с данными пользователей, которые хранятся в файле
+USER_DATA_KEYS = ('user_info', 'user_history', 'user_settings', 'image_requests')
+# Версии пользователей, сохранённые этим процессом, и удалённые пользователи (user_id -> версия)
+_saved_versions = {}
+_tombstones = {}
+
+def _user_data_paths() -> list:
+    paths = [BASE_USER_DATA_FILE] + sorted(glob.glob(shard_data_file("*")))
+    return [p for p in paths if os.path.exists(p)]
 
+def _read_data_file(path: str):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except json.JSONDecodeError as e:
+        logging.error(f"Ошибка формата JSON в {path}: {str(e)}")
+        # Создаем резервную копию битого файла
+        backup_path = f"{path}.corrupted.{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        os.rename(path, backup_path)
+        logging.warning(f"Создана резервная копия битого файла: {backup_path}")
+    except OSError as e:
+        logging.error(f"Не удалось прочитать {path}: {str(e)}")
+    return None
+
+def _read_user_data() -> dict:
+    """Собирает данные из общего файла и файлов всех шардов.
+
+    Пользователь берётся целиком из файла, где у него наибольшая версия
+    (время сохранения владельцем); удалённые пользователи хранятся как
+    tombstone с версией и не возвращаются из старых файлов. У файлов старого
+    формата без версий версией служит время изменения файла.
+    """
+    records = {}  # user_id -> (версия, данные файла или None для удалённого)
+    for path in _user_data_paths():
+        data = _read_data_file(path)
+        if data is None:
+            continue
+        versions = data.get('versions')
+        if versions is None:
+            mtime = os.path.getmtime(path)
+            versions = {k: mtime for key in USER_DATA_KEYS for k in data.get(key, {})}
+        candidates = [(k, v, data) for k, v in versions.items()]
+        candidates += [(k, v, None) for k, v in data.get('deleted', {}).items()]
+        for k, version, source in candidates:
+            if k not in records or version > records[k][0]:
+                records[k] = (version, source)
+    merged = {key: {} for key in USER_DATA_KEYS}
+    merged['versions'], merged['deleted'] = {}, {}
+    for k, (version, source) in records.items():
+        if source is None:
+            merged['deleted'][k] = version
+            continue
+        merged['versions'][k] = version
+        for key in USER_DATA_KEYS:
+            if k in source.get(key, {}):
+                merged[key][k] = source[key][k]
+    return merged
 
 ###################################################
 ############# Функция загрузки данных #############
@@ -76,83 +178,93 @@ def migrate_old_history():
 
 # Функция загрузки пользователей
 def load_users():
-    global user_info, user_history, user_settings, image_requests, group_quiz_data  # Добавьте group_quiz_data
     try:
-        if not os.path.exists(USER_DATA_FILE):
+        paths = _user_data_paths()
+        if not paths:
             logging.warning("Файл данных не найден, создаем новый")
             save_users()
             return
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        required_keys = ['user_info', 'user_history', 'user_settings', 'image_requests']
-        for key in required_keys:
-            if key not in data:
-                raise KeyError(f"Отсутствует ключ {key} в файле данных")
-        user_info = {int(k): v for k, v in data.get('user_info', {}).items()}
-        user_history = {int(k): v for k, v in data.get('user_history', {}).items()}
-        user_settings = {int(k): v for k, v in data.get('user_settings', {}).items()}
-        image_requests = {int(k): v for k, v in data.get('image_requests', {}).items()}
-        group_quiz_data = data.get('group_quiz_data', {})  # Восстановите данные групповой викторины
+        data = _read_user_data()
+        for key, store in zip(USER_DATA_KEYS, (user_info, user_history, user_settings, image_requests)):
+            _replace_dict(store, {int(k): v for k, v in data[key].items() if owns_key(k)})
+        _saved_versions.clear()
+        _saved_versions.update({int(k): v for k, v in data['versions'].items() if owns_key(k)})
+        _tombstones.clear()
+        _tombstones.update({int(k): v for k, v in data['deleted'].items() if owns_key(k)})
         logging.info("Данные пользователей загружены.")
         migrate_old_history()
+        if shard_state["count"] <= 1:
+            _consolidate_shard_files()
 
-    except json.JSONDecodeError as e:
-        logging.error(f"Ошибка формата JSON: {str(e)}")
-        # Создаем резервную копию битого файла
-        backup_path = f"{USER_DATA_FILE}.corrupted.{datetime.now().strftime('%Y%m%d%H%M%S')}"
-        os.rename(USER_DATA_FILE, backup_path)
-        logging.warning(f"Создана резервная копия битого файла: {backup_path}")
-        # Инициализируем заново
-        user_info = {}
-        user_history = {}
-        user_settings = {}
-        image_requests = {}
-        save_users()
     except Exception as e:
         logging.error(f"Критическая ошибка загрузки: {str(e)}")
-        logging.warning("Файл данных не найден, создаем новый")
-        user_info = {}
-        user_history = {}
-        user_settings = {}
-        image_requests = {}
+        for store in (user_info, user_history, user_settings, image_requests):
+            store.clear()
         save_users()  # Создаем файл с начальными данными
 
+def _consolidate_shard_files():
+    """Шардирование выключено: данные шардов собраны в общий файл, файлы шардов больше не нужны"""
+    paths = glob.glob(shard_data_file("*"))
+    if not paths or not save_users():
+        return
+    for path in paths:
+        try:
+            os.remove(path)
+            logging.info(f"Данные {path} перенесены в {BASE_USER_DATA_FILE}")
+        except OSError as e:
+            logging.error(f"Не удалось удалить {path}: {str(e)}")
+
 # Функция сохранения пользователей
-def save_users():
+def save_users() -> bool:
     try:
         os.makedirs(os.path.dirname(USER_DATA_FILE), exist_ok=True)
+        version = time.time()
+        stores = {key: {k: v for k, v in store.items() if owns_key(k)} for key, store in
+                  zip(USER_DATA_KEYS, (user_info, user_history, user_settings, image_requests))}
+        current = {k for store in stores.values() for k in store}
+        # Пропавшие с прошлого сохранения пользователи удалены - помечаем их
+        for k in set(_saved_versions) - current:
+            _tombstones[k] = version
+        for k in current:
+            _tombstones.pop(k, None)
+        _saved_versions.clear()
+        _saved_versions.update(dict.fromkeys(current, version))
         data = {
-            'user_info': {str(k): v for k, v in user_info.items()},
-            'user_history': {str(k): v for k, v in user_history.items()},
-            'user_settings': {str(k): v for k, v in user_settings.items()},
-            'image_requests': {str(k): v for k, v in image_requests.items()},
-            'group_quiz_data': group_quiz_data  # Добавьте это поле
+            **{key: {str(k): v for k, v in store.items()} for key, store in stores.items()},
+            'versions': {str(k): v for k, v in _saved_versions.items()},
+            'deleted': {str(k): v for k, v in _tombstones.items()},
         }
-        with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
+        # Пишем во временный файл и подменяем: сбой при записи не портит данные
+        temp_path = f"{USER_DATA_FILE}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(temp_path, USER_DATA_FILE)
         logging.info("Данные пользователей сохранены.")
+        return True
     except Exception as e:
         logging.error(f"Ошибка сохранения данных: {str(e)}")
+        return False
 
 # Функция загрузки заблокированных пользователей
 def load_blocked_users():
-    global blocked_users
     try:
         with open(BLOCKED_USERS_FILE, 'r', encoding='utf-8') as f:
-            blocked_users = json.load(f)
-            logging.info("Данные заблокированных пользователей загружены.")
+            data = json.load(f)
+        blocked_users.clear()
+        blocked_users.update(data)
+        logging.info("Данные заблокированных пользователей загружены.")
 
     except FileNotFoundError:
         logging.warning("Файл заблокированных пользователей не найден. Будет создан новый.")
-        blocked_users = {}
+        blocked_users.clear()
 
     except json.JSONDecodeError:
         logging.error("Ошибка при загрузке данных заблокированных пользователей. Файл поврежден.")
-        blocked_users = {}
+        blocked_users.clear()
 
 
 # Функция сохранения заблокированных пользователей
 def save_blocked_users():
     with open(BLOCKED_USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(blocked_users, f, ensure_ascii=False, indent=4)
+        json.dump(blocked_users.copy(), f, ensure_ascii=False, indent=4)
     logging.info("Данные заблокированных пользователей сохранены.")
\ No newline at end of file
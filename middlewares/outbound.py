@@ -0,0 +1,288 @@
+# middlewares/outbound.py
+import time
+import asyncio
+import logging
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods.base import Response
+import config
+
+# Приоритеты исходящих запросов: интерактивные ответы идут раньше массовых
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Текущий приоритет задаётся в обработчике и читается мидлварью
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_INTERACTIVE)
+
+@contextmanager
+def outbound_priority(priority: int):
+    """Все запросы к Telegram внутри блока уходят с заданным приоритетом"""
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+# Методы, которые пишут в чат и подпадают под лимиты Telegram
+PACED_METHOD_PREFIXES = ("Send", "Edit", "Delete", "Copy", "Forward")
+# Служебные методы: не публикуют сообщений, поэтому не расходуют лимит чата
+UNPACED_CHAT_METHOD_PREFIXES = ("SendChatAction", "Delete")
+# Методы редактирования, которые можно схлопывать
+COALESCED_EDITS = ("EditMessageText", "EditMessageReplyMarkup", "EditMessageCaption")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена"""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class OutboundItem:
+    __slots__ = ("make_request", "bot", "method", "futures", "chat_id", "priority", "key", "attempts", "light")
+
+    def __init__(self, make_request, bot, method, chat_id, priority, key):
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.chat_id = chat_id
+        self.priority = priority
+        self.key = key
+        self.attempts = 0
+        # Служебный запрос идёт в порядке очереди чата, но без токена чата
+        self.light = type(method).__name__.startswith(UNPACED_CHAT_METHOD_PREFIXES)
+
+
+class OutboundThrottlingMiddleware(BaseRequestMiddleware):
+    """Очередь исходящих запросов с лимитами на чат и глобально.
+
+    Запросы раскладываются по полосам приоритета и по чатам; внутри полосы
+    чаты обслуживаются по кругу. RetryAfter приостанавливает чат (или всю
+    отправку) и возвращает запрос в начало его очереди. Повторные chat action
+    и правки одного и того же сообщения схлопываются. Chat action и удаления
+    не расходуют лимит чата (только глобальный) и не обгоняют сообщения,
+    уже стоящие в очереди чата.
+    """
+
+    def __init__(self):
+        self.group_rate = config.OUTBOUND_GROUP_CHAT_RATE
+        self.group_burst = config.OUTBOUND_CHAT_BURST
+        self.global_bucket = TokenBucket(config.OUTBOUND_GLOBAL_RATE, config.OUTBOUND_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.lanes = [OrderedDict(), OrderedDict()]  # приоритет -> {chat_id: deque[OutboundItem]}
+        self.pending = {}        # ключ схлопывания -> OutboundItem в очереди
+        self.recent_actions = {}  # ключ chat action -> время отправки
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.in_flight = 0
+        self.stats = {"sent": 0, "coalesced": 0, "retry_after": 0}
+
+    def configure_shard(self, count: int):
+        """Лимиты Telegram общие для бота: шард получает свою долю глобального
+        лимита и лимита группы (в группу пишут пользователи разных шардов).
+        Личный чат обслуживает один шард, его лимит не делится"""
+        if count > 1:
+            global_rate = config.OUTBOUND_GLOBAL_RATE / count
+            self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+            self.group_rate = config.OUTBOUND_GROUP_CHAT_RATE / count
+            self.group_burst = max(config.OUTBOUND_CHAT_BURST / count, 1)
+            self.chat_buckets = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id - группы и каналы, для них лимит строже
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(config.OUTBOUND_PRIVATE_CHAT_RATE, config.OUTBOUND_CHAT_BURST)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _coalesce_key(self, method, chat_id):
+        name = type(method).__name__
+        if name == "SendChatAction":
+            return ("action", chat_id, method.action, getattr(method, "message_thread_id", None))
+        if name in COALESCED_EDITS:
+            return (name, chat_id, getattr(method, "message_id", None))
+        return None
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(PACED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+
+        key = self._coalesce_key(method, chat_id)
+        if key is not None:
+            if key[0] == "action":
+                sent_at = self.recent_actions.get(key)
+                if sent_at and time.monotonic() - sent_at < config.OUTBOUND_CHAT_ACTION_TTL:
+                    # Индикатор ещё отображается, повторять не нужно
+                    self.stats["coalesced"] += 1
+                    return Response[bool](ok=True, result=True)
+            item = self.pending.get(key)
+            if item is not None:
+                # Заменяем ожидающий запрос более свежим, результат получат оба
+                item.method = method
+                item.make_request = make_request
+                future = asyncio.get_running_loop().create_future()
+                item.futures.append(future)
+                self.stats["coalesced"] += 1
+                return await future
+
+        item = OutboundItem(make_request, bot, method, chat_id, send_priority.get(), key)
+        if key is not None:
+            self.pending[key] = item
+        self._enqueue(item)
+        return await item.futures[0]
+
+    def _enqueue(self, item: OutboundItem, front: bool = False):
+        lane = self.lanes[item.priority]
+        queue = lane.get(item.chat_id)
+        if queue is None:
+            queue = lane[item.chat_id] = deque()
+        if front:
+            queue.appendleft(item)
+        else:
+            queue.append(item)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+        self.wakeup.set()
+
+    def _pick(self, now: float):
+        """Выбирает следующий запрос, для чата которого есть токен"""
+        min_wait = None
+        for lane in self.lanes:
+            for chat_id, queue in lane.items():
+                bucket = self._chat_bucket(chat_id)
+                light = queue[0].light
+                # Служебный запрос ждёт только паузы чата после RetryAfter
+                wait = max(bucket.blocked_until - now, 0.0) if light else bucket.delay(now)
+                if wait > 0:
+                    min_wait = wait if min_wait is None else min(min_wait, wait)
+                    continue
+                item = queue.popleft()
+                if queue:
+                    lane.move_to_end(chat_id)  # Круговое обслуживание чатов
+                else:
+                    del lane[chat_id]
+                if not light:
+                    bucket.consume(now)
+                return item, None
+        return None, min_wait
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+            item, wait = self._pick(now)
+            if item is None:
+                if wait is None and not any(self.lanes):
+                    self._prune_buckets(now)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.global_bucket.consume(now)
+            if item.key is not None and self.pending.get(item.key) is item:
+                del self.pending[item.key]
+            asyncio.create_task(self._execute(item))
+
+    async def _execute(self, item: OutboundItem):
+        self.in_flight += 1
+        try:
+            response = await item.make_request(item.bot, item.method)
+        except TelegramRetryAfter as e:
+            self.stats["retry_after"] += 1
+            item.attempts += 1
+            logging.warning(f"RetryAfter {e.retry_after} с. для чата {item.chat_id}")
+            if item.attempts > config.OUTBOUND_MAX_RETRIES:
+                self._resolve(item, exception=e)
+                return
+            # Flood control приходит на чат, но при массовой отправке притормаживаем и глобально
+            self._chat_bucket(item.chat_id).block(e.retry_after)
+            if item.priority == PRIORITY_BULK:
+                self.global_bucket.block(e.retry_after)
+            self._enqueue(item, front=True)
+            return
+        except BaseException as e:
+            self._resolve(item, exception=e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        finally:
+            self.in_flight -= 1
+        self.stats["sent"] += 1
+        if item.key is not None and item.key[0] == "action":
+            self.recent_actions[item.key] = time.monotonic()
+        self._resolve(item, result=response)
+
+    def _resolve(self, item: OutboundItem, result=None, exception=None):
+        for future in item.futures:
+            if future.done():
+                continue
+            if isinstance(exception, asyncio.CancelledError):
+                future.cancel()
+            elif exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _prune_buckets(self, now: float):
+        # Удаляем состояние простаивающих чатов, чтобы память не росла
+        if len(self.chat_buckets) > config.OUTBOUND_MAX_TRACKED_CHATS:
+            self.chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+                if not bucket.is_idle(now)
+            }
+        self.recent_actions = {
+            key: sent_at for key, sent_at in self.recent_actions.items()
+            if now - sent_at < config.OUTBOUND_CHAT_ACTION_TTL
+        }
+
+    def queued(self) -> int:
+        return sum(len(queue) for lane in self.lanes for queue in lane.values())
+
+    def stats_text(self) -> str:
+        return (
+            f"📤 Исходящие: отправлено {self.stats['sent']}, схлопнуто {self.stats['coalesced']}, "
+            f"RetryAfter {self.stats['retry_after']}, в очереди {self.queued()}"
+        )
+
+
+outbound = OutboundThrottlingMiddleware()
@@ -1,27 +1,40 @@
 # middlewares/user_middleware.py
+import time
 import config
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 from typing import Callable, Awaitable, Dict, Any
-from database import user_history, user_settings
-from utils.helpers import save_user_info, update_user_activity
+from database import owns_key
+from utils.activity import activity
+from utils.quota import quota, classify_service, format_wait, SERVICE_NAMES
 
 # Мидлварь для обработки пользователей
 
 class UserMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: TelegramObject, data: dict):
         user = data.get("event_from_user")
-        if user:
+        # Обновления, пришедшие в шард по id чата (групповая викторина), не трогают
+        # данные пользователя: ими владеет его шард
+        if user and owns_key(user.id):
+            started = time.perf_counter_ns()
             user_id = user.id
-            if user_id not in user_history:
-                user_history[user_id] = []
-            if user_id not in user_settings:
-                user_settings[user_id] = {
-                    "model": "flux",
-                    "width": 1080,
-                    "height": 1920,
-                    "provider": config.DEFAULT_PROVIDER  # Добавлен провайдер
-                }
-            save_user_info(user)
-            await update_user_activity(user)
-        return await handler(event, data)
\ No newline at end of file
+            # Активность и профиль копятся в памяти и переносятся в user_info пачкой
+            activity.touch(user)
+
+            # Проверка квоты до запуска обработчика и любых сетевых запросов
+            service = classify_service(event) if user_id not in config.ADMINS else None
+            wait = quota.acquire(user_id, service) if service else 0
+            activity.record(time.perf_counter_ns() - started)
+            if wait:
+                await reject_over_quota(event, service, wait)
+                return None
+        return await handler(event, data)
+
+
+async def reject_over_quota(event, service: str, wait: float):
+    text = (f"⛔ Лимит запросов исчерпан ({SERVICE_NAMES[service]}).\n"
+            f"Попробуйте снова через {format_wait(wait)}")
+    if event.callback_query is not None:
+        await event.callback_query.answer(text, show_alert=True)
+    elif event.message is not None:
+        await event.message.answer(text)
\ No newline at end of file
@@ -1,4 +1,5 @@
 # services/admin.py
+import os
 import logging
 import asyncio
 from aiogram import F, Router, types
@@ -13,45 +14,37 @@ from database import (
                         image_requests, last_image_requests,
                         user_states, admin_states, blocked_users,
                         user_analysis_states, user_analysis_settings,
-                        user_transcribe_states
+                        user_transcribe_states, admin_user_searches, shard_state
                     )
 from datetime import datetime
+import config
 from config import ADMINS
-
-router = Router()
+from utils.image_cache import analysis_cache
+from utils.tts_cache import tts_cache
+from middlewares.outbound import outbound, outbound_priority, PRIORITY_BULK
+from utils.scheduler import scheduler
+from utils.quota import quota, SERVICES, SERVICE_NAMES
+from utils.inflight import inflight
+from utils import singleflight
+from utils.jobqueue import jobs
+from utils.quiz_bank import quiz_bank
+from utils.group_quiz import group_quiz
+from utils.activity import activity
+from utils.expiring import expiring_stats_text
+from utils.history_stats import history_stats, collect_stats, HISTORY_TYPE_NAMES
+from utils.user_index import user_index, SORT_NAMES, SORT_ACTIVITY
+from utils.history_export import export_history, period_start, EXPORT_FORMATS
+from utils.broadcast import broadcaster, BROADCAST_SEGMENTS, RUNNING as BROADCAST_RUNNING
+from utils.dispatch import StateRouter, ANY, ADMIN_INPUT, BLOCKED
+
+router = StateRouter()
+
+# Страница результатов поиска в списке пользователей
+SORT_SEARCH = "s"
 
 def is_admin(user_id: int):
     return user_id in ADMINS
 
-@router.message(Command("adminusers"))
-async def cmd_admin(message: Message):
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ Доступ запрещен")
-        return
-        
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Общая статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="👥 Список пользователей", callback_data="admin_users_list")],
-        [InlineKeyboardButton(text="🚫 Заблокированные", callback_data="admin_blocked_list")]
-    ])
-    await message.answer("🔐 Админ-панель", reply_markup=keyboard)
-
-@router.callback_query(lambda c: c.data.startswith("admin_block_"))
-async def block_user(query: CallbackQuery):
-    if not is_admin(query.from_user.id):
-        await query.answer("❌ Доступ запрещен")
-        return
-        
-    user_id = int(query.data.split("_")[2])
-    if is_admin(user_id):
-        await query.answer("❌ Невозможно заблокировать администратора")
-        return
-        
-    blocked_users[str(user_id)] = datetime.now().isoformat()
-    save_blocked_users()
-    await query.message.edit_text("✅ Пользователь заблокирован")
-
-
 ###################################################
 ########### Дополнения для админки ################
 
@@ -62,43 +55,51 @@ async def block_user(query: CallbackQuery):
 ################### Админ панель ###################
 
 # Обработчик для статистики
-@router.callback_query(lambda query: query.data == "admin_stats")
+@router.callback("admin_stats")
 async def handle_admin_stats(query: CallbackQuery):
     try:
+        # Счётчики истории сводятся по всем шардам
+        merged = await collect_stats()
         stats_text = "📊 Общая статистика:\n\n"
-        total_users = len(user_info)
-        total_messages = sum(len(h) for h in user_history.values())
+        total_users = merged["users"]
+        total_messages = sum(merged["totals"].values())
         total_blocked = len(blocked_users)
-        total_transcriptions = sum(
-            1 for entries in user_history.values() 
-            for entry in entries 
-            if entry.get("type") == "transcribe"
-        )
-        total_audio = sum(
-            1 for entries in user_history.values() 
-            for entry in entries 
-            if entry.get("type") == "audio"
-        )
+        total_transcriptions = merged["totals"].get("transcribe", 0)
+        total_audio = merged["totals"].get("audio", 0)
 
         stats_text += f"👥 Всего пользователей: {total_users}\n"
         stats_text += f"📨 Всего сообщений: {total_messages}\n"
         stats_text += f"🚫 Заблокированных: {total_blocked}\n\n"
         stats_text += f"\n🎤 Всего транскрибаций: {total_transcriptions}"
         stats_text += f"\n🎙️ Всего аудио: {total_audio}"
+        stats_text += f"\n{history_stats.usage_text(merged['daily'])}"
+        if shard_state["count"] > 1:
+            stats_text += (
+                f"\n\n🧩 Учтено шардов: {merged['shards']} из {shard_state['count']}, "
+                f"данные на {datetime.fromtimestamp(merged['oldest']).strftime('%H:%M:%S')}\n"
+                f"Ниже - счётчики только шарда {shard_state['index'] + 1}:"
+            )
+        stats_text += f"\n{analysis_cache.stats_text()}"
+        stats_text += f"\n{tts_cache.stats_text()}"
+        stats_text += f"\n{outbound.stats_text()}"
+        stats_text += f"\n{scheduler.stats_text()}"
+        stats_text += f"\n{quota.stats_text()}"
+        stats_text += f"\n{inflight.stats_text()}"
+        stats_text += f"\n{singleflight.stats_text()}"
+        stats_text += f"\n{jobs.stats_text()}"
+        stats_text += f"\n{quiz_bank.stats_text()}"
+        stats_text += f"\n{group_quiz.stats_text()}"
+        stats_text += f"\n{activity.stats_text()}"
+        stats_text += f"\n{expiring_stats_text()}\n\n"
         stats_text += "Топ активных пользователей:\n"
         
-        # Сортируем пользователей по количеству сообщений
-        active_users = sorted(
-            [(uid, len(history)) for uid, history in user_history.items()],
-            key=lambda x: x[1],
-            reverse=True
-        )[:5]  # Топ-5
-        
-        for i, (uid, count) in enumerate(active_users, 1):
-            user_info_str = get_user_info_str(uid)
+        # Топ поддерживается при записи в историю и сводится по шардам
+        for i, (uid, count, profile) in enumerate(merged["top"], 1):
+            user_info_str = format_user_info(uid, profile)
             stats_text += f"{i}. {user_info_str} - {count} сообщ.\n"
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="♻️ Повторить упавшие задачи", callback_data="admin_jobs_retry")],
             [InlineKeyboardButton(text="↩️ Назад", callback_data="admin_main_menu")]
         ])
         
@@ -109,8 +110,20 @@ async def handle_admin_stats(query: CallbackQuery):
         logging.error(f"Ошибка статистики: {str(e)}")
         await query.answer("❌ Ошибка загрузки статистики")
 
+# Возврат упавших фоновых задач в очередь
+@router.callback("admin_jobs_retry")
+async def handle_admin_jobs_retry(query: CallbackQuery):
+    if not is_admin(query.from_user.id):
+        return
+    try:
+        count = jobs.requeue_dead()
+        await query.answer(f"♻️ Возвращено в очередь задач: {count}", show_alert=True)
+    except Exception as e:
+        logging.error(f"Ошибка перезапуска задач: {str(e)}")
+        await query.answer("❌ Ошибка перезапуска задач")
+
 # Обработчик главного меню
-@router.callback_query(lambda query: query.data == "admin_main_menu")
+@router.callback("admin_main_menu")
 async def handle_admin_main_menu(query: CallbackQuery):
     try:
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -118,6 +131,7 @@ async def handle_admin_main_menu(query: CallbackQuery):
             [InlineKeyboardButton(text="👥 Список пользователей", callback_data="admin_users_list")],
             [InlineKeyboardButton(text="🚫 Заблокированные", callback_data="admin_blocked_list")],
             [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+            [InlineKeyboardButton(text="🎚 Тарифы", callback_data="admin_quota")],
             [InlineKeyboardButton(text="❌ Закрыть", callback_data="admin_close")]
         ])
         
@@ -135,7 +149,7 @@ async def handle_admin_main_menu(query: CallbackQuery):
         await query.answer("❌ Ошибка загрузки меню")
 
 # Обработчик закрытия меню
-@router.callback_query(lambda query: query.data == "admin_close")
+@router.callback("admin_close")
 async def handle_admin_close(query: CallbackQuery):
     await query.message.delete()
     await query.answer("🔒 Меню закрыто")
@@ -157,8 +171,10 @@ def get_role_icon(role):
 
 # Получаем информацию о пользователе
 def get_user_info_str(user_id: int) -> str:
-    if user_id in user_info:
-        info = user_info.get(user_id, {})
+    return format_user_info(user_id, user_info.get(user_id))
+
+def format_user_info(user_id: int, info) -> str:
+    if info:
         name = f"{info['first_name']} {info['last_name']}" if info.get('last_name') else info['first_name']
         username = f"(@{info['username']})" if info.get('username') else ""
         return f"{name} {username}" if name else f"ID: {user_id}"
@@ -166,7 +182,7 @@ def get_user_info_str(user_id: int) -> str:
 
 # Обработчик для команды /adminusers
 # Обработчик команды админ-панели
-@router.message(Command("adminusers"))
+@router.command("adminusers")
 async def cmd_admin(message: Message):
     if not is_admin(message.from_user.id):
         await message.answer("❌ Доступ запрещен")
@@ -177,6 +193,7 @@ async def cmd_admin(message: Message):
         [InlineKeyboardButton(text="👥 Список пользователей", callback_data="admin_users_list")],
         [InlineKeyboardButton(text="🚫 Заблокированные", callback_data="admin_blocked_list")],
         [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="🎚 Тарифы", callback_data="admin_quota")],
         [InlineKeyboardButton(text="❌ Закрыть", callback_data="admin_close")]
     ])
     
@@ -185,33 +202,104 @@ async def cmd_admin(message: Message):
         reply_markup=keyboard
     )
 
+# Список пользователей: страницы по индексам, а не сортировка всей базы
+def user_button_text(uid: int) -> str:
+    info = user_info.get(uid, {})
+    return f"👤 {info.get('first_name') or ''} {info.get('last_name') or ''} (@{info.get('username') or 'нет'})"
+
+def users_page(order: str, page: int, admin_id: int) -> tuple:
+    """Текст и клавиатура страницы списка; order=SORT_SEARCH - результаты поиска"""
+    size = config.ADMIN_USERS_PAGE_SIZE
+    if order == SORT_SEARCH:
+        prefix = admin_user_searches.get(admin_id, "")
+        uids, has_next = user_index.search(prefix, page * size, size)
+        title = f"🔍 Поиск «{prefix}», стр. {page + 1}"
+    else:
+        total = user_index.count()
+        pages = max((total + size - 1) // size, 1)
+        page = min(page, pages - 1)
+        uids = user_index.page(order, page, size)
+        has_next = page + 1 < pages
+        title = f"📋 Пользователи {SORT_NAMES[order]} (всего {total}), стр. {page + 1}/{pages}"
+
+    buttons = [[InlineKeyboardButton(text=user_button_text(uid), callback_data=f"admin_user_{uid}")] for uid in uids]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"admin_users:{order}:{page - 1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"admin_users:{order}:{page + 1}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([
+        InlineKeyboardButton(text=("✅ " if key == order else "") + name, callback_data=f"admin_users:{key}:0")
+        for key, name in SORT_NAMES.items()
+    ])
+    buttons.append([
+        InlineKeyboardButton(text="🔍 Поиск", callback_data="admin_users_search"),
+        InlineKeyboardButton(text="↩️ Назад", callback_data="admin_main_menu")
+    ])
+    if shard_state["count"] > 1:
+        # Профили и история хранятся у шарда-владельца, поэтому список неполный
+        title += f"\n⚠️ Только пользователи шарда {shard_state['index'] + 1} из {shard_state['count']}"
+    if not uids:
+        title += "\n\nНикого не найдено"
+    return title, InlineKeyboardMarkup(inline_keyboard=buttons)
+
 # Обработчик списка пользователей
-@router.callback_query(lambda query: query.data == "admin_users_list")
+@router.callback("admin_users_list")
 async def handle_users_list(query: CallbackQuery):
-    unique_users = {}
-    for uid, info in user_info.items():
-        unique_users[uid] = info
-    
-    if not unique_users:
+    await show_users_page(query, SORT_ACTIVITY, 0)
+
+@router.callback(prefix="admin_users:")
+async def handle_users_page(query: CallbackQuery):
+    _, order, page = query.data.split(":")
+    if order not in SORT_NAMES and order != SORT_SEARCH:
+        await query.answer()
+        return
+    await show_users_page(query, order, int(page))
+
+async def show_users_page(query: CallbackQuery, order: str, page: int):
+    admin_id = query.from_user.id
+    if not is_admin(admin_id):
+        await query.answer("❌ Доступ запрещен")
+        return
+    if order != SORT_SEARCH and not user_info:
         await query.answer("📂 База пользователей пуста")
         return
-    
-    sorted_users = sorted(unique_users.items(), key=lambda x: x[0])
-    buttons = []
-    for uid, info in sorted_users:
-        user_text = f"👤 {info['first_name']} {info['last_name'] or ''} (@{info['username'] or 'нет'})"
-        buttons.append([InlineKeyboardButton(text=user_text, callback_data=f"admin_user_{uid}")])
-    
-    buttons.append([InlineKeyboardButton(text="↩️ Назад", callback_data="admin_main_menu")])
-    
-    await query.message.edit_text(
-        "📋 Список пользователей:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
-    )
+    try:
+        text, keyboard = users_page(order, page, admin_id)
+        await query.message.edit_text(text, reply_markup=keyboard)
+        await query.answer()
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logging.error(f"Ошибка списка пользователей: {str(e)}")
+        await query.answer()
+
+# Поиск по username, имени и фамилии
+@router.callback("admin_users_search")
+async def handle_users_search(query: CallbackQuery):
+    admin_id = query.from_user.id
+    if not is_admin(admin_id):
+        await query.answer("❌ Доступ запрещен")
+        return
+    admin_states[admin_id] = {"action": "user_search"}
+    await query.message.answer("🔍 Введите начало username, имени или фамилии:")
+    await query.answer()
+
+async def apply_user_search(message: Message):
+    admin_id = message.from_user.id
+    del admin_states[admin_id]
+    prefix = (message.text or "").strip()
+    if not prefix:
+        await message.answer("❌ Пустой запрос")
+        return
+    admin_user_searches[admin_id] = prefix
+    text, keyboard = users_page(SORT_SEARCH, 0, admin_id)
+    await message.answer(text, reply_markup=keyboard)
 
 
 # Обработчик для отправки сообщения пользователю
-@router.callback_query(lambda query: query.data.startswith("admin_message_"))
+@router.callback(prefix="admin_message_")
 async def handle_admin_message(query: CallbackQuery):
     admin_id = query.from_user.id
     if not is_admin(admin_id):
@@ -225,7 +313,7 @@ async def handle_admin_message(query: CallbackQuery):
     await query.answer()
 
 # Обработчик текстовых сообщений для админских действий
-@router.message(lambda message: is_admin(message.from_user.id) and message.from_user.id in admin_states)
+@router.message(ANY, state=ADMIN_INPUT)
 async def handle_admin_messages(message: Message):
     admin_id = message.from_user.id
     state = admin_states.get(admin_id)
@@ -239,44 +327,55 @@ async def handle_admin_messages(message: Message):
     
     try:
         if action == "message" and target:
-            # Создаем клавиатуру
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Принято", callback_data=f"response_accepted_{admin_id}_{target}"),
-                 InlineKeyboardButton(text="❌ Не принято", callback_data=f"response_rejected_{admin_id}_{target}")]
-            ])
+            # Сообщения от админа идут в массовой полосе, не мешая интерактивным ответам
+            with outbound_priority(PRIORITY_BULK):
+                # Создаем клавиатуру
+                keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="✅ Принято", callback_data=f"response_accepted_{admin_id}_{target}"),
+                     InlineKeyboardButton(text="❌ Не принято", callback_data=f"response_rejected_{admin_id}_{target}")]
+                ])
             
-            # Получаем информацию о пользователе
-            user_info_str = get_user_info_str(target)
+                # Получаем информацию о пользователе
+                user_info_str = get_user_info_str(target)
             
-            # Отправляем сообщение пользователю
-            user_message = await bot.send_message(
-                chat_id=target,
-                text=f"📨 Сообщение от администратора:\n\n{text}",
-                reply_markup=keyboard
-            )
+                # Отправляем сообщение пользователю
+                user_message = await bot.send_message(
+                    chat_id=target,
+                    text=f"📨 Сообщение от администратора:\n\n{text}",
+                    reply_markup=keyboard
+                )
             
-            # Отправляем подтверждение администратору
-            await bot.send_message(
-                chat_id=admin_id,
-                text=f"✅ Сообщение отправлено пользователю: {user_info_str}",
-                reply_to_message_id=message.message_id
-            )
+                # Отправляем подтверждение администратору
+                await bot.send_message(
+                    chat_id=admin_id,
+                    text=f"✅ Сообщение отправлено пользователю: {user_info_str}",
+                    reply_to_message_id=message.message_id
+                )
             
-            # Сохраняем контекст
-            admin_states[admin_id] = {
-                "action": "message",
-                "target": target,
-                "admin_msg_id": message.message_id,
-                "user_info_str": user_info_str,
-                "message_text": text
-            }
+                # Сохраняем контекст
+                admin_states[admin_id] = {
+                    "action": "message",
+                    "target": target,
+                    "admin_msg_id": message.message_id,
+                    "user_info_str": user_info_str,
+                    "message_text": text
+                }
+
+        elif action == "quota_edit":
+            await apply_quota_edit(message, state)
+
+        elif action == "user_search":
+            await apply_user_search(message)
+
+        elif action in ("broadcast", "broadcast_ready"):
+            await prepare_broadcast(message)
 
     except Exception as e:
         await message.answer(f"❌ Ошибка: {str(e)}")
         logging.error(f"Admin error: {str(e)}")
 
 # Кнопки для просмотра истории и блокировки:
-@router.callback_query(lambda query: query.data.startswith("admin_user_"))
+@router.callback(prefix="admin_user_")
 async def handle_admin_user_selection(query: CallbackQuery):
     try:
         admin_id = query.from_user.id
@@ -309,7 +408,8 @@ async def handle_admin_user_selection(query: CallbackQuery):
                 *action_buttons
             ],
             [
-                InlineKeyboardButton(text="📨 Сообщение", callback_data=f"admin_message_{user_id}")
+                InlineKeyboardButton(text="📨 Сообщение", callback_data=f"admin_message_{user_id}"),
+                InlineKeyboardButton(text=f"🎚 Тариф: {quota.user_tier(user_id)}", callback_data=f"admin_tier:{user_id}")
             ],
             [
                 InlineKeyboardButton(text="↩️ Назад к списку", callback_data="admin_users_list"),
@@ -332,8 +432,26 @@ async def handle_admin_user_selection(query: CallbackQuery):
         await query.answer("❌ Произошла ошибка")
 
 
-# Обновленный обработчик истории
-@router.callback_query(lambda query: query.data.startswith("admin_history_"))
+# Выгрузка истории пользователя одним сжатым файлом
+EXPORT_PERIODS = {0: "Всё время", 7: "7 дней", 30: "30 дней"}
+
+def export_menu(user_id: int, fmt: str, days: int, entry_type: str) -> InlineKeyboardMarkup:
+    """Клавиатура выбора фильтров; текущий выбор хранится в callback data"""
+    def button(text, selected, fmt=fmt, days=days, entry_type=entry_type, go=0):
+        return InlineKeyboardButton(
+            text=("✅ " if selected else "") + text,
+            callback_data=f"admin_export:{user_id}:{fmt}:{days}:{entry_type}:{go}"
+        )
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [button(name.upper(), name == fmt, fmt=name) for name in EXPORT_FORMATS],
+        [button(name, period == days, days=period) for period, name in EXPORT_PERIODS.items()],
+        [button("Все", entry_type == "all", entry_type="all")]
+        + [button(name.split()[0], key == entry_type, entry_type=key) for key, name in HISTORY_TYPE_NAMES.items()],
+        [button("📦 Выгрузить", False, go=1),
+         InlineKeyboardButton(text="↩️ Назад", callback_data=f"admin_user_{user_id}")]
+    ])
+
+@router.callback(prefix="admin_history_")
 async def handle_admin_history(query: CallbackQuery):
     admin_id = query.from_user.id
     if not is_admin(admin_id):
@@ -341,64 +459,52 @@ async def handle_admin_history(query: CallbackQuery):
         return
     
     user_id = int(query.data.split("_")[2])
-    history = user_history.get(user_id, [])
-    
-    # Максимальная длина сообщения Telegram (4096 символов)
-    MAX_MESSAGE_LENGTH = 4000  
-    history_text = "📜 История диалога:\n\n"
-    valid_entries = 0
-    
-    # Разбиваем историю на части
-    for entry in history:
-        entry_type = entry.get("type", "unknown")
-        
-        if entry_type == "text":
-            role = entry.get("role", "user")
-            content = entry.get("content", "")
-            timestamp = entry.get("timestamp", "")
-            prefix = "👤" if role == "user" else "🤖"
-            
-            # Формируем запись
-            entry_text = f"{prefix} {role.capitalize()} ({timestamp}):\n{content}\n\n"
-            
-            # Проверяем длину
-            if len(history_text) + len(entry_text) > MAX_MESSAGE_LENGTH:
-                await query.message.answer(history_text)
-                history_text = ""  # Начинаем новую часть
-            
-            history_text += entry_text
-            valid_entries += 1
-        
-        elif entry_type == "image":
-            prompt = entry.get("prompt", "")
-            model = entry.get("model", "")
-            width = entry.get("width", "")
-            height = entry.get("height", "")
-            history_text += f"🖼 Запрос изображения: '{prompt}'\nМодель: {model}, Размер: {width}x{height}\n\n"
-            valid_entries += 1
-        
-        elif entry_type == "transcribe":
-            response = entry.get("response", "")
-            history_text += f"🎤 Транскрибация: {response[:50]}...\n\n"
-            valid_entries += 1
-
-    # Отправляем оставшуюся часть
-    if history_text.strip():
-        await query.message.answer(history_text)
-    
-    # Кнопка возврата
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="↩️ Назад", callback_data=f"admin_user_{user_id}")]
-    ])
-    
-    if valid_entries == 0:
-        await query.message.answer("История пуста")
-    
-    await query.message.answer("Конец истории", reply_markup=keyboard)
+    await query.message.edit_text(
+        f"📜 История: {get_user_info_str(user_id)}\n"
+        f"Записей: {len(user_history.get(user_id, []))}\n\n"
+        "Выберите формат, период и тип записей:",
+        reply_markup=export_menu(user_id, "jsonl", 0, "all")
+    )
     await query.answer()
 
+@router.callback(prefix="admin_export:")
+async def handle_admin_export(query: CallbackQuery):
+    admin_id = query.from_user.id
+    if not is_admin(admin_id):
+        await query.answer("❌ Доступ запрещен")
+        return
+
+    _, user_id, fmt, days, entry_type, go = query.data.split(":")
+    user_id, days = int(user_id), int(days)
+    if go != "1":
+        try:
+            await query.message.edit_reply_markup(reply_markup=export_menu(user_id, fmt, days, entry_type))
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.error(f"Ошибка меню выгрузки: {str(e)}")
+        await query.answer()
+        return
+
+    await query.answer("⏳ Готовим файл...")
+    path = None
+    try:
+        types = None if entry_type == "all" else {entry_type}
+        # Сжатие - в отдельном потоке, чтобы не останавливать обработку других обновлений
+        path = await asyncio.to_thread(export_history, user_id, fmt, period_start(days), None, types)
+        await query.message.answer_document(
+            FSInputFile(path, filename=os.path.basename(path)),
+            caption=f"📜 История {get_user_info_str(user_id)}: {EXPORT_PERIODS.get(days, days)}, "
+                    f"{HISTORY_TYPE_NAMES.get(entry_type, 'все записи')}"
+        )
+    except Exception as e:
+        logging.error(f"Ошибка выгрузки истории {user_id}: {str(e)}")
+        await query.message.answer("❌ Ошибка выгрузки истории")
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
 # Обработчик для блокировки пользователя
-@router.callback_query(lambda query: query.data.startswith("admin_block_"))
+@router.callback(prefix="admin_block_")
 async def handle_admin_block(query: CallbackQuery):
     admin_id = query.from_user.id
     if not is_admin(admin_id):
@@ -421,7 +527,7 @@ async def handle_admin_block(query: CallbackQuery):
     await query.answer("✅ Пользователь заблокирован", show_alert=True)
     await query.message.edit_text(f"🚫 Пользователь ID: {user_id} заблокирован.")
 
-@router.callback_query(lambda query: query.data.startswith("admin_unblock_"))
+@router.callback(prefix="admin_unblock_")
 async def handle_admin_unblock(query: CallbackQuery):
     admin_id = query.from_user.id
     if not is_admin(admin_id):
@@ -442,7 +548,7 @@ async def handle_admin_unblock(query: CallbackQuery):
     await query.message.edit_text(f"🔓 Пользователь ID: {user_id} разблокирован.")
 
 # Обработчик для инлайн-кнопок "Принято" и "Не принято"
-@router.callback_query(lambda query: query.data.startswith("response_"))
+@router.callback(prefix="response_")
 async def handle_response(callback: CallbackQuery):
     # Логируем данные callback
     logging.info(f"Callback data: {callback.data}")
@@ -497,7 +603,7 @@ async def handle_response(callback: CallbackQuery):
 
 
 # Модифицированный обработчик блокированных пользователей
-@router.callback_query(lambda query: query.data == "admin_blocked_list")
+@router.callback("admin_blocked_list")
 async def handle_blocked_list(query: CallbackQuery):
     if not is_admin(query.from_user.id):
         await query.answer("❌ Доступ запрещен")
@@ -523,18 +629,171 @@ async def handle_blocked_list(query: CallbackQuery):
 
 
 # Обновляем обработчик admin_cancel для поддержки возврата
-@router.callback_query(lambda query: query.data == "admin_cancel")
+@router.callback("admin_cancel")
 async def handle_admin_cancel(query: CallbackQuery):
     await query.message.edit_text("Действие отменено")
     await query.answer()
 
+####################################################
+################# Тарифы и квоты ###################
+
+def tier_limits_text(tier: str, limits: dict) -> str:
+    lines = [f"🎚 Тариф «{tier}»:"]
+    for service in SERVICES:
+        capacity, per_hour = limits.get(service, (0, 0))
+        if per_hour > 0:
+            lines.append(f"  {SERVICE_NAMES[service]}: {capacity} сразу, +{per_hour} в час")
+        else:
+            lines.append(f"  {SERVICE_NAMES[service]}: без ограничений")
+    return "\n".join(lines)
+
+# Список тарифов
+@router.callback("admin_quota")
+async def handle_quota_tiers(query: CallbackQuery):
+    if not is_admin(query.from_user.id):
+        await query.answer("❌ Доступ запрещен")
+        return
+    tiers = quota.tier_definitions()
+    text = "\n\n".join(tier_limits_text(tier, limits) for tier, limits in tiers.items())
+    buttons = [[InlineKeyboardButton(text=f"✏️ {tier}", callback_data=f"admin_quota_tier:{tier}")] for tier in tiers]
+    buttons.append([InlineKeyboardButton(text="↩️ Назад", callback_data="admin_main_menu")])
+    await query.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await query.answer()
+
+# Выбор сервиса для изменения лимита
+@router.callback(prefix="admin_quota_tier:")
+async def handle_quota_tier(query: CallbackQuery):
+    if not is_admin(query.from_user.id):
+        await query.answer("❌ Доступ запрещен")
+        return
+    tier = query.data.split(":", 1)[1]
+    limits = quota.tier_definitions().get(tier, {})
+    buttons = [
+        [InlineKeyboardButton(text=SERVICE_NAMES[service], callback_data=f"admin_quota_edit:{tier}:{service}")]
+        for service in SERVICES
+    ]
+    buttons.append([InlineKeyboardButton(text="↩️ Назад", callback_data="admin_quota")])
+    await query.message.edit_text(tier_limits_text(tier, limits), reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await query.answer()
+
+# Запрос нового значения лимита
+@router.callback(prefix="admin_quota_edit:")
+async def handle_quota_edit(query: CallbackQuery):
+    admin_id = query.from_user.id
+    if not is_admin(admin_id):
+        await query.answer("❌ Доступ запрещен")
+        return
+    _, tier, service = query.data.split(":", 2)
+    admin_states[admin_id] = {"action": "quota_edit", "tier": tier, "service": service}
+    await query.message.answer(
+        f"Введите лимит для «{tier}» / {SERVICE_NAMES[service]} в формате:\n"
+        "<ёмкость> <пополнение в час>\n"
+        "Например: 10 30. Пополнение 0 - без ограничений."
+    )
+    await query.answer()
+
+async def apply_quota_edit(message: Message, state: dict):
+    admin_id = message.from_user.id
+    try:
+        capacity, per_hour = (int(value) for value in (message.text or "").split())
+        if capacity < 0 or per_hour < 0:
+            raise ValueError
+    except ValueError:
+        await message.answer("❌ Нужно два неотрицательных числа, например: 10 30")
+        return
+    tier = state["tier"]
+    quota.set_limit(tier, state["service"], capacity, per_hour)
+    del admin_states[admin_id]
+    await message.answer(f"✅ Лимит обновлён.\n\n{tier_limits_text(tier, quota.tier_definitions()[tier])}")
+
+# Смена тарифа пользователя (по кругу)
+@router.callback(prefix="admin_tier:")
+async def handle_user_tier(query: CallbackQuery):
+    if not is_admin(query.from_user.id):
+        await query.answer("❌ Доступ запрещен")
+        return
+    user_id = int(query.data.split(":", 1)[1])
+    tiers = list(quota.tier_definitions())
+    current = quota.user_tier(user_id)
+    new_tier = tiers[(tiers.index(current) + 1) % len(tiers)] if current in tiers else tiers[0]
+    # Через общее хранилище: пользователь может принадлежать другому шарду
+    await asyncio.to_thread(quota.set_user_tier, user_id, new_tier)
+    await query.answer(f"🎚 Тариф пользователя: {new_tier}", show_alert=True)
+
+# Рассылка: сообщение копируется пользователям выбранного сегмента
+async def prepare_broadcast(message: Message):
+    admin_id = message.from_user.id
+    admin_states[admin_id] = {
+        "action": "broadcast_ready",
+        "from_chat_id": message.chat.id,
+        "message_id": message.message_id
+    }
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        *[[InlineKeyboardButton(text=f"📢 {name}", callback_data=f"admin_bc:start:{key}")]
+          for key, (name, _) in BROADCAST_SEGMENTS.items()],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_cancel")]
+    ])
+    await message.reply(
+        "Кому отправить это сообщение? Чтобы заменить сообщение, просто отправьте новое.",
+        reply_markup=keyboard
+    )
+
+@router.callback(prefix="admin_bc:")
+async def handle_broadcast_actions(query: CallbackQuery):
+    admin_id = query.from_user.id
+    if not is_admin(admin_id):
+        await query.answer("❌ Доступ запрещен")
+        return
+    action, _, arg = query.data[len("admin_bc:"):].partition(":")
+    try:
+        if action == "start":
+            state = admin_states.get(admin_id)
+            if not state or state.get("action") != "broadcast_ready" or arg not in BROADCAST_SEGMENTS:
+                await query.answer("Сообщение для рассылки не найдено, начните заново")
+                return
+            del admin_states[admin_id]
+            broadcast_id = await broadcaster.start(
+                admin_id, state["from_chat_id"], state["message_id"], arg,
+                query.message.chat.id, query.message.message_id
+            )
+            await query.message.edit_text(
+                broadcaster.progress_text(broadcast_id),
+                reply_markup=broadcaster.progress_markup(broadcast_id, BROADCAST_RUNNING)
+            )
+            await query.answer("Рассылка запущена")
+        elif action in ("status", "stop"):
+            broadcast_id = int(arg)
+            if action == "stop":
+                broadcaster.cancel(broadcast_id)
+            row = broadcaster.get(broadcast_id)
+            await query.message.edit_text(
+                broadcaster.progress_text(broadcast_id),
+                reply_markup=broadcaster.progress_markup(broadcast_id, row[4])
+            )
+            await query.answer("Рассылка остановлена" if action == "stop" else None)
+        elif action == "cleanup":
+            await broadcaster.request_cleanup()
+            await query.message.edit_reply_markup(
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="↩️ В меню", callback_data="admin_main_menu")]
+                ])
+            )
+            await query.answer("Данные недоступных пользователей будут удалены")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logging.error(f"Ошибка рассылки: {str(e)}")
+        await query.answer()
+    except Exception as e:
+        logging.error(f"Ошибка рассылки: {str(e)}")
+        await query.answer("❌ Ошибка рассылки")
+
 # Проверка блокировки пользователя
-@router.message(lambda message: message.from_user.id in blocked_users)
+@router.message(ANY, state=BLOCKED)
 async def handle_blocked_user(message: Message):
     await message.answer("🚫 Вы заблокированы и не можете использовать бота.")
 
 # Обработчик инлайн-кнопок админки (ИСПРАВЛЕННЫЙ ВАРИАНТ)
-@router.callback_query(lambda query: query.data.startswith("admin_"))
+@router.callback(prefix="admin_")
 async def handle_admin_actions(query: CallbackQuery):
     admin_id = query.from_user.id
     if not is_admin(admin_id):
@@ -544,7 +803,7 @@ async def handle_admin_actions(query: CallbackQuery):
     # Убрана обработка admin_user_ из этого обработчика
     if data == "admin_broadcast":
         admin_states[admin_id] = {"action": "broadcast"}
-        await query.message.answer("Введите сообщение для рассылки всем пользователям:")
+        await query.message.answer("Отправьте сообщение для рассылки (текст, фото, видео, документ):")
         await query.answer()
   
     elif data == "admin_cancel":
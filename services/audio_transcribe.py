@@ -13,6 +13,8 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from utils.helpers import is_admin, save_users
 from services.tgapi import bot
+from utils.scheduler import scheduler
+from utils.jobqueue import jobs
 from database import (  save_users, load_users, save_blocked_users,
                         user_history, user_settings, user_info,
                         image_requests, last_image_requests,
@@ -24,8 +26,10 @@ from utils.helpers import ( get_user_settings, convert_to_mp3, split_audio,
                             auto_detect_language, format_response)
 from services.retry import (transcribe_with_retry, download_image_with_retry,
                             generate_audio_with_retry)
+from utils.dispatch import StateRouter, VOICE, AUDIO_DOCUMENT, AUDIO_TRANSCRIBE
+from utils.history_stats import append_history
 
-router = Router()
+router = StateRouter()
 
 class AudioState(StatesGroup):
     waiting_for_audio = State()
@@ -34,14 +38,14 @@ class AudioState(StatesGroup):
 ##### Обработчик транскрибации аудиофайла Polinations ##### 
 
 # Обработчик команды /transcribe
-@router.message(Command("transcribe"))
+@router.command("transcribe")
 async def cmd_transcribe(message: Message):
     user_id = message.from_user.id
     await message.answer("🎤 Пожалуйста, отправьте аудиофайл для распознавания.")
     user_transcribe_states[user_id] = "waiting_for_audio_transcribe"
 
 # Обработчик аудиофайлов для транскрибации
-@router.message(lambda message: message.audio or message.voice or message.document and message.document.mime_type.startswith('audio/'))
+@router.message(VOICE, AUDIO_DOCUMENT, state=AUDIO_TRANSCRIBE)
 async def handle_audio_transcribe(message: Message):
     user_id = message.from_user.id
     
@@ -49,52 +53,76 @@ async def handle_audio_transcribe(message: Message):
     if user_transcribe_states.get(user_id) != "waiting_for_audio_transcribe":
         return  # Игнорируем, если не запрашивали транскрибацию
     
-    await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
+    # Распознавание выполняется фоновой задачей: результат придёт и после перезапуска бота
+    audio_file = message.audio or message.voice or message.document
+    await jobs.enqueue_async(
+        "transcribe",
+        {"user_id": user_id, "chat_id": message.chat.id, "file_id": audio_file.file_id},
+        idempotency_key=f"transcribe:{message.chat.id}:{message.message_id}",
+        route_key=user_id
+    )
+    user_transcribe_states[user_id] = None
+    await message.answer("🎤 Файл принят, результат распознавания придёт в этот чат.")
+
+
+async def notify_transcription_failed(payload: dict, error: str):
+    await bot.send_message(
+        payload["chat_id"],
+        "⚠️ Ошибка при транскрибации:\n"
+        "1. Проверьте, что файл не превышает 512 MB\n"
+        "2. Попробуйте использовать формат MP3\n"
+        "3. Для длинных записей используйте более короткие фрагменты"
+    )
+
+
+@jobs.handler("transcribe", on_dead=notify_transcription_failed, inflight_service="transcribe")
+async def run_transcription(payload: dict):
+    """Фоновая задача транскрибации: скачивает файл по file_id и отправляет результат"""
+    user_id, chat_id = payload["user_id"], payload["chat_id"]
+    file_info = await bot.get_file(payload["file_id"])
+    file_path = file_info.file_path
+    
+    # Создаём временную директорию
+    temp_dir = tempfile.gettempdir()
+    temp_input_path = os.path.join(temp_dir, f"{file_info.file_id}.{file_path.split('.')[-1]}")
+    
+    await bot.send_chat_action(chat_id, ChatAction.TYPING)
     
     try:
-        # Получаем файл
-        audio_file = message.audio or message.voice or message.document
-        file_info = await bot.get_file(audio_file.file_id)
-        file_path = file_info.file_path
-        
-        # Создаём временную директорию
-        temp_dir = tempfile.gettempdir()
-        temp_input_path = os.path.join(temp_dir, f"{file_info.file_id}.{file_path.split('.')[-1]}")
-        
         # Скачиваем файл
         await bot.download_file(file_path, temp_input_path)
         
         # Проверка формата
         file_extension = temp_input_path.split('.')[-1].lower()
         if file_extension not in config.SUPPORTED_AUDIO_FORMATS:
-            await message.answer(f"❌ Формат {file_extension} не поддерживается. Поддерживаются: {', '.join(config.SUPPORTED_AUDIO_FORMATS)}")
+            await bot.send_message(chat_id, f"❌ Формат {file_extension} не поддерживается. Поддерживаются: {', '.join(config.SUPPORTED_AUDIO_FORMATS)}")
             return
         
         # Проверка размера
         file_size = os.path.getsize(temp_input_path)
         if file_size > config.MAX_AUDIO_SIZE:
-            await message.answer("⏳ Файл слишком большой. Попробую сжать...")
+            await bot.send_message(chat_id, "⏳ Файл слишком большой. Попробую сжать...")
             
             # Конвертируем в MP3
             mp3_path = os.path.join(temp_dir, f"{file_info.file_id}.mp3")
             
             if not convert_to_mp3(temp_input_path, mp3_path):
-                await message.answer("❌ Не удалось конвертировать файл в MP3")
+                await bot.send_message(chat_id, "❌ Не удалось конвертировать файл в MP3")
                 return
             
             # Проверяем размер после конвертации
             mp3_size = os.path.getsize(mp3_path)
             if mp3_size > config.MAX_AUDIO_SIZE:
-                await message.answer("⏳ Файл всё ещё слишком большой. Разбиваю на части...")
+                await bot.send_message(chat_id, "⏳ Файл всё ещё слишком большой. Разбиваю на части...")
                 
                 # Разбиваем на части
                 chunks = split_audio(mp3_path)
                 if not chunks:
-                    await message.answer("❌ Не удалось разбить аудиофайл на части")
+                    await bot.send_message(chat_id, "❌ Не удалось разбить аудиофайл на части")
                     return
                 
                 full_transcription = ""
-                progress_msg = await message.answer("🔄 Обработка частей файла:")
+                progress_msg = await bot.send_message(chat_id, "🔄 Обработка частей файла:")
                 
                 for i, chunk_path in enumerate(chunks):
                     # Обновляем статус прогресса
@@ -125,7 +153,8 @@ async def handle_audio_transcribe(message: Message):
                     }
                     
                     try:
-                        result = await transcribe_with_retry(payload)
+                        async with scheduler.slot("transcribe", user_id, bounded=False):
+                            result = await transcribe_with_retry(payload)
                         transcription = result['choices'][0]['message']['content']
                         full_transcription += f"Часть {i+1}:\n{transcription}\n\n"
                     except Exception as e:
@@ -136,23 +165,10 @@ async def handle_audio_transcribe(message: Message):
                 await progress_msg.delete()
                 
                 # Сохраняем в историю
-                user_entry = {
-                    "type": "transcribe",
-                    "prompt": "Распознайте речь из этого аудиофайла (разбит на части)",
-                    "timestamp": datetime.now().isoformat()
-                }
-                user_history.setdefault(user_id, []).append(user_entry)
-                
-                assistant_entry = {
-                    "type": "transcribe",
-                    "response": full_transcription,
-                    "timestamp": datetime.now().isoformat()
-                }
-                user_history[user_id].append(assistant_entry)
-                save_users()
+                save_transcription_history(user_id, "Распознайте речь из этого аудиофайла (разбит на части)", full_transcription)
                 
                 # Отправляем результат
-                await message.answer(f"🎤 Результат транскрибации (файл разбит на части):\n\n{full_transcription}")
+                await bot.send_message(chat_id, f"🎤 Результат транскрибации (файл разбит на части):\n\n{full_transcription}")
                 return
         
         else:
@@ -182,37 +198,16 @@ async def handle_audio_transcribe(message: Message):
         
         logging.info(f"Транскрибация аудио от {user_id}")
         
-        # Отправляем запрос
-        result = await transcribe_with_retry(payload)
+        # Отправляем запрос; ошибка уходит в очередь задач и запрос повторяется позже
+        async with scheduler.slot("transcribe", user_id, bounded=False):
+            result = await transcribe_with_retry(payload)
         transcription = result['choices'][0]['message']['content']
         
         # Сохраняем в историю
-        user_entry = {
-            "type": "transcribe",
-            "prompt": "Распознайте речь из этого аудиофайла",
-            "timestamp": datetime.now().isoformat()
-        }
-        user_history.setdefault(user_id, []).append(user_entry)
-        
-        assistant_entry = {
-            "type": "transcribe",
-            "response": transcription,
-            "timestamp": datetime.now().isoformat()
-        }
-        user_history[user_id].append(assistant_entry)
-        save_users()
+        save_transcription_history(user_id, "Распознайте речь из этого аудиофайла", transcription)
         
         # Отправляем результат
-        await message.answer(f"🎤 Результат транскрибации:\n\n{transcription}")
-        
-    except Exception as e:
-        logging.error(f"Ошибка транскрибации: {str(e)}")
-        await message.answer(
-            "⚠️ Ошибка при транскрибации:\n"
-            "1. Проверьте, что файл не превышает 512 MB\n"
-            "2. Попробуйте использовать формат MP3\n"
-            "3. Для длинных записей используйте более короткие фрагменты"
-        )
+        await bot.send_message(chat_id, f"🎤 Результат транскрибации:\n\n{transcription}")
     
     finally:
         # Очищаем временные файлы
@@ -223,9 +218,24 @@ async def handle_audio_transcribe(message: Message):
                         os.remove(os.path.join(root, file))
                     except:
                         pass
-        
-        # Сбрасываем состояние
-        user_transcribe_states[user_id] = None
+
+
+def save_transcription_history(user_id, prompt, response):
+    """Сохранение транскрибации в историю"""
+    user_entry = {
+        "type": "transcribe",
+        "prompt": prompt,
+        "timestamp": datetime.now().isoformat()
+    }
+    append_history(user_id, user_entry)
+    
+    assistant_entry = {
+        "type": "transcribe",
+        "response": response,
+        "timestamp": datetime.now().isoformat()
+    }
+    append_history(user_id, assistant_entry)
+    save_users()
 
 
 #####################################################
@@ -1,12 +1,14 @@
 # services/audio_transcribeapi.py
 
 import os
+import time
 import asyncio
 import httpx
 import config
 import pollinations as ai
 from aiogram import F, Router, types
 from services.tgapi import bot
+from utils.jobqueue import jobs, RetryLater
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputFile, BufferedInputFile, FSInputFile, BotCommand, BotCommandScopeChat, CallbackQuery, TelegramObject
 from aiogram.enums import ParseMode, ChatAction
@@ -19,8 +21,9 @@ from database import (  save_users, load_users, save_blocked_users,
                         user_transcribe_states)
 from speechmatics.batch_client import BatchClient
 from speechmatics.models import BatchTranscriptionConfig
+from utils.dispatch import StateRouter
 
-router = Router()
+router = StateRouter()
 
 ###########################################################
 ########### Обработчик транскрибации аудиофайла ########### 
@@ -116,37 +119,46 @@ async def handle_audio_file(message: Message):
             await bot.delete_message(chat_id=message.chat.id, message_id=processing_message.message_id)  # Удаляем сообщение о обработке
             await message.answer("✅ Задача отправлена на распознавание. Ожидайте результатов...", disable_notification=True)
 
-            # Запускаем фоновую задачу для проверки статуса
-            asyncio.create_task(check_job_status(job_id, user_id))
+            # Ожидание результата - фоновая задача в очереди, переживает перезапуск бота
+            await jobs.enqueue_async(
+                "speechmatics_result",
+                {"job_id": job_id, "user_id": user_id,
+                 "deadline": time.time() + config.SPEECHMATICS_WAIT_LIMIT},
+                idempotency_key=f"speechmatics:{job_id}",
+                delay=config.SPEECHMATICS_POLL_INTERVAL,
+                route_key=user_id
+            )
 
     except Exception as e:
         await bot.delete_message(chat_id=message.chat.id, message_id=processing_message.message_id)  # Удаляем сообщение о обработке
         await message.answer(f"⚠️ Произошла ошибка: {str(e)}", disable_notification=True)
 
 # Фоновая задача для проверки статуса
-async def check_job_status(job_id, user_id):
-    while True:
-        await asyncio.sleep(15)  # Проверяем статус каждые 15 секунд
-
-        # Получаем статус задачи
-        transcript = await get_transcript(job_id, config.SPEECHMATICS_API)
-        if transcript:
-            # Создаем файл в папке temp
-            try:
-                temp_file_path = os.path.join('temp', f"{job_id}.txt")
-                with open(temp_file_path, 'w', encoding='utf-8') as temp_file:
-                    temp_file.write(transcript)  # Записываем текст в файл
-
-                # Отправляем файл пользователю с использованием FSInputFile
-                audio_file = FSInputFile(temp_file_path)
-                sent_message = await bot.send_document(user_id, audio_file, disable_notification=True)
-                await bot.delete_message(chat_id=user_id, message_id=sent_message.message_id - 1)  # Удаляем предыдущее сообщение со статусом
-            except Exception as e:
-                await bot.send_message(user_id, f"⚠️ Ошибка при создании файла: {str(e)}", disable_notification=True)
-            break
-        else:
-            # Если задача еще не завершена, продолжаем проверять
-            continue
+@jobs.handler("speechmatics_result")
+async def check_job_status(payload: dict):
+    job_id, user_id = payload["job_id"], payload["user_id"]
+
+    # Получаем статус задачи
+    transcript = await get_transcript(job_id, config.SPEECHMATICS_API)
+    if not transcript:
+        if time.time() > payload["deadline"]:
+            await bot.send_message(user_id, "⚠️ Не удалось дождаться результатов транскрипции.", disable_notification=True)
+            return
+        # Если задача еще не завершена, проверим позже
+        raise RetryLater(config.SPEECHMATICS_POLL_INTERVAL)
+
+    # Создаем файл в папке temp
+    try:
+        temp_file_path = os.path.join('temp', f"{job_id}.txt")
+        with open(temp_file_path, 'w', encoding='utf-8') as temp_file:
+            temp_file.write(transcript)  # Записываем текст в файл
+
+        # Отправляем файл пользователю с использованием FSInputFile
+        audio_file = FSInputFile(temp_file_path)
+        sent_message = await bot.send_document(user_id, audio_file, disable_notification=True)
+        await bot.delete_message(chat_id=user_id, message_id=sent_message.message_id - 1)  # Удаляем предыдущее сообщение со статусом
+    except Exception as e:
+        await bot.send_message(user_id, f"⚠️ Ошибка при создании файла: {str(e)}", disable_notification=True)
 
 # Обработчик существующих задач
 async def handle_existing_jobs(user_id, file_path):
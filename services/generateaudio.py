@@ -1,6 +1,8 @@
 # services/generateaudio.py
 
+import re
 import aiohttp
+import asyncio
 import config
 import logging
 import urllib.parse
@@ -9,6 +11,7 @@ from aiogram import F, Router
 from aiogram.enums import ParseMode, ChatAction
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputFile, BufferedInputFile, FSInputFile, BotCommand, BotCommandScopeChat, TelegramObject
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
 from datetime import datetime
 from services.retry import generate_audio_with_retry
 from utils.helpers import get_user_settings, save_users
@@ -19,14 +22,20 @@ from database import (
                         user_analysis_states, user_analysis_settings,
                         user_transcribe_states )
 from utils.helpers import get_user_settings, translate_to_english
+from utils.tts_cache import tts_cache
+from utils.scheduler import scheduler, QueueNotice, QueueFull
+from utils.inflight import inflight
+from utils.jobqueue import jobs
 from services.tgapi import bot
+from utils.dispatch import StateRouter
+from utils.history_stats import append_history
 
-router = Router()
+router = StateRouter()
 
 ###########################################################
 ####### Обработчик генерации аудиофайла Polinations #######
 # Блок генерации аудио из текста
-@router.message(Command("generateaudio"))
+@router.command("generateaudio")
 async def cmd_generate_audio(message: Message):
     user_id = message.from_user.id
     reply = message.reply_to_message
@@ -49,7 +58,8 @@ def voice_selection_keyboard():
         [InlineKeyboardButton(text="↩️ Отмена", callback_data="voice_cancel")]
     ])
 
-@router.callback_query(lambda query: query.data.startswith("voice_"))
+@router.callback(prefix="voice_")
+@inflight.tracked("tts")
 async def handle_voice_selection(callback: CallbackQuery):
     user_id = callback.from_user.id
     state = user_states.get(user_id)
@@ -68,72 +78,207 @@ async def handle_voice_selection(callback: CallbackQuery):
     text = state.get("text", "")
     
     # Проверяем длину текста
-    if len(text) > 4096:
-        # Используем POST-метод для длинных текстов
-        await generate_audio_post(user_id, text, voice, callback)
+    if len(text) > config.TTS_CHUNK_SIZE:
+        # Длинные тексты синтезируем по частям параллельно в фоновой задаче
+        await enqueue_audio_long(user_id, text, voice, callback)
     else:
         # Используем GET-метод для коротких текстов
         await generate_audio_get(user_id, text, voice, callback)
 
+async def synthesize_speech_get(text, voice, model=None):
+    """Синтез речи GET-запросом, возвращает байты MP3"""
+    encoded_text = urllib.parse.quote(text)
+    payload = {
+        "url": f"https://text.pollinations.ai/{encoded_text}?model={model or config.TTS_MODEL}&voice={voice}"
+    }
+    return await generate_audio_with_retry(payload, method="GET")
+
+async def synthesize_speech_post(text, voice, model=None):
+    """Синтез речи POST-запросом, возвращает байты MP3"""
+    payload = {
+        "model": model or config.TTS_MODEL,
+        "messages": [{"role": "user", "content": text}],
+        "voice": voice
+    }
+    result = await generate_audio_with_retry(payload, method="POST")
+    audio_data_base64 = result['choices'][0]['message']['audio']['data']
+    return base64.b64decode(audio_data_base64)
+
+async def synthesize_speech(text, voice, model=None):
+    """Синтез речи с дисковым кешем, метод выбирается по длине текста"""
+    key = tts_cache.make_key(text, voice, model)
+    audio_data = await tts_cache.get(key)
+    if audio_data is not None:
+        return audio_data
+    if len(urllib.parse.quote(text)) > config.TTS_MAX_GET_URL_LENGTH:
+        audio_data = await synthesize_speech_post(text, voice, model)
+    else:
+        audio_data = await synthesize_speech_get(text, voice, model)
+    await tts_cache.put(key, audio_data)
+    return audio_data
+
+async def answer_cached_audio(chat_id: int, key: str, caption: str):
+    """Повторная отправка озвучки по file_id без синтеза и загрузки"""
+    file_id = tts_cache.get_file_id(key)
+    if not file_id:
+        return None
+    try:
+        return await bot.send_audio(chat_id, file_id, caption=caption)
+    except TelegramBadRequest as e:
+        logging.warning(f"file_id озвучки больше не действителен: {str(e)}")
+        tts_cache.set_file_id(key, None)
+        return None
+
+async def answer_audio_and_remember(chat_id: int, key: str, audio_data: bytes, caption: str):
+    """Отправляет аудио и сохраняет file_id для повторного использования"""
+    input_file = BufferedInputFile(audio_data, filename='generated_audio.mp3')
+    sent = await bot.send_audio(chat_id, input_file, caption=caption)
+    if sent.audio:
+        tts_cache.set_file_id(key, sent.audio.file_id)
+    return sent
+
 async def generate_audio_get(user_id, text, voice, callback):
     try:
-        encoded_text = urllib.parse.quote(text)
-        payload = {
-            "url": f"https://text.pollinations.ai/ {encoded_text}?model={config.TTS_MODEL}&voice={voice}"
-        }
-        
-        audio_data = await generate_audio_with_retry(payload, method="GET")
+        key = tts_cache.make_key(text, voice)
+        caption = f"🎙️ Аудио сгенерировано с голосом: {voice}"
+        if not await answer_cached_audio(callback.message.chat.id, key, caption):
+            async with scheduler.slot("tts", user_id, QueueNotice(callback.message)):
+                audio_data = await synthesize_speech(text, voice)
+            # Создаем и отправляем аудиофайл
+            await answer_audio_and_remember(callback.message.chat.id, key, audio_data, caption)
         
         # Сохраняем в историю
         save_audio_history(user_id, text, voice, "GET")
-        
-        # Создаем и отправляем аудиофайл
-        input_file = BufferedInputFile(audio_data, filename='generated_audio.mp3')
-        await callback.message.answer_audio(input_file, caption=f"🎙️ Аудио сгенерировано с голосом: {voice}")
         await callback.message.delete()
     
+    except QueueFull as e:
+        await callback.message.answer(f"⏳ {str(e)}")
     except Exception as e:
         logging.error(f"Ошибка генерации через GET: {str(e)}")
         await callback.message.answer(f"⚠️ Ошибка: {str(e)}")
 
-async def generate_audio_post(user_id, text, voice, callback):
+async def enqueue_audio_long(user_id, text, voice, callback):
+    """Длинный текст озвучивается фоновой задачей: результат придёт и после перезапуска бота"""
+    await jobs.enqueue_async(
+        "tts_long",
+        {"user_id": user_id, "chat_id": callback.message.chat.id, "text": text, "voice": voice},
+        idempotency_key=f"tts_long:{callback.id}",
+        route_key=user_id
+    )
+    await callback.message.edit_text("🎙️ Текст поставлен в очередь озвучки, аудио придёт в этот чат.")
+
+async def notify_audio_long_failed(payload: dict, error: str):
+    await bot.send_message(payload["chat_id"], f"⚠️ Не удалось озвучить текст: {error}")
+
+@jobs.handler("tts_long", on_dead=notify_audio_long_failed)
+async def generate_audio_long(payload: dict):
+    """Параллельный синтез длинного текста по частям со склейкой результата.
+    Готовые части лежат в кеше, поэтому повтор задачи синтезирует только недостающие"""
+    user_id, chat_id = payload["user_id"], payload["chat_id"]
+    text, voice = payload["text"], payload["voice"]
+    key = tts_cache.make_key(text, voice)
+    caption = f"🎙️ Аудио сгенерировано с голосом: {voice}"
     try:
-        payload = {
-            "model": config.TTS_MODEL,
-            "messages": [{"role": "user", "content": text}],
-            "voice": voice
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post("https://text.pollinations.ai/openai ", json=payload, timeout=300) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logging.error(f"Ошибка генерации аудио: {response.status} - {error_text}")
-                    await callback.message.answer("⚠️ Не удалось сгенерировать аудио")
-                    return
-                
-                result = await response.json()
-        
-        # Извлекаем base64-аудио
-        try:
-            audio_data_base64 = result['choices'][0]['message']['audio']['data']
-            audio_binary = base64.b64decode(audio_data_base64)
-        except (KeyError, IndexError, base64.binascii.Error) as e:
-            logging.error(f"Ошибка обработки ответа: {str(e)}")
-            await callback.message.answer("❌ Ошибка: не удалось получить аудио из ответа")
+        if await answer_cached_audio(chat_id, key, caption):
+            save_audio_history(user_id, text, voice, "CHUNKED")
             return
-        
-        # Сохраняем в историю
-        save_audio_history(user_id, text, voice, "POST")
-        
-        # Создаем и отправляем аудиофайл
-        input_file = BufferedInputFile(audio_binary, filename='generated_audio.mp3')
-        await callback.message.answer_audio(input_file, caption=f"🎙️ Аудио сгенерировано с голосом: {voice}")
-        await callback.message.delete()
-    
     except Exception as e:
-        logging.error(f"Ошибка генерации через POST: {str(e)}")
-        await callback.message.answer(f"⚠️ Ошибка: {str(e)}")
+        logging.error(f"Ошибка отправки аудио из кеша: {str(e)}")
+
+    chunks = split_text_into_chunks(text, config.TTS_CHUNK_SIZE)
+    semaphore = asyncio.Semaphore(config.TTS_MAX_PARALLEL)
+
+    async def synthesize_chunk(chunk):
+        async with semaphore:
+            # Части одного текста не ограничиваем лимитом очереди пользователя
+            async with scheduler.slot("tts", user_id, bounded=False):
+                return await synthesize_speech(chunk, voice)
+
+    tasks = [asyncio.create_task(synthesize_chunk(chunk)) for chunk in chunks]
+    progress_msg = await bot.send_message(chat_id, f"🔄 Озвучиваю текст: 0/{len(chunks)}")
+    parts = []
+    try:
+        # Ждём части строго по порядку, остальные синтезируются параллельно
+        for i, task in enumerate(tasks):
+            parts.append(await task)
+            await progress_msg.edit_text(f"🔄 Озвучиваю текст: {i + 1}/{len(chunks)}")
+            if i == 0 and len(chunks) > 1:
+                # Первую часть отправляем сразу, чтобы можно было начать слушать
+                await bot.send_audio(
+                    chat_id,
+                    BufferedInputFile(parts[0], filename='generated_audio_part1.mp3'),
+                    caption=f"▶️ Начало (часть 1/{len(chunks)}), полная версия готовится..."
+                )
+
+        # MP3 склеивается на уровне фреймов без перекодирования
+        # Сама склейка на диск не кешируется: части уже лежат в кеше, а file_id запоминаем
+        audio_binary = join_mp3_parts(parts)
+        save_audio_history(user_id, text, voice, "CHUNKED")
+
+        await answer_audio_and_remember(chat_id, key, audio_binary, caption)
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        try:
+            await progress_msg.delete()
+        except Exception:
+            pass
+
+# Битрейты Layer III (кбит/с) для MPEG-1 и MPEG-2/2.5
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Частоты дискретизации по битам версии: 3 - MPEG-1, 2 - MPEG-2, 0 - MPEG-2.5
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def id3v2_size(data: bytes) -> int:
+    """Длина ID3v2-заголовка в начале MP3 (0, если его нет)"""
+    if len(data) > 10 and data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+def mp3_frame_length(data: bytes):
+    """Длина кадра MPEG Layer III по его заголовку; None, если это не заголовок кадра"""
+    if len(data) < 4 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (data[1] >> 3) & 3, (data[1] >> 1) & 3
+    bitrate_index, rate_index = data[2] >> 4, (data[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (data[2] >> 1) & 1
+    return (144 if version == 3 else 72) * bitrate // sample_rate + padding
+
+def strip_info_frame(data: bytes) -> bytes:
+    """Удаляет первый кадр, если это служебный кадр Xing/Info/VBRI: в нём
+    число кадров и длительность одной части, а не всего файла"""
+    length = mp3_frame_length(data)
+    if length is None:
+        return data
+    mono = (data[3] >> 6) == 3
+    side_info = (17 if mono else 32) if (data[1] >> 3) & 3 == 3 else (9 if mono else 17)
+    if data[4 + side_info:8 + side_info] in (b"Xing", b"Info") or data[36:40] == b"VBRI":
+        return data[length:]
+    return data
+
+def strip_mp3_tags(data: bytes) -> bytes:
+    """Оставляет только аудиокадры: без ID3v2, кадра Xing/Info и ID3v1 в конце"""
+    data = data[id3v2_size(data):]
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    return strip_info_frame(data)
+
+def join_mp3_parts(parts):
+    """Склейка MP3-частей в один поток: ID3v2 оставляем только у первой части,
+    служебные кадры Xing/Info и ID3v1 убираем у всех частей"""
+    if not parts:
+        return b""
+    return parts[0][:id3v2_size(parts[0])] + b"".join(strip_mp3_tags(part) for part in parts)
 
 def save_audio_history(user_id, text, voice, method):
     """Сохранение генерации аудио в историю"""
@@ -144,23 +289,31 @@ def save_audio_history(user_id, text, voice, method):
         "method": method,
         "timestamp": datetime.now().isoformat()
     }
-    user_history.setdefault(user_id, []).append(entry)
+    append_history(user_id, entry)
     save_users()
 
 def split_text_into_chunks(text, max_length=4096):
-    """Разделение текста на части для генерации аудио"""
-    words = text.split()
+    """Разделение текста на части по границам предложений для генерации аудио"""
+    sentences = [sentence for sentence in re.split(r'(?<=[.!?…])\s+', text.strip()) if sentence]
     chunks = []
     current_chunk = ""
     
-    for word in words:
-        if len(current_chunk) + len(word) + 1 <= max_length:
-            current_chunk += " " + word
+    for sentence in sentences:
+        if len(sentence) > max_length:
+            # Слишком длинное предложение режем по словам
+            for word in sentence.split():
+                if len(current_chunk) + len(word) + 1 <= max_length:
+                    current_chunk = f"{current_chunk} {word}".strip()
+                else:
+                    chunks.append(current_chunk)
+                    current_chunk = word
+        elif len(current_chunk) + len(sentence) + 1 <= max_length:
+            current_chunk = f"{current_chunk} {sentence}".strip()
         else:
-            chunks.append(current_chunk.strip())
-            current_chunk = word
+            chunks.append(current_chunk)
+            current_chunk = sentence
     
     if current_chunk:
-        chunks.append(current_chunk.strip())
+        chunks.append(current_chunk)
     
-    return chunks
\ No newline at end of file
+    return [chunk for chunk in chunks if chunk]
@@ -20,8 +20,13 @@ from database import (
                         user_transcribe_states )
 from utils.helpers import get_user_settings, translate_to_english
 from services.tgapi import bot
+from utils.scheduler import scheduler, QueueNotice, QueueFull
+from utils.inflight import inflight
+from utils.singleflight import image_flight
+from utils.dispatch import StateRouter, TEXT, IMAGE_DESCRIPTION
+from utils.history_stats import append_history
 
-router = Router()
+router = StateRouter()
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +35,7 @@ logger = logging.getLogger(__name__)
 ########### Выбора провайдера и настроек ###########
 
 # Обработчик команды /imagesettings
-@router.message(Command("imagesettings"))
+@router.command("imagesettings")
 async def cmd_imagesettings(message: Message):
     user_id = message.from_user.id
     settings = get_user_settings(user_id)
@@ -63,7 +68,7 @@ def get_user_settings(user_id):
     return user_settings[user_id]
 
 # Обработчик выбора настроек
-@router.callback_query(lambda query: query.data.startswith("setting_"))
+@router.callback(prefix="setting_")
 async def handle_settings_selection(query: CallbackQuery):
     user_id = query.from_user.id
     settings = get_user_settings(user_id)
@@ -108,7 +113,7 @@ async def handle_settings_selection(query: CallbackQuery):
         await query.answer()
 
 # Новый обработчик для выбора модели
-@router.callback_query(lambda query: query.data.startswith("model_"))
+@router.callback(prefix="model_")
 async def handle_model_selection(query: CallbackQuery):
     user_id = query.from_user.id
     settings = get_user_settings(user_id)
@@ -131,10 +136,50 @@ def get_user_settings(user_id):
 class ImageState(StatesGroup):
     description = State()
 
+class ImageFetchError(Exception):
+    """Сервис генерации вернул ошибку"""
+
+async def download_image(image_url: str) -> bytes:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(image_url, timeout=300) as response:
+            if response.status == 200:
+                return await response.read()
+            raise ImageFetchError(f"{response.status} - {await response.text()}")
+
+def build_image_url(prompt: str, params: dict) -> str:
+    return f"https://image.pollinations.ai/prompt/{urllib.parse.quote(prompt)}?{urllib.parse.urlencode(params)}"
+
+async def fetch_image(image_url: str, user_id: int, notice: QueueNotice = None) -> bytes:
+    """Загрузка изображения по готовому URL через очередь; одинаковые одновременные запросы объединяются.
+    Слот занимает каждый вызывающий сам: отказ и позиция в очереди - свои у каждого"""
+    async with scheduler.slot("image", user_id, notice):
+        return await image_flight.do(image_url, lambda: download_image(image_url))
+
+async def generate_seeded_image(prompt: str, model: str, width: int, height: int,
+                                user_id: int, notice: QueueNotice = None) -> tuple:
+    """Генерация со случайным seed, возвращает (байты, seed).
+    Одновременные запросы с тем же промптом, моделью и размером объединяются:
+    seed выбирается внутри общего запроса, и все получают одно изображение с его seed"""
+    async def download():
+        seed = random.randint(10, 99999999)
+        image_url = build_image_url(prompt, {
+            "width": width,
+            "height": height,
+            "seed": seed,
+            "model": model,
+            "nologo": "true"
+        })
+        logging.info(f"Генерация изображения: {image_url}")
+        return await download_image(image_url), seed
+
+    async with scheduler.slot("image", user_id, notice):
+        return await image_flight.do((prompt, model, width, height), download)
+
 ##################################################
 ########### Блок генерации изображений ###########
 # Обработчик текстовых сообщений для генерации изображения
-@router.message(lambda message: message.text and user_states.get(message.from_user.id) == "waiting_for_image_description")
+@router.message(TEXT, state=IMAGE_DESCRIPTION)
+@inflight.tracked("image")
 async def handle_image_description(message: Message):
     user_id = message.from_user.id
     settings = get_user_settings(user_id)
@@ -145,7 +190,7 @@ async def handle_image_description(message: Message):
         return
 
     # Добавляем запрос в историю с оригинальным промптом
-    user_history[user_id].append({
+    append_history(user_id, {
         "type": "image",
         "prompt": prompt,
         "model": settings["model"],
@@ -162,35 +207,20 @@ async def handle_image_description(message: Message):
         # Получаем параметры генерации
         width = settings["width"]
         height = settings["height"]
-        seed = random.randint(10, 99999999)
         model = settings["model"]
 
         # Переводим промпт на английский
         translated_prompt = await translate_to_english(prompt)
         logging.info(f"Перевод выполнен: {prompt} -> {translated_prompt}")
 
-        # Формируем URL с переведенным промптом
-        encoded_prompt = urllib.parse.quote(translated_prompt)  # ❌ Было: prompt
-        params = {
-            "width": width,
-            "height": height,
-            "seed": seed,
-            "model": model,
-            "nologo": "true"
-        }
-        image_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?{urllib.parse.urlencode(params)}"
-        
-        logging.info(f"Генерация изображения: {image_url}")
-
-        # Загружаем изображение
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_url, timeout=300) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                else:
-                    logging.error(f"Ошибка загрузки изображения: {response.status} - {await response.text()}")
-                    await message.answer("⚠️ Ошибка: не удалось получить изображение.")
-                    return
+        # Загружаем изображение по переведенному промпту
+        try:
+            image_data, seed = await generate_seeded_image(
+                translated_prompt, model, width, height, user_id, QueueNotice(message))
+        except ImageFetchError as e:
+            logging.error(f"Ошибка загрузки изображения: {str(e)}")
+            await message.answer("⚠️ Ошибка: не удалось получить изображение.")
+            return
         
         # Создаем объект BufferedInputFile из данных изображения
         input_file = BufferedInputFile(image_data, filename='image.jpg')
@@ -220,6 +250,9 @@ async def handle_image_description(message: Message):
         user_states[user_id] = None
         image_requests[user_id] = []  # Очищаем историю запросов на изображение
 
+    except QueueFull as e:
+        user_states[user_id] = None
+        await message.answer(f"⏳ {str(e)}")
     except Exception as e:
         logging.error(f"Ошибка генерации изображения: {str(e)}")
         user_states[user_id] = None  # Сбрасываем состояние при ошибке
@@ -227,7 +260,8 @@ async def handle_image_description(message: Message):
 
 
 # Обработчик для перегенерации изображения
-@router.callback_query(lambda query: query.data.startswith("regenerate:"))
+@router.callback(prefix="regenerate:")
+@inflight.tracked("regenerate")
 async def handle_regenerate(callback: CallbackQuery):
     user_id = int(callback.data.split(":")[1])
     
@@ -243,31 +277,19 @@ async def handle_regenerate(callback: CallbackQuery):
     width = request_data["width"]
     height = request_data["height"]
 
-    # Генерируем новое значение seed
-    new_seed = random.randint(10, 99999999)
-
-    # Формируем новый URL с переведенным промптом
-    encoded_prompt = urllib.parse.quote(translated_prompt)  # ❌ Было: original_prompt
-    params = {
-        "width": width,
-        "height": height,
-        "seed": new_seed,
-        "model": model,
-        "nologo": "true"
-    }
-    image_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?{urllib.parse.urlencode(params)}"
-    
-    logging.info(f"Перегенерация изображения: {image_url}")
+    logging.info(f"Перегенерация изображения для {user_id}: {translated_prompt}")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_url, timeout=300) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                else:
-                    logging.error(f"Ошибка загрузки изображения: {response.status} - {await response.text()}")
-                    await callback.answer("⚠️ Ошибка: не удалось получить изображение.", show_alert=True)
-                    return
+        # Отвечаем на callback сразу: в очереди ожидание может быть дольше его таймаута
+        await callback.answer("🔄 Генерирую...")
+        try:
+            # Новое значение seed выбирается при генерации
+            image_data, new_seed = await generate_seeded_image(
+                translated_prompt, model, width, height, user_id, QueueNotice(callback.message))
+        except ImageFetchError as e:
+            logging.error(f"Ошибка загрузки изображения: {str(e)}")
+            await callback.message.answer("⚠️ Ошибка: не удалось получить изображение.")
+            return
         
         # Создаем объект BufferedInputFile из данных изображения
         input_file = BufferedInputFile(image_data, filename='image.jpg')
@@ -287,17 +309,17 @@ async def handle_regenerate(callback: CallbackQuery):
             ])
         )
         
-        await callback.answer("✅ Изображение обновлено!")
-
         # Обновляем last_image_requests с новым переведенным промптом
         last_image_requests[user_id]["translated_prompt"] = await translate_to_english(original_prompt)
         
+    except QueueFull as e:
+        await callback.message.answer(f"⏳ {str(e)}")
     except Exception as e:
         logging.error(f"Ошибка при перегенерации: {str(e)}")
-        await callback.answer("⚠️ Ошибка при перегенерации", show_alert=True)
+        await callback.message.answer("⚠️ Ошибка при перегенерации")
 
 # Обработчик для кнопки "Готово"
-@router.callback_query(lambda query: query.data.startswith("accept:"))
+@router.callback(prefix="accept:")
 async def handle_accept(callback: CallbackQuery):
     user_id = int(callback.data.split(":")[1])
     
@@ -319,14 +341,11 @@ async def generate_image(prompt: str, user_id: int) -> bytes:
         "width": settings["width"],
         "height": settings["height"]
     }
-    encoded_prompt = urllib.parse.quote(prompt)
-    image_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?{urllib.parse.urlencode(params)}"
+    image_url = build_image_url(prompt, params)
     
-    async with aiohttp.ClientSession() as session:
-        async with session.get(image_url, timeout=300) as response:
-            if response.status == 200:
-                return await response.read()
-            else:
-                error_text = await response.text()
-                logger.error(f"Ошибка генерации изображения: {response.status} - {error_text}")
-                return None
\ No newline at end of file
+    try:
+        # Без seed URL одинаков для одинаковых запросов, объединение по нему работает
+        return await fetch_image(image_url, user_id)
+    except ImageFetchError as e:
+        logger.error(f"Ошибка генерации изображения: {str(e)}")
+        return None
\ No newline at end of file
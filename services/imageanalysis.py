@@ -26,9 +26,39 @@ from database import (  save_users, load_users, save_blocked_users,
                         user_analysis_states, user_analysis_settings,
                         user_transcribe_states, temp_file_store )
 from utils.helpers import get_user_settings, translate_to_english
+from utils.image_cache import analysis_cache, lookup_cached_analysis
+from utils.scheduler import scheduler, QueueNotice, QueueFull
+from utils.inflight import inflight
+from utils.singleflight import analysis_flight
+from utils.dispatch import StateRouter, IMAGE, IMAGE_ANALYSIS
+from utils.history_stats import append_history
 
-router = Router()
+router = StateRouter()
 TEMP_DIR = "temp"
+ANALYSIS_API_URL = "https://text.pollinations.ai/openai"
+# Запросы к модели: краткое описание и подробный анализ (входят в ключ кеша)
+DESCRIBE_PROMPT = "Опишите, что изображено на этой картинке на русском языке."
+DETAILED_PROMPT = "Вы — опытный аналитик изображений, опишите содержимое картинки подробно на русском языке."
+
+class AnalysisError(Exception):
+    """Сервис анализа вернул ошибку"""
+
+async def request_analysis(payload: dict, image_bytes: bytes, user_id: int, notice: QueueNotice = None) -> str:
+    """Запрос к модели анализа через очередь; одинаковые одновременные запросы объединяются.
+    Слот занимает каждый вызывающий сам: отказ и позиция в очереди - свои у каждого"""
+    prompt = payload["messages"][0]["content"][0]["text"]
+    key = (hashlib.sha256(image_bytes).hexdigest(), prompt, payload.get("max_tokens"))
+
+    async def call():
+        async with aiohttp.ClientSession() as session:
+            async with session.post(ANALYSIS_API_URL, json=payload, timeout=300) as response:
+                if response.status != 200:
+                    raise AnalysisError(f"{response.status} - {await response.text()}")
+                result = await response.json()
+        return remove_html_tags(result['choices'][0]['message']['content'])
+
+    async with scheduler.slot("analyze", user_id, notice):
+        return await analysis_flight.do(key, call)
 
 ##################################################
 ######### Блок доп настроек изображения ##########
@@ -40,14 +70,14 @@ def get_user_analysis_settings(user_id):
     return user_analysis_settings[user_id]
 
 # Обработчик команды /analyze
-@router.message(Command("analyze"))
+@router.command("analyze")
 async def cmd_analyze(message: Message):
     user_id = message.from_user.id
     await message.answer("🖼 Пожалуйста, отправьте изображение для анализа.")
     user_analysis_states[user_id] = "waiting_for_image_analysis"
 
 # Обработчик команды /analysissettings
-@router.message(Command("analysissettings"))
+@router.command("analysissettings")
 async def cmd_analysis_settings(message: Message):
     user_id = message.from_user.id
     settings = get_user_analysis_settings(user_id)
@@ -62,7 +92,7 @@ async def cmd_analysis_settings(message: Message):
     await message.answer("🔍 Настройки анализа изображений:", reply_markup=keyboard)
 
 # Обработчик выбора качества анализа
-@router.callback_query(lambda query: query.data.startswith("quality_"))
+@router.callback(prefix="quality_")
 async def handle_analysis_quality(callback: CallbackQuery):
     user_id = callback.from_user.id
     quality = callback.data.split("_")[1]
@@ -78,7 +108,7 @@ async def handle_analysis_quality(callback: CallbackQuery):
 ######### Блок анализа изображения ##########
 
 # Обработчик для изображений и других медиафайлов
-@router.message(F.photo | (F.document & F.document.mime_type.startswith('image/')))
+@router.message(IMAGE)
 async def handle_unsolicited_image(message: Message):
     try:
         if message.from_user is None:
@@ -137,9 +167,25 @@ async def analyze_image(message: Message, file_id: str):
         if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
             raise ValueError("Не удалось сохранить изображение локально")
         
-        # Кодируем в base64
         with open(temp_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
+            image_bytes = image_file.read()
+
+        # Проверяем кеш по перцептивному хешу
+        phash, analysis = await lookup_cached_analysis(image_bytes, "high", DESCRIBE_PROMPT)
+        if analysis:
+            logging.info(f"Анализ изображения от {user_id} взят из кеша")
+            append_history(user_id, {
+                "type": "analysis",
+                "response": analysis,
+                "cached": True,
+                "timestamp": datetime.now().isoformat()
+            })
+            save_users()
+            await message.answer(f"🔍 Результат анализа изображения:\n\n{analysis}")
+            return
+
+        # Кодируем в base64
+        encoded_string = base64.b64encode(image_bytes).decode('utf-8')
         
         # Определяем формат изображения
         image_format = "jpeg"  # Можно улучшить через PIL
@@ -147,24 +193,21 @@ async def analyze_image(message: Message, file_id: str):
             "model": config.IMAGE_ANALYSIS_MODEL,
             "messages": [
                 {"role": "user", "content": [
-                    {"type": "text", "text": "Опишите, что изображено на этой картинке на русском языке."},
+                    {"type": "text", "text": DESCRIBE_PROMPT},
                     {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_string}"}}
                 ]}],
             "max_tokens": config.ANALYSIS_QUALITY_SETTINGS.get("high", 300)
         }
         await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
         # Отправляем запрос
-        async with aiohttp.ClientSession() as session:
-            async with session.post("https://text.pollinations.ai/openai ", json=payload) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logging.error(f"Ошибка анализа: {response.status} - {error_text}")
-                    await message.answer("⚠️ Ошибка: не удалось проанализировать изображение")
-                    return
-                
-                result = await response.json()
-                analysis = result['choices'][0]['message']['content']
-                analysis = remove_html_tags(analysis)
+        try:
+            analysis = await request_analysis(payload, image_bytes, user_id, QueueNotice(message))
+        except AnalysisError as e:
+            logging.error(f"Ошибка анализа: {str(e)}")
+            await message.answer("⚠️ Ошибка: не удалось проанализировать изображение")
+            return
+        if phash is not None:
+            analysis_cache.put(phash, "high", DESCRIBE_PROMPT, analysis)
         
         # Сохраняем результат
         user_entry = {
@@ -172,12 +215,14 @@ async def analyze_image(message: Message, file_id: str):
             "response": analysis,
             "timestamp": datetime.now().isoformat()
         }
-        user_history.setdefault(user_id, []).append(user_entry)
+        append_history(user_id, user_entry)
         save_users()
         await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
         # Отправляем результат
         await message.answer(f"🔍 Результат анализа изображения:\n\n{analysis}")
         
+    except QueueFull as e:
+        await message.answer(f"⏳ {str(e)}")
     except Exception as e:
         logging.error(f"Ошибка при анализе изображения: {str(e)}")
         await message.answer(f"⚠️ Ошибка при анализе: {str(e)}")
@@ -195,7 +240,8 @@ async def analyze_and_respond(message: Message, file_id: str):
         logging.error(f"Ошибка при анализе изображения: {str(e)}")
         await message.answer("⚠️ Ошибка при анализе изображения.")
 
-@router.callback_query(lambda query: query.data.startswith("analyze_now_"))
+@router.callback(prefix="analyze_now_")
+@inflight.tracked("analyze")
 async def handle_analyze_now(callback: CallbackQuery):
     try:
         await callback.answer()
@@ -218,7 +264,8 @@ async def handle_analyze_now(callback: CallbackQuery):
         await callback.message.answer("⚠️ Ошибка при анализе изображения.")
 
 # Обработчик изображений для анализа
-@router.message(lambda message: message.photo or (message.document and message.document.mime_type.startswith('image/')))
+@router.message(IMAGE, state=IMAGE_ANALYSIS)
+@inflight.tracked("analyze")
 async def handle_image_analysis(message: Message):
     user_id = message.from_user.id
     
@@ -240,17 +287,32 @@ async def handle_image_analysis(message: Message):
             await message.answer("❌ Размер изображения превышает 512 MB")
             return
         
+        # Получаем настройки пользователя
+        analysis_settings = get_user_analysis_settings(user_id)
+        quality = analysis_settings["quality"]
+        max_tokens = config.ANALYSIS_QUALITY_SETTINGS[quality]
+        
+        # Проверяем кеш по перцептивному хешу
+        phash, analysis = await lookup_cached_analysis(image_data.getvalue(), quality, DETAILED_PROMPT)
+        if analysis:
+            logging.info(f"Анализ изображения от {user_id} взят из кеша")
+            append_history(user_id, {
+                "type": "analysis",
+                "response": analysis,
+                "quality": quality,
+                "cached": True,
+                "timestamp": datetime.now().isoformat()
+            })
+            save_users()
+            await message.answer(f"🔍 Результат анализа изображения:\n\n{analysis}")
+            return
+        
         # Преобразуем изображение в base64
         image = Image.open(BytesIO(image_data.getvalue()))
         image_format = image.format.lower() or "jpeg"
         image_data.seek(0)
         base64_image = base64.b64encode(image_data.read()).decode('utf-8')
         
-        # Получаем настройки пользователя
-        analysis_settings = get_user_analysis_settings(user_id)
-        quality = analysis_settings["quality"]
-        max_tokens = config.ANALYSIS_QUALITY_SETTINGS[quality]
-        
         # Формируем запрос к API
         payload = {
             "model": config.IMAGE_ANALYSIS_MODEL,
@@ -258,7 +320,7 @@ async def handle_image_analysis(message: Message):
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": "Вы — опытный аналитик изображений, опишите содержимое картинки подробно на русском языке."},
+                        {"type": "text", "text": DETAILED_PROMPT},
                         {
                             "type": "image_url",
                             "image_url": {
@@ -274,38 +336,37 @@ async def handle_image_analysis(message: Message):
         logging.info(f"Анализ изображения от {user_id}")
         
         # Отправляем запрос
-        async with aiohttp.ClientSession() as session:
-            async with session.post("https://text.pollinations.ai/openai", json=payload, timeout=300) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logging.error(f"Ошибка анализа: {response.status} - {error_text}")
-                    await message.answer("⚠️ Ошибка: не удалось проанализировать изображение")
-                    return
-                
-                result = await response.json()
-                analysis = result['choices'][0]['message']['content']
-                analysis = remove_html_tags(analysis)  # Очищаем ответ от HTML-тегов
-                
-                # Сохраняем в историю
-                user_entry = {
-                    "type": "analysis",
-                    "prompt": "Опишите, что изображено на этой картинке",
-                    "timestamp": datetime.now().isoformat()
-                }
-                user_history.setdefault(user_id, []).append(user_entry)
-                
-                assistant_entry = {
-                    "type": "analysis",
-                    "response": analysis,
-                    "quality": quality,
-                    "timestamp": datetime.now().isoformat()
-                }
-                user_history[user_id].append(assistant_entry)
-                save_users()
-                
-                # Отправляем результат
-                await message.answer(f"🔍 Результат анализа изображения:\n\n{analysis}")
-                
+        try:
+            analysis = await request_analysis(payload, image_data.getvalue(), user_id, QueueNotice(message))
+        except AnalysisError as e:
+            logging.error(f"Ошибка анализа: {str(e)}")
+            await message.answer("⚠️ Ошибка: не удалось проанализировать изображение")
+            return
+        if phash is not None:
+            analysis_cache.put(phash, quality, DETAILED_PROMPT, analysis)
+        
+        # Сохраняем в историю
+        user_entry = {
+            "type": "analysis",
+            "prompt": "Опишите, что изображено на этой картинке",
+            "timestamp": datetime.now().isoformat()
+        }
+        append_history(user_id, user_entry)
+        
+        assistant_entry = {
+            "type": "analysis",
+            "response": analysis,
+            "quality": quality,
+            "timestamp": datetime.now().isoformat()
+        }
+        append_history(user_id, assistant_entry)
+        save_users()
+        
+        # Отправляем результат
+        await message.answer(f"🔍 Результат анализа изображения:\n\n{analysis}")
+        
+    except QueueFull as e:
+        await message.answer(f"⏳ {str(e)}")
     except Exception as e:
         logging.error(f"Ошибка анализа изображения: {str(e)}")
         await message.answer(f"⚠️ Ошибка при анализе изображения: {str(e)}")
@@ -315,13 +376,13 @@ async def handle_image_analysis(message: Message):
         user_analysis_states[user_id] = None
 
 # Обработчик нажатия на кнопку "Сгенерировать"
-@router.callback_query(lambda query: query.data == "suggest_generate")
+@router.callback("suggest_generate")
 async def handle_suggest_generate(callback: CallbackQuery):
     await callback.message.edit_text("Хорошо, вы можете сгенерировать новое изображение. Для этого используйте команду `/image`.")
     await callback.answer()
 
 # Обработчик нажатия на кнопку "Отмена"
-@router.callback_query(lambda query: query.data == "censel_button")
+@router.callback("censel_button")
 async def handle_censel_button(callback: CallbackQuery):
     await callback.message.edit_text("При необходимости вы можете проанализировать изображение. Для этого используйте команду `/analyse`.")
     await callback.answer()
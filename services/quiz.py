@@ -1,7 +1,11 @@
 import re
+import time
+import asyncio
+import inspect
 import g4f
 import logging
 import config
+from g4f.client import AsyncClient
 from aiogram import F, Router
 from aiogram.enums import ParseMode, ChatAction
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, InputFile, BufferedInputFile, FSInputFile, BotCommand, BotCommandScopeChat, TelegramObject
@@ -15,18 +19,37 @@ from langdetect import detect
 from utils.helpers import auto_detect_language, get_user_settings, save_users
 from database import (  save_users, load_users, save_blocked_users,
                         user_history, user_settings, user_info,
-                        image_requests, last_image_requests, used_questions,
+                        image_requests, last_image_requests,
                         user_states, admin_states, blocked_users,
                         user_analysis_states, user_analysis_settings,
-                        user_transcribe_states, user_quiz_data, group_quiz_data )
+                        user_transcribe_states, user_quiz_data,
+                        shared_settings )
 from utils.helpers import get_user_settings, translate_to_english
+from utils.inflight import inflight
 from services.tgapi import bot
+from utils.dispatch import StateRouter
+from utils.jobqueue import jobs
+from utils.quiz_bank import quiz_bank
+from utils.group_quiz import group_quiz
 
-router = Router()
+router = StateRouter()
 
 logger = logging.getLogger(__name__)
 
-@router.message(Command("next"))
+# Категории викторины
+QUIZ_CATEGORIES = {
+    1: "История",
+    2: "Наука и технологии",
+    3: "Культура и искусство",
+    4: "География",
+    5: "Спорт",
+    6: "Литература",
+    7: "Фильмы и сериалы",
+    8: "Музыка",
+    9: "Разное"
+}
+
+@router.command("next")
 async def cmd_next(message: Message):
     chat_type = message.chat.type
     
@@ -36,17 +59,16 @@ async def cmd_next(message: Message):
             return
         await ask_next_question(message, user_id)
     else:
-        chat_id = message.chat.id
-        if chat_id not in group_quiz_data:
-            return
-        quiz_data = group_quiz_data[chat_id]
-        quiz_data["current_question"] += 1
-        await send_group_question(message, chat_id)
+        # Ведущий закрывает текущий вопрос досрочно
+        await message.answer(group_quiz.start_now(message.chat.id, message.from_user.id))
+
+def get_quiz_provider() -> str:
+    return shared_settings.get("quiz_provider", config.DEFAULT_QVIZ_PROVIDER)
 
-@router.message(Command("quizprovider"))
+@router.command("quizprovider")
 async def cmd_quiz_provider(message: Message):
     user_id = message.from_user.id
-    current = config.DEFAULT_QVIZ_PROVIDER  # Текущий провайдер
+    current = get_quiz_provider()  # Текущий провайдер
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(
             text=f"🔄 {provider}{' ✅' if provider == current else ''}", 
@@ -56,7 +78,7 @@ async def cmd_quiz_provider(message: Message):
     ])
     await message.answer("Выберите провайдера для викторин:", reply_markup=keyboard)
 
-@router.callback_query(lambda query: query.data == "finish_quiz")
+@router.callback("finish_quiz")
 async def finish_quiz(callback: CallbackQuery):
     user_id = callback.from_user.id
     quiz_data = user_quiz_data.get(user_id)
@@ -86,61 +108,28 @@ async def finish_quiz(callback: CallbackQuery):
     
     user_quiz_data.pop(user_id, None)
 
-@router.callback_query(lambda query: query.data.startswith("quiz_provider_"))
+@router.callback(prefix="quiz_provider_")
 async def handle_quiz_provider_selection(query: CallbackQuery):
     provider_name = query.data.split("_", 2)[2]  # Извлекаем имя провайдера
-    config.DEFAULT_QVIZ_PROVIDER = provider_name  # Обновляем глобальную константу
+    shared_settings["quiz_provider"] = provider_name  # Общая настройка для всех процессов
     await query.message.edit_text(f"✅ Провайдер для викторин изменён на: {provider_name}")
     await query.answer()
 
-def get_unique_question(user_id: int, questions: list) -> list:
-    """Возвращает только уникальные вопросы для пользователя"""
-    if user_id not in used_questions:
-        used_questions[user_id] = set()
-    
-    unique = []
-    for q in questions:
-        question_hash = hash(q["question"])
-        if question_hash not in used_questions[user_id]:
-            unique.append(q)
-            used_questions[user_id].add(question_hash)
-    
-    return unique
-
-async def send_group_question(message: Message, chat_id: int):
-    """Отправляет вопрос с инлайн-клавиатурой всем участникам"""
-    quiz_data = group_quiz_data[chat_id]
-    
-    if quiz_data["current_question"] >= len(quiz_data["questions"]):
-        await show_group_quiz_results(message, chat_id)
-        return
-    
-    current_q = quiz_data["questions"][quiz_data["current_question"]]
-    participants = quiz_data["participants"]
-    current_player = participants[quiz_data["current_turn"] % len(participants)]
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=f"{key}) {value}", callback_data=f"group_quiz_answer_{key}_{chat_id}")]
-        for key, value in current_q["options"].items()
-    ])
-    
-    await message.bot.send_message(
-        chat_id,
-        f"👥 Вопрос {quiz_data['current_question'] + 1}:\n{current_q['question']}\n\n"
-        f"Очередь игрока: {current_player} (ID: {current_player})"
-    )
-    await message.bot.send_message(chat_id, "Выберите ответ:", reply_markup=keyboard)
-
-@router.message(Command("stopquiz"))
+@router.command("stopquiz")
 async def cmd_stop_quiz(message: Message):
     user_id = message.from_user.id
+    if message.chat.type != "private":
+        await message.answer(await group_quiz.stop(message.chat.id, user_id))
+        return
+    # Генерация следующего вопроса больше не нужна
+    inflight.cancel(user_id, ("quiz",), reason="stopquiz")
     if user_id in user_quiz_data:
         user_quiz_data.pop(user_id)
         await message.answer("🛑 Викторина остановлена.")
     else:
         await message.answer("❌ Вы не в викторине.")
 
-@router.message(Command("quiz"))
+@router.command("quiz")
 async def cmd_quiz(message: Message):
     chat_type = message.chat.type
     
@@ -158,135 +147,43 @@ async def start_private_quiz(message: Message):
         await message.answer("⚠️ Вы уже в викторине!")
         return
     
-    # Категории
-    categories = {
-        1: "История",
-        2: "Наука и технологии",
-        3: "Культура и искусство",
-        4: "География",
-        5: "Спорт",
-        6: "Литература",
-        7: "Фильмы и сериалы",
-        8: "Музыка",
-        9: "Разное"
-    }
-    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=cat, callback_data=f"quiz_category_{i}")]
-        for i, cat in categories.items()
+        for i, cat in QUIZ_CATEGORIES.items()
     ])
     
     await message.answer("Выберите категорию:", reply_markup=keyboard)
     user_states[user_id] = "quiz_category_selection"
 
 async def start_group_quiz(message: Message):
-    chat_id = message.chat.id
-    
-    if chat_id in group_quiz_data:
+    # Категорию можно указать номером: /quiz 4
+    args = message.text.split()[1:] if message.text else []
+    category = QUIZ_CATEGORIES.get(int(args[0]), "Разное") if args and args[0].isdigit() else "Разное"
+    user = message.from_user
+    if not await group_quiz.create(message.chat.id, user.id, user.full_name[:32], category):
         await message.answer("⚠️ Викторина уже идет в этом чате!")
-        return
-    
-    # Создаем данные для группы
-    group_quiz_data[chat_id] = {
-        "participants": [],  # Список ID участников
-        "current_question": 0,
-        "score": {},          # Счет участников
-        "current_turn": 0,    # Индекс текущего игрока
-        "questions": []       # Список вопросов
-    }
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Присоединиться", callback_data="join_quiz")],
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_quiz")]
-    ])
-    await message.answer("🎮 Начинается викторина для группы! Нажмите «Присоединиться», чтобы принять участие.", reply_markup=keyboard)
 
-@router.callback_query(lambda query: query.data == "join_quiz")
-async def join_group_quiz(callback: CallbackQuery):
-    user_id = callback.from_user.id
+@router.callback(prefix="gquiz:")
+async def handle_group_quiz(callback: CallbackQuery):
     chat_id = callback.message.chat.id
-    
-    if chat_id not in group_quiz_data:
-        await callback.message.answer("❌ Викторина не начата.")
-        return
-    
-    participants = group_quiz_data[chat_id]["participants"]
-    
-    if user_id in participants:
-        await callback.answer("Вы уже участвуете!", show_alert=True)
-        return
-    
-    participants.append(user_id)
-    group_quiz_data[chat_id]["score"][user_id] = 0
-    await callback.answer("Вы присоединились к викторине!", show_alert=True)
-
-@router.callback_query(lambda query: query.data.startswith("group_quiz_answer_"))
-async def handle_group_quiz_answer(callback: CallbackQuery):
-    chat_id = int(callback.data.split("_")[-1])
-    answer = callback.data.split("_")[2].upper()
-    user_id = callback.from_user.id
-    
-    quiz_data = group_quiz_data.get(chat_id)
-    if not quiz_data or user_id not in quiz_data["participants"]:
-        await callback.message.answer("❌ Вы не участвуете в викторине.")
-        return
-    
-    current_turn = quiz_data["current_turn"]
-    participants = quiz_data["participants"]
-    
-    if user_id != participants[current_turn % len(participants)]:
-        await callback.answer("❌ Сейчас не ваша очередь отвечать.", show_alert=True)
-        return
-    
-    current_q = quiz_data["questions"][quiz_data["current_question"]]
-    await callback.message.edit_reply_markup(reply_markup=None)
-    
-    if answer == current_q["correct"]:
-        quiz_data["score"][user_id] += 1
-        await callback.message.bot.send_message(chat_id, "✅ Правильно!")
-    else:
-        await callback.message.bot.send_message(chat_id, f"❌ Неверно. Правильный ответ: {current_q['correct']}")
-    
-    quiz_data["current_turn"] += 1
-    quiz_data["current_question"] += 1
-    await send_group_question(callback.message, chat_id)
-
-async def show_group_quiz_results(message: Message, chat_id: int):
-    quiz_data = group_quiz_data.get(chat_id)
-    if not quiz_data:
-        await message.answer("❌ Викторина не найдена.")
-        return
-    
-    results = sorted(
-        [(user, score) for user, score in quiz_data["score"].items()],
-        key=lambda x: x[1],
-        reverse=True
-    )
-    
-    result_text = "🏆 Результаты групповой викторины:\n\n"
-    for user_id, score in results[:5]:
-        result_text += f"{user_id}: {score} очков\n"
-    
-    await message.answer(result_text)
-    group_quiz_data.pop(chat_id, None)
-
-
-@router.callback_query(lambda query: query.data.startswith("quiz_category_"))
+    user = callback.from_user
+    action, _, arg = callback.data[len("gquiz:"):].partition(":")
+    if action == "join":
+        await callback.answer(group_quiz.join(chat_id, user.id, user.full_name[:32]))
+    elif action == "answer":
+        round_, _, letter = arg.partition(":")
+        await callback.answer(group_quiz.answer(chat_id, user.id, user.full_name[:32], int(round_), letter))
+    elif action == "start":
+        await callback.answer(group_quiz.start_now(chat_id, user.id))
+    elif action == "stop":
+        await callback.answer(await group_quiz.stop(chat_id, user.id))
+
+
+@router.callback(prefix="quiz_category_")
 async def handle_quiz_category(callback: CallbackQuery):
     user_id = callback.from_user.id
     category_number = int(callback.data.split("_")[2])
-    categories = {
-        1: "История",
-        2: "Наука и технологии",
-        3: "Культура и искусство",
-        4: "География",
-        5: "Спорт",
-        6: "Литература",
-        7: "Фильмы и сериалы",
-        8: "Музыка",
-        9: "Разное"
-    }
-    selected_category = categories.get(category_number, "Разное")
+    selected_category = QUIZ_CATEGORIES.get(category_number, "Разное")
     
     user_quiz_data[user_id] = {
         "category": selected_category,
@@ -303,7 +200,7 @@ async def handle_quiz_category(callback: CallbackQuery):
     ]))
 
 
-@router.callback_query(lambda query: query.data == "start_quiz")
+@router.callback("start_quiz")
 async def start_quiz(callback: CallbackQuery):
     user_id = callback.from_user.id
     if user_id not in user_quiz_data:
@@ -315,63 +212,110 @@ async def start_quiz(callback: CallbackQuery):
     await ask_next_question(callback.message, user_id)
 
 
+# Разметка ответа модели. Буквы вариантов иногда приходят кириллицей (А, В, С)
+OPTION_LETTERS = {"A": "A", "B": "B", "C": "C", "D": "D", "А": "A", "В": "B", "С": "C"}
+QUESTION_LINE = re.compile(r'^(?:Вопрос\s*\d*|\d+)\s*[:.)]\s*(.+)$', re.IGNORECASE)
+OPTION_LINE = re.compile(r'^([A-DАВС])\s*[).:]\s*(.+)$')
+CORRECT_LINE = re.compile(r'^Правильный ответ\s*[:\-–—]?\s*(.*)$', re.IGNORECASE)
+CORRECT_LETTER = re.compile(r'^\(?([A-DАВС])(?:[).:]|\s*$)')
+MARKDOWN_CHARS = re.compile(r'[*_#`]+')
+
+
+class QuizStreamParser:
+    """Разбирает поток текста модели в вопросы по мере поступления строк.
+
+    Вопрос готов, как только пришла строка «Правильный ответ»: feed()
+    сразу возвращает его. Неполный вопрос (меньше четырёх вариантов, нет
+    или не распознан правильный ответ) отбрасывается сам по себе, остальные
+    вопросы пачки сохраняются.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.current = None
+        self.parsed = 0
+        self.dropped = 0
+
+    def feed(self, text: str) -> list:
+        """Возвращает список вопросов, законченных в этом фрагменте"""
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        ready = []
+        for line in lines:
+            question = self._line(line)
+            if question is not None:
+                ready.append(question)
+        return ready
+
+    def flush(self) -> list:
+        rest, self.buffer = self.buffer, ""
+        question = self._line(rest)
+        if self.current is not None:
+            # Ответ оборвался до строки с правильным ответом
+            self._drop()
+        return [question] if question is not None else []
+
+    def _start(self, text: str):
+        if self.current is not None:
+            self._drop()
+        self.current = {"question": text, "options": {}, "correct": ""}
+
+    def _drop(self):
+        logging.debug(f"Неполный вопрос отброшен: {self.current}")
+        self.current = None
+        self.dropped += 1
+
+    def _line(self, line: str):
+        line = MARKDOWN_CHARS.sub("", line).strip()
+        if not line:
+            return None
+        if match := CORRECT_LINE.match(line):
+            return self._finish(match.group(1).strip())
+        if match := OPTION_LINE.match(line):
+            if self.current is None:
+                self.current = {"question": "", "options": {}, "correct": ""}
+            self.current["options"][OPTION_LETTERS[match.group(1)]] = match.group(2).strip()
+        elif match := QUESTION_LINE.match(line):
+            self._start(match.group(1).strip())
+        elif "?" in line and len(line) > 10:
+            # Вопрос без префикса (например, "Какой фильм...?")
+            self._start(line)
+        return None
+
+    def _finish(self, answer: str):
+        question, self.current = self.current, None
+        if question is None:
+            return None
+        correct = self._correct_letter(answer, question["options"])
+        if not question["question"] or len(question["options"]) != 4 or correct is None:
+            self.current = question
+            self._drop()
+            return None
+        question["correct"] = correct
+        self.parsed += 1
+        return question
+
+    @staticmethod
+    def _correct_letter(answer: str, options: dict):
+        """Буква правильного ответа: «B», «B) Текст», «Текст варианта» или «Вариант B»"""
+        if match := CORRECT_LETTER.match(answer):
+            letter = OPTION_LETTERS[match.group(1)]
+            return letter if letter in options else None
+        text = answer.rstrip(".").strip().lower()
+        for letter, value in options.items():
+            if value.rstrip(".").strip().lower() == text:
+                return letter
+        if match := re.search(r'\b([A-D])\b', answer):
+            return match.group(1) if match.group(1) in options else None
+        return None
+
+
 def parse_quiz_questions(raw_text: str) -> list:
-    """Парсит текстовый ответ модели в структуру вопроса"""
-    logging.info(f"Парсинг ответа: {raw_text}")
-    lines = [line.strip() for line in raw_text.strip().split('\n') if line.strip()]
-    questions = []
-    current_question = None
-    
-    for line in lines:
-        # Обнаружение вопроса с префиксом "Вопрос:" или номером
-        if line.startswith("Вопрос:") or re.match(r'^\d+\.', line):
-            if current_question:
-                questions.append(current_question)
-            question_text = line.split(":", 1)[1].strip() if ":" in line else line.split(".", 1)[1].strip()
-            current_question = {
-                "question": question_text,
-                "options": {},
-                "correct": ""
-            }
-        # Обнаружение вопроса без префикса (например, "Какой фильм...?")
-        elif "?" in line and not line.startswith(('A)', 'B)', 'C)', 'D)')) and len(line) > 10:
-            if current_question:
-                questions.append(current_question)
-            current_question = {
-                "question": line,
-                "options": {},
-                "correct": ""
-            }
-        # Обнаружение вариантов ответов
-        elif re.match(r'^[A-D]\)', line):
-            if not current_question:
-                current_question = {
-                    "question": "Неизвестный вопрос",
-                    "options": {},
-                    "correct": ""
-                }
-            key = line[0]
-            value = line[3:].strip()
-            current_question["options"][key] = value
-        # Обнаружение правильного ответа
-        elif line.startswith("Правильный ответ:"):
-            if current_question:
-                correct = line.split(":")[-1].strip().upper()
-                current_question["correct"] = correct
-                questions.append(current_question)
-                current_question = None
-    
-    # Добавляем последний вопрос, если он есть
-    if current_question:
-        current_question["options"] = {k: v for k, v in current_question["options"].items() if v}
-        if len(current_question["options"]) >= 4:
-            questions.append(current_question)
-    
-    # Проверка валидности
-    if not questions or any(len(q["options"]) < 4 for q in questions):
-        logging.warning("Не удалось распознать структуру вопроса")
-        return []
-    
+    """Парсит полный текстовый ответ модели в список вопросов"""
+    parser = QuizStreamParser()
+    questions = parser.feed(raw_text) + parser.flush()
+    if parser.dropped:
+        logging.warning(f"Не удалось распознать вопросов: {parser.dropped} из {parser.dropped + parser.parsed}")
     return questions
 
 async def ask_next_question(message: Message, user_id: int):
@@ -388,11 +332,12 @@ async def ask_next_question(message: Message, user_id: int):
         user_quiz_data[user_id] = quiz_data
 
     if quiz_data["current_question"] >= len(quiz_data["questions"]):
-        new_question = await generate_quiz_questions(quiz_data["category"])
+        with inflight.track(user_id, "quiz"):
+            new_question = await next_bank_question(user_id, quiz_data["category"])
         if not new_question:
             await message.answer("⚠️ Не удалось загрузить вопрос.")
             return
-        quiz_data["questions"].extend(new_question)
+        quiz_data["questions"].append(new_question)
 
     current_q = quiz_data["questions"][quiz_data["current_question"]]
     quiz_data["awaiting_answer"] = True
@@ -417,7 +362,7 @@ async def ask_next_question(message: Message, user_id: int):
     quiz_data["last_question_message_id"] = answer_message.message_id
     quiz_data["last_question_message_chat_id"] = answer_message.chat.id
 
-@router.callback_query(lambda query: query.data.startswith("quiz_answer_"))
+@router.callback(prefix="quiz_answer_")
 async def handle_quiz_answer(callback: CallbackQuery):
     user_id = callback.from_user.id
     answer = callback.data.split("_")[-1].upper()
@@ -450,7 +395,7 @@ async def handle_quiz_answer(callback: CallbackQuery):
     quiz_data["current_question"] += 1
     await ask_next_question(callback.message, user_id)
 
-@router.callback_query(lambda query: query.data == "next_question")
+@router.callback("next_question")
 async def next_question_handler(callback: CallbackQuery):
     user_id = callback.from_user.id
     await ask_next_question(callback.message, user_id)
@@ -480,13 +425,13 @@ async def show_quiz_results(message: Message, user_id: int):
     user_quiz_data.pop(user_id, None)
 
 
-@router.callback_query(lambda query: query.data == "answer_quiz")
+@router.callback("answer_quiz")
 async def answer_quiz(callback: CallbackQuery):
     user_id = callback.from_user.id
     await callback.message.answer("Введите ваш ответ (A, B, C или D):")
 
 
-@router.callback_query(lambda query: query.data == "cancel_quiz")
+@router.callback("cancel_quiz")
 async def cancel_quiz(callback: CallbackQuery):
     user_id = callback.from_user.id
     if user_id in user_quiz_data:
@@ -494,13 +439,16 @@ async def cancel_quiz(callback: CallbackQuery):
     await callback.message.edit_text("❌ Викторина отменена.")
     await callback.answer()
 
-from tenacity import retry, stop_after_attempt, wait_exponential
-from langdetect import detect
+#####################################################
+################## Банк вопросов ####################
 
-async def generate_quiz_questions(category: str, count: int = 1):
-    """Генерирует один вопрос по выбранной категории"""
+async def stream_quiz_questions(category: str, count: int = None):
+    """Генерирует пачку вопросов по категории одним потоковым запросом к модели
+    и отдаёт каждый вопрос, как только он разобран"""
+    count = count or config.QUIZ_BANK_BATCH_SIZE
     prompt = f"""
-    Сгенерируйте {count} вопрос по теме '{category}' на русском языке в формате:
+    Сгенерируйте {count} разных вопросов по теме '{category}' на русском языке.
+    Каждый вопрос строго в формате:
     Вопрос: [Вопрос]
     A) [Вариант 1]
     B) [Вариант 2]
@@ -518,24 +466,117 @@ async def generate_quiz_questions(category: str, count: int = 1):
 
     ВАЖНО: 
     - Ответ должен быть только на русском языке.
-    - Строго соблюдайте указанный формат.
+    - Строго соблюдайте указанный формат, вопросы разделяйте пустой строкой.
     - Не добавляйте дополнительный текст.
     """
+    parser = QuizStreamParser()
     try:
-        import config
-        provider_class = getattr(g4f.Provider, config.DEFAULT_QVIZ_PROVIDER)
-        
-        raw_questions = await g4f.ChatCompletion.create_async(
+        client = AsyncClient(provider=getattr(g4f.Provider, get_quiz_provider()))
+        response = client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "Вы отвечаете на русском языке."},
                 {"role": "user", "content": prompt}
             ],
-            provider=provider_class
+            stream=True
         )
-        
-        logging.info(f"Получен ответ от модели: {raw_questions}")
-        return parse_quiz_questions(raw_questions)
+        if inspect.isawaitable(response):
+            response = await response
+        async for chunk in response:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                for question in parser.feed(delta):
+                    yield question
+        for question in parser.flush():
+            yield question
     except Exception as e:
+        # Уже разобранные вопросы остаются у вызывающего
         logging.error(f"Ошибка генерации вопроса: {str(e)}", exc_info=True)
-        return []
\ No newline at end of file
+    finally:
+        logging.info(
+            f"Викторина «{category}»: получено вопросов {parser.parsed} из {count}, отброшено {parser.dropped}"
+        )
+
+def refill_key(category: str) -> str:
+    """Ключ идемпотентности: пополнение категории не чаще раза в QUIZ_BANK_REFILL_COOLDOWN секунд"""
+    window = int(time.time() // config.QUIZ_BANK_REFILL_COOLDOWN)
+    return f"quiz_refill:{category}:{window}"
+
+async def request_refill(category: str):
+    """Ставит пополнение категории"""
+    await jobs.enqueue_async("quiz_refill", {"category": category}, idempotency_key=refill_key(category))
+
+def request_initial_refill():
+    """При запуске добиваем до нормы категории, в которых мало вопросов"""
+    for category in QUIZ_CATEGORIES.values():
+        if quiz_bank.depth(category) < config.QUIZ_BANK_LOW_WATER:
+            jobs.enqueue("quiz_refill", {"category": category}, idempotency_key=refill_key(category))
+
+@jobs.handler("quiz_refill")
+async def refill_category(payload: dict):
+    category = payload["category"]
+    for _ in range(config.QUIZ_BANK_MAX_BATCHES):
+        if await asyncio.to_thread(quiz_bank.depth, category) >= config.QUIZ_BANK_TARGET:
+            return
+        received = 0
+        async for question in stream_quiz_questions(category):
+            received += 1
+            await asyncio.to_thread(quiz_bank.add, category, [question])
+        if not received:
+            raise RuntimeError(f"модель не вернула вопросов для «{category}»")
+
+# Идущие потоковые генерации в банк: категория -> BankStream
+bank_streams = {}
+
+
+class BankStream:
+    """Потоковая генерация пачки вопросов прямо в банк, когда банк категории пуст.
+
+    Одна генерация на категорию: все, кому не хватило вопросов, ждут её
+    вместе и получают вопрос, как только он разобран и попал в банк.
+    Остаток пачки дописывается в банк уже без них.
+    """
+
+    def __init__(self, category: str):
+        self.category = category
+        self.finished = False
+        self.arrivals = asyncio.Condition()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        try:
+            async for question in stream_quiz_questions(self.category):
+                if await asyncio.to_thread(quiz_bank.add, self.category, [question]):
+                    async with self.arrivals:
+                        self.arrivals.notify_all()
+        finally:
+            self.finished = True
+            bank_streams.pop(self.category, None)
+            async with self.arrivals:
+                self.arrivals.notify_all()
+
+    async def next_question(self, user_id: int):
+        async with self.arrivals:
+            while True:
+                question = await asyncio.to_thread(quiz_bank.pop, self.category, user_id)
+                if question is not None or self.finished:
+                    return question
+                await self.arrivals.wait()
+
+async def next_bank_question(user_id: int, category: str):
+    """Вопрос из банка, который пользователь ещё не видел. Если банк пуст,
+    генерируем пачку в банк потоком и отдаём первый подходящий вопрос, не
+    дожидаясь остальных. Работа с банком (SQLite и сравнение подписей) идёт в потоке,
+    чтобы блокировка записи другого шарда не останавливала цикл событий"""
+    question = await asyncio.to_thread(quiz_bank.pop, category, user_id)
+    if question is None:
+        stream = bank_streams.get(category)
+        if stream is None:
+            stream = bank_streams[category] = BankStream(category)
+        question = await stream.next_question(user_id)
+    if await asyncio.to_thread(quiz_bank.depth, category) < config.QUIZ_BANK_LOW_WATER:
+        await request_refill(category)
+    return question
+
+# Вопросы групповой викторины - из того же банка; повторы отсеиваются по чату
+group_quiz.question_source(next_bank_question)
@@ -1,9 +1,11 @@
 # services/retry.py
+import json
 import aiohttp
 import asyncio
 import logging
 from tenacity import retry, stop_after_attempt, wait_exponential
 from services.tgapi import check_telegram_api_availability
+from utils.singleflight import audio_flight
 from database import (  save_users, load_users, save_blocked_users,
                         user_history, user_settings, user_info,
                         image_requests, last_image_requests,
@@ -37,8 +39,14 @@ async def download_image_with_retry(image_url):
             raise Exception(f"Ошибка генерации: {error_text}")
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, max=10))
 async def generate_audio_with_retry(payload, method="POST"):
+    """Генерация аудио; одинаковые одновременные запросы выполняются один раз.
+    Слот "tts" вызывающие занимают сами, до входа сюда"""
+    key = (method, json.dumps(payload, sort_keys=True, ensure_ascii=False))
+    return await audio_flight.do(key, lambda: request_audio_with_retry(payload, method))
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, max=10))
+async def request_audio_with_retry(payload, method="POST"):
     """Генерация аудио с повторными попытками"""
     async with aiohttp.ClientSession() as session:
         if method == "GET":
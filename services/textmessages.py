@@ -1,4 +1,5 @@
 # services/textmessages.py
+import time
 import logging
 import asyncio
 import g4f
@@ -17,18 +18,25 @@ from database import (  save_users, load_users, save_blocked_users,
                         image_requests, last_image_requests,
                         user_states, admin_states, blocked_users,
                         user_analysis_states, user_analysis_settings,
-                        user_transcribe_states, user_quiz_data)
+                        user_transcribe_states, user_quiz_data,
+                        pending_chat_messages)
 from utils.helpers import (get_user_settings, convert_to_mp3, split_audio,
                             encode_audio_base64, remove_html_tags,
                             auto_detect_language, format_response)
+from utils.scheduler import scheduler, QueueNotice, QueueFull
+from utils.inflight import inflight
+from utils.quota import quota
 from datetime import datetime
+from utils.dispatch import StateRouter, TEXT, VOICE, AUDIO_DOCUMENT, ADMIN_REPLY
+from utils.history_stats import append_history
 
-router = Router()
+router = StateRouter()
 
 
 ################################################
 ########### Запрос инфы о провайдере ###########
-@router.message(Command("aihelp"))
+@router.command("aihelp")
+@inflight.tracked("chat")
 async def cmd_aihelp(message: Message):
     user_id = message.from_user.id
     user_input = "Раскажи доступното ты такой и что ты умеешь!?"
@@ -46,14 +54,15 @@ async def cmd_aihelp(message: Message):
         ]
         api_messages.append({"role": "user", "content": user_input})
 
-        await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
+        async with scheduler.slot("chat", user_id, QueueNotice(message)):
+            await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
 
-        response = await g4f.ChatCompletion.create_async(
-            model=g4f.models.default,
-            messages=api_messages,
-            provider=provider_class(),
-            api_key=config.API_DeepSeek
-        )
+            response = await g4f.ChatCompletion.create_async(
+                model=g4f.models.default,
+                messages=api_messages,
+                provider=provider_class(),
+                api_key=config.API_DeepSeek
+            )
 
         # Сохраняем в историю
         user_entry = {
@@ -62,7 +71,7 @@ async def cmd_aihelp(message: Message):
             "content": user_input,
             "timestamp": datetime.now().isoformat()
         }
-        user_history.setdefault(user_id, []).append(user_entry)
+        append_history(user_id, user_entry)
 
         assistant_entry = {
             "type": "text",
@@ -70,13 +79,15 @@ async def cmd_aihelp(message: Message):
             "content": remove_html_tags(response),
             "timestamp": datetime.now().isoformat()
         }
-        user_history[user_id].append(assistant_entry)
+        append_history(user_id, assistant_entry)
         save_users()
 
         # Отправляем ответ
         formatted_response = format_response(response)
         await message.answer(formatted_response, parse_mode=ParseMode.HTML)
 
+    except QueueFull as e:
+        await message.answer(f"⏳ {str(e)}")
     except Exception as e:
         logging.error(f"Ошибка AI: {str(e)}")
         current_provider = AVAILABLE_PROVIDERS[0]
@@ -89,7 +100,7 @@ async def cmd_aihelp(message: Message):
 ################################################
 ########### Блок текстовых сообщений ###########
 # Обработчик текстовых сообщений для ответов на сообщения администраторов
-@router.message(lambda message: message.reply_to_message and is_admin(message.reply_to_message.from_user.id))
+@router.message(TEXT, state=ADMIN_REPLY)
 async def handle_admin_reply(message: Message):
     admin_id = message.reply_to_message.from_user.id
     user_id = message.from_user.id
@@ -106,14 +117,20 @@ def format_thinking_process(text, duration):
     """Форматирует мыслительный процесс как цитату"""
     return f"🔍 Мысли бота:\n{text}\n⏱️ Время выполнения: {duration:.1f} секунд"
 
-# Создаем кастомный фильтр для проверки, является ли автор ответа администратором
-def is_reply_to_admin(message: Message) -> bool:
-    return message.reply_to_message and is_admin(message.reply_to_message.from_user.id)
+# Очереди ответов по (чат, пользователь): ответы одному пользователю в чате идут строго по порядку.
+# (чат, пользователь) -> [блокировка, сколько обработчиков держат или ждут её]
+chat_turn_locks = {}
+
+async def keep_typing(chat_id: int):
+    """Держит индикатор набора, пока готовится ответ"""
+    while True:
+        await bot.send_chat_action(chat_id, ChatAction.TYPING)
+        await asyncio.sleep(4)
 
 # Обработчик текстовых сообщений для общения с ИИ
-@router.message(F.text & ~F.func(is_reply_to_admin))
+@router.message(TEXT)
+@inflight.tracked("chat")
 async def handle_message(message: Message):
-    global current_provider
     # Проверяем, существует ли from_user
     if message.from_user is None:
         logging.warning("Получено сообщение без from_user (например, от канала).")
@@ -126,9 +143,49 @@ async def handle_message(message: Message):
     if user_state == "in_quiz":
         await message.answer("⚠️ Ответьте на вопрос с помощью кнопок ниже.")
         return
+
+    # Несколько быстрых сообщений подряд собираем в один запрос.
+    # Буфер ведётся отдельно для каждого чата: сообщения из лички не должны попасть в ответ в группе
+    key = (message.chat.id, user_id)
+    buffer = pending_chat_messages.setdefault(key, [])
+    buffer.append((message, time.monotonic()))
+    if len(buffer) == 1:
+        await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
+    await asyncio.sleep(config.CHAT_DEBOUNCE_SECONDS)
+    buffer = pending_chat_messages.get(key, [])
+    if buffer and buffer[-1][0] is not message:
+        first_at = buffer[0][1]
+        if time.monotonic() - first_at < config.CHAT_DEBOUNCE_MAX_WAIT:
+            return  # Ответит обработчик последнего сообщения
+        # Пользователь пишет без пауз - не откладываем ответ бесконечно
+
+    entry = chat_turn_locks.get(key)
+    if entry is None:
+        entry = chat_turn_locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            buffer = pending_chat_messages.pop(key, [])
+            if buffer:
+                messages = [item[0] for item in buffer]
+                # Сообщения, слитые в один ход, расходуют одну единицу квоты
+                for _ in messages[1:]:
+                    quota.refund(user_id, "chat")
+                await answer_chat_turn(messages[-1], "\n".join(item.text for item in messages))
+    finally:
+        # Блокировку убираем, только когда её никто не держит и не ждёт:
+        # иначе следующее сообщение создаст новую и обгонит разбуженного ожидающего
+        entry[1] -= 1
+        if not entry[1]:
+            chat_turn_locks.pop(key, None)
+
+async def answer_chat_turn(message: Message, user_input: str):
+    """Один запрос к модели на ход диалога"""
+    global current_provider
+    user_id = message.from_user.id
     # Получаем провайдера из настроек пользователя
     provider_name = user_settings.get(user_id, {}).get("provider",config.DEFAULT_PROVIDER)
-    user_input = message.text
+    typing = asyncio.create_task(keep_typing(message.chat.id))
     
     try:
         # Фильтруем историю для API
@@ -149,30 +206,32 @@ async def handle_message(message: Message):
         }
         api_messages.append({"role": "user", "content": user_input})
         
-        await bot.send_chat_action(message.chat.id, ChatAction.TYPING)
-        
         provider_class = getattr(g4f.Provider,provider_name)
-        response = await g4f.ChatCompletion.create_async(
-            model=g4f.models.default,
-            messages=api_messages,  # Используем отфильтрованные сообщения
-            provider=provider_class(),
-            api_key=config.API_DeepSeek
-        )
+        async with scheduler.slot("chat", user_id, QueueNotice(message)):
+            response = await g4f.ChatCompletion.create_async(
+                model=g4f.models.default,
+                messages=api_messages,  # Используем отфильтрованные сообщения
+                provider=provider_class(),
+                api_key=config.API_DeepSeek
+            )
+        typing.cancel()
         
         # Сохраняем в историю
-        user_history.setdefault(user_id, []).append(user_entry)
+        append_history(user_id, user_entry)
         assistant_entry = {
             "type": "text",
             "role": "assistant",
             "content": remove_html_tags(response),
             "timestamp": datetime.now().isoformat()
         }
-        user_history[user_id].append(assistant_entry)
+        append_history(user_id, assistant_entry)
         save_users()
         
         formatted_response = format_response(response)
         await message.answer(formatted_response, parse_mode=ParseMode.HTML)
 
+    except QueueFull as e:
+        await message.answer(f"⏳ {str(e)}")
     except Exception as e:
         logging.error(f"Ошибка AI: {str(e)}")
         current_provider = AVAILABLE_PROVIDERS[0]
@@ -181,9 +240,11 @@ async def handle_message(message: Message):
             f"Провайдер автоматически сброшен на {current_provider}\n"
             "Попробуйте повторить запрос"
         )
+    finally:
+        typing.cancel()
 
 # Обработчик аудиофайлов без команды
-@router.message(lambda message: message.audio or message.voice or message.document and message.document.mime_type.startswith('audio/'))
+@router.message(VOICE, AUDIO_DOCUMENT)
 async def handle_unsolicited_audio(message: Message):
     user_id = message.from_user.id
     
@@ -194,6 +255,7 @@ async def handle_unsolicited_audio(message: Message):
     # Отправляем предложение проанализировать аудиофайл
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🎤 Распознать речь", callback_data="suggest_transcribe")],
+        [InlineKeyboardButton(text="🗣 Голосовой режим", callback_data="suggest_voicechat")],
         [InlineKeyboardButton(text="🖼 Сгенерировать изображение", callback_data="suggest_generate")]
     ])
     
@@ -203,7 +265,7 @@ async def handle_unsolicited_audio(message: Message):
     )
 
 # Обработчик нажатия на кнопку "Распознать"
-@router.callback_query(lambda query: query.data == "suggest_transcribe")
+@router.callback("suggest_transcribe")
 async def handle_suggest_transcribe(callback: CallbackQuery):
     await callback.message.edit_text("Хорошо, я могу распознать речь в этом аудиофайле. Для этого используйте команду `/transcribe`.")
     await callback.answer()
\ No newline at end of file
@@ -6,6 +6,7 @@ from aiogram import Bot
 from aiogram.client.session.aiohttp import AiohttpSession
 from providers.fully_working import AVAILABLE_PROVIDERS
 from middlewares.user_middleware import UserMiddleware
+from middlewares.outbound import outbound
 
 
 #####################################################
@@ -28,3 +29,5 @@ bot = Bot(
     session=session,
     timeout=40
 )
+# Все исходящие запросы проходят через очередь с лимитами Telegram
+bot.session.middleware(outbound)
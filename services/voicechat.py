@@ -0,0 +1,222 @@
+# services/voicechat.py
+import os
+import re
+import base64
+import asyncio
+import inspect
+import logging
+import tempfile
+import g4f
+import config
+from g4f.client import AsyncClient
+from aiogram import Router
+from aiogram.enums import ChatAction
+from aiogram.filters import Command
+from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from datetime import datetime
+from database import save_users, user_history, user_settings, user_transcribe_states
+from utils.helpers import convert_to_mp3, remove_html_tags
+from services.retry import transcribe_with_retry
+from services.generateaudio import synthesize_speech
+from services.tgapi import bot
+from utils.scheduler import scheduler, QueueNotice, QueueFull
+from utils.inflight import inflight
+from utils.dispatch import StateRouter, VOICE, VOICE_CHAT
+from utils.history_stats import append_history
+
+router = StateRouter()
+
+# Граница предложения: знак препинания и пробел после него
+SENTENCE_END = re.compile(r'[.!?…]+[\s]+')
+
+############################################################
+########### Режим голосового общения (голос -> голос) ######
+
+def is_voice_chat_enabled(user_id: int) -> bool:
+    return bool(user_settings.get(user_id, {}).get("voice_chat"))
+
+@router.command("voicechat")
+async def cmd_voice_chat(message: Message):
+    user_id = message.from_user.id
+    enabled = not is_voice_chat_enabled(user_id)
+    user_settings.setdefault(user_id, {})["voice_chat"] = enabled
+    save_users()
+    if enabled:
+        await message.answer("🗣 Голосовой режим включён. Отправьте голосовое сообщение — я отвечу голосом.\n"
+                             "Чтобы выключить, повторите /voicechat")
+    else:
+        await message.answer("🔇 Голосовой режим выключен.")
+
+@router.callback("suggest_voicechat")
+async def handle_suggest_voice_chat(callback: CallbackQuery):
+    user_settings.setdefault(callback.from_user.id, {})["voice_chat"] = True
+    save_users()
+    await callback.message.edit_text("🗣 Голосовой режим включён. Отправьте голосовое сообщение ещё раз.")
+    await callback.answer()
+
+class SentenceSplitter:
+    """Собирает поток токенов в предложения для озвучки"""
+
+    def __init__(self, min_length: int):
+        self.min_length = min_length
+        self.buffer = ""
+
+    def feed(self, text: str):
+        """Возвращает список готовых фрагментов"""
+        self.buffer += text
+        ready = []
+        while True:
+            cut = None
+            for match in SENTENCE_END.finditer(self.buffer):
+                # Короткие предложения объединяем, чтобы не дробить синтез
+                if match.end() >= self.min_length:
+                    cut = match.end()
+                    break
+            if cut is None:
+                return ready
+            ready.append(self.buffer[:cut].strip())
+            self.buffer = self.buffer[cut:]
+
+    def flush(self):
+        rest, self.buffer = self.buffer.strip(), ""
+        return [rest] if rest else []
+
+async def transcribe_voice(message: Message) -> str:
+    """Скачивает голосовое сообщение и распознаёт речь"""
+    voice = message.voice or message.audio
+    temp_dir = tempfile.gettempdir()
+    input_path = os.path.join(temp_dir, f"voicechat_{voice.file_unique_id}.ogg")
+    mp3_path = os.path.join(temp_dir, f"voicechat_{voice.file_unique_id}.mp3")
+    try:
+        await bot.download(voice, destination=input_path)
+        if not await asyncio.to_thread(convert_to_mp3, input_path, mp3_path):
+            raise ValueError("Не удалось конвертировать голосовое сообщение")
+        with open(mp3_path, "rb") as f:
+            encoded_audio = base64.b64encode(f.read()).decode('utf-8')
+    finally:
+        for path in (input_path, mp3_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    payload = {
+        "model": config.SPEECH_TO_TEXT_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Распознайте речь из этого аудиофайла, верните только текст:"},
+                    {"type": "input_audio", "input_audio": {"data": encoded_audio, "format": "mp3"}}
+                ]
+            }
+        ]
+    }
+    async with scheduler.slot("transcribe", message.from_user.id, QueueNotice(message)):
+        result = await transcribe_with_retry(payload)
+    return result['choices'][0]['message']['content'].strip()
+
+async def stream_chat_completion(user_id: int, api_messages: list):
+    """Потоковый ответ g4f: отдаёт текстовые фрагменты по мере генерации"""
+    provider_name = user_settings.get(user_id, {}).get("provider", config.DEFAULT_PROVIDER)
+    client = AsyncClient(provider=getattr(g4f.Provider, provider_name))
+    response = client.chat.completions.create(
+        model=g4f.models.default,
+        messages=api_messages,
+        stream=True
+    )
+    if inspect.isawaitable(response):
+        response = await response
+    async for chunk in response:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
+@router.message(VOICE, state=VOICE_CHAT)
+@inflight.tracked("voice")
+async def handle_voice_chat(message: Message):
+    user_id = message.from_user.id
+    voice_file = message.voice or message.audio
+    if voice_file.duration and voice_file.duration > config.MAX_AUDIO_DURATION:
+        await message.answer(f"❌ Голосовое сообщение длиннее {config.MAX_AUDIO_DURATION} секунд.")
+        return
+
+    voice = user_settings.get(user_id, {}).get("voice", config.DEFAULT_VOICE)
+    semaphore = asyncio.Semaphore(config.TTS_MAX_PARALLEL)
+    # Очередь задач синтеза в порядке предложений; None - конец ответа
+    speech_queue = asyncio.Queue()
+
+    async def synthesize(sentence):
+        async with semaphore:
+            async with scheduler.slot("tts", user_id, bounded=False):
+                return await synthesize_speech(remove_html_tags(sentence), voice, config.TEXT_TO_SPEECH_MODEL)
+
+    async def send_replies():
+        # Отправляем голосовые ответы строго по порядку, пока следующие ещё синтезируются
+        while True:
+            task = await speech_queue.get()
+            if task is None:
+                return
+            audio_data = await task
+            await message.answer_voice(BufferedInputFile(audio_data, filename="reply.mp3"))
+
+    sender = None
+    pending = []
+    try:
+        await bot.send_chat_action(message.chat.id, ChatAction.RECORD_VOICE)
+        user_input = await transcribe_voice(message)
+        if not user_input:
+            await message.answer("⚠️ Не удалось распознать речь.")
+            return
+        await message.answer(f"🎤 {user_input}")
+
+        api_messages = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in user_history.get(user_id, [])
+            if msg.get("type") == "text" and "role" in msg and "content" in msg
+        ]
+        api_messages.append({"role": "user", "content": user_input})
+
+        sender = asyncio.create_task(send_replies())
+        splitter = SentenceSplitter(config.VOICE_CHAT_MIN_SENTENCE)
+        answer_parts = []
+        # Потоковый ответ занимает слот чата, как и обычные запросы к модели
+        async with scheduler.slot("chat", user_id, QueueNotice(message)):
+            async for delta in stream_chat_completion(user_id, api_messages):
+                answer_parts.append(delta)
+                for sentence in splitter.feed(delta):
+                    task = asyncio.create_task(synthesize(sentence))
+                    pending.append(task)
+                    speech_queue.put_nowait(task)
+        for sentence in splitter.flush():
+            task = asyncio.create_task(synthesize(sentence))
+            pending.append(task)
+            speech_queue.put_nowait(task)
+        speech_queue.put_nowait(None)
+        await sender
+
+        answer = remove_html_tags("".join(answer_parts))
+        append_history(user_id, {
+            "type": "text",
+            "role": "user",
+            "content": user_input,
+            "voice": True,
+            "timestamp": datetime.now().isoformat()
+        })
+        append_history(user_id, {
+            "type": "text",
+            "role": "assistant",
+            "content": answer,
+            "voice": True,
+            "timestamp": datetime.now().isoformat()
+        })
+        save_users()
+
+    except QueueFull as e:
+        await message.answer(f"⏳ {str(e)}")
+    except Exception as e:
+        logging.error(f"Ошибка голосового режима: {str(e)}")
+        await message.answer(f"⚠️ Ошибка голосового режима: {str(e)}")
+    finally:
+        for task in pending:
+            task.cancel()
+        if sender and not sender.done():
+            sender.cancel()
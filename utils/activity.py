@@ -0,0 +1,101 @@
+# utils/activity.py
+import time
+import asyncio
+import logging
+import config
+from database import user_info, user_history, user_settings, save_users
+from utils.user_index import user_index
+
+#####################################################
+########### Активность пользователей ################
+
+class ActivityTracker:
+    """Учёт активности без работы с user_info на каждом обновлении.
+
+    На пользователя хранится кортеж (последняя активность в секундах epoch,
+    (username, first_name, last_name)). Активность обновляется не чаще раза
+    в ACTIVITY_GRANULARITY секунд, изменения профиля копятся в dirty и
+    переносятся в user_info пачкой раз в ACTIVITY_FLUSH_INTERVAL. На диск
+    сразу пишутся только новые пользователи и смена профиля, время активности
+    уходит с ближайшим обычным сохранением.
+    """
+
+    def __init__(self):
+        self.users = {}     # user_id -> (last_activity, profile)
+        self.joined = {}    # user_id -> время первого появления (только новые, до сброса)
+        self.dirty = set()
+        self.profiles_changed = False
+        self.stats = {"updates": 0, "ns": 0, "flushes": 0}
+
+    def touch(self, user) -> None:
+        """Вызывается мидлварью на каждое обновление; дешёвый путь - одно сравнение"""
+        now = int(time.time())
+        user_id = user.id
+        profile = (user.username, user.first_name, user.last_name)
+        entry = self.users.get(user_id)
+        if entry is None:
+            self._first_seen(user_id, now)
+        elif entry[1] == profile:
+            if now - entry[0] < config.ACTIVITY_GRANULARITY:
+                return
+        else:
+            self.profiles_changed = True
+        self.users[user_id] = (now, profile)
+        self.dirty.add(user_id)
+
+    def _first_seen(self, user_id: int, now: int):
+        # Настройки по умолчанию нужны обработчикам сразу, поэтому не откладываем
+        if user_id not in user_history:
+            user_history[user_id] = []
+        if user_id not in user_settings:
+            user_settings[user_id] = {
+                "model": "flux",
+                "width": 1080,
+                "height": 1920,
+                "provider": config.DEFAULT_PROVIDER
+            }
+        if user_id not in user_info:
+            self.joined[user_id] = now
+            self.profiles_changed = True
+
+    def flush(self) -> bool:
+        """Переносит накопленные изменения в user_info.
+        Возвращает True, если появились новые пользователи или сменился профиль"""
+        dirty, self.dirty = self.dirty, set()
+        changed, self.profiles_changed = self.profiles_changed, False
+        for user_id in dirty:
+            last_activity, (username, first_name, last_name) = self.users[user_id]
+            info = user_info.get(user_id)
+            if info is None:
+                info = user_info[user_id] = {"date_joined": self.joined.pop(user_id, last_activity)}
+            info.update(username=username, first_name=first_name, last_name=last_name,
+                        last_activity=last_activity)
+            user_index.mark(user_id)
+        if dirty:
+            self.stats["flushes"] += 1
+        return changed
+
+    def record(self, elapsed_ns: int):
+        self.stats["updates"] += 1
+        self.stats["ns"] += elapsed_ns
+
+    def stats_text(self) -> str:
+        updates = self.stats["updates"]
+        average = self.stats["ns"] / updates / 1000 if updates else 0.0
+        return (
+            f"⏱ Мидлварь: обновлений {updates}, в среднем {average:.1f} мкс, "
+            f"пользователей {len(self.users)}, сбросов профилей {self.stats['flushes']}"
+        )
+
+
+activity = ActivityTracker()
+
+
+async def activity_flush_task():
+    while True:
+        await asyncio.sleep(config.ACTIVITY_FLUSH_INTERVAL)
+        try:
+            if activity.flush():
+                save_users()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения активности: {str(e)}")
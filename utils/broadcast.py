@@ -0,0 +1,283 @@
+# utils/broadcast.py
+import json
+import time
+import asyncio
+import logging
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+import config
+from services.tgapi import bot
+from database import user_info, user_settings, shard_state, owns_key, save_users
+from utils.storage import storage
+from utils.jobqueue import jobs, RetryLater
+from utils.user_index import user_index, to_epoch
+from utils.history_stats import clear_history
+from middlewares.outbound import outbound_priority, PRIORITY_BULK
+
+#####################################################
+########### Рассылка администратора #################
+
+# Сегменты получателей: ключ -> (название, активность за столько дней; 0 - все)
+BROADCAST_SEGMENTS = {
+    "all": ("Все пользователи", 0),
+    "7": ("Активные за 7 дней", 7),
+    "30": ("Активные за 30 дней", 30),
+}
+
+# Статусы рассылки
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+
+# Пользователи, которым не удалось доставить сообщение (заблокировали бота, удалены)
+UNREACHABLE_NAMESPACE = "unreachable_users"
+
+
+class Broadcaster:
+    """Рассылка сообщения администратора всем пользователям или сегменту.
+
+    Сообщение копируется (copy_message) из чата администратора, поэтому
+    подходит любой тип содержимого. Каждый шард рассылает своим
+    пользователям в порядке user_id через очередь задач: задача отправляет
+    порции по BROADCAST_CHUNK_SIZE, после каждой сохраняет курсор и
+    счётчики, а через BROADCAST_SLICE_SECONDS уступает воркер (RetryLater).
+    После перезапуска рассылка продолжается с курсора; повторно может уйти
+    не больше одной порции. Если число шардов изменилось, новые шарды
+    получают свои части, а части лишних шардов закрываются; пользователь,
+    переехавший в шард с курсором дальше его id, сообщение не получит. Темп задаёт очередь исходящих: рассылка идёт в
+    массовой полосе и не задерживает интерактивные ответы.
+    """
+
+    def ensure_schema(self):
+        storage.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, admin_id INTEGER NOT NULL, "
+            "from_chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, segment TEXT NOT NULL, "
+            "status TEXT NOT NULL, progress_chat_id INTEGER, progress_message_id INTEGER, "
+            "reported_at REAL NOT NULL DEFAULT 0, created_at REAL NOT NULL)"
+        )
+        storage.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_parts ("
+            "broadcast_id INTEGER NOT NULL, shard INTEGER NOT NULL, cursor INTEGER NOT NULL DEFAULT 0, "
+            "total INTEGER, sent INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+            "unreachable INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (broadcast_id, shard))"
+        )
+
+    def _create(self, admin_id, from_chat_id, message_id, segment, progress_chat_id, progress_message_id) -> int:
+        self.ensure_schema()
+        with storage.transaction() as conn:
+            return conn.execute(
+                "INSERT INTO broadcasts (admin_id, from_chat_id, message_id, segment, status, "
+                "progress_chat_id, progress_message_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (admin_id, from_chat_id, message_id, segment, RUNNING,
+                 progress_chat_id, progress_message_id, time.time())
+            ).lastrowid
+
+    async def start(self, admin_id: int, from_chat_id: int, message_id: int, segment: str,
+                    progress_chat_id: int, progress_message_id: int) -> int:
+        """Создаёт рассылку и ставит по задаче на каждый шард"""
+        broadcast_id = await asyncio.to_thread(
+            self._create, admin_id, from_chat_id, message_id, segment, progress_chat_id, progress_message_id
+        )
+        await self.sync_parts(broadcast_id)
+        return broadcast_id
+
+    @staticmethod
+    def _write_parts(broadcast_id: int, count: int):
+        with storage.transaction() as conn:
+            for shard in range(count):
+                conn.execute("INSERT OR IGNORE INTO broadcast_parts (broadcast_id, shard) VALUES (?, ?)",
+                             (broadcast_id, shard))
+            conn.execute("UPDATE broadcast_parts SET done = 1 WHERE broadcast_id = ? AND shard >= ?",
+                         (broadcast_id, count))
+
+    async def sync_parts(self, broadcast_id: int):
+        """Часть рассылки и задача на каждый текущий шард; части шардов сверх
+        текущего числа закрываются - их пользователи теперь у других шардов"""
+        count = shard_state["count"]
+        await asyncio.to_thread(self._write_parts, broadcast_id, count)
+        for shard in range(count):
+            await jobs.enqueue_async("broadcast", {"id": broadcast_id, "shard": shard},
+                                     idempotency_key=f"broadcast:{broadcast_id}:{shard}", shard=shard)
+
+    def cancel(self, broadcast_id: int) -> bool:
+        self.ensure_schema()
+        return storage.execute(
+            "UPDATE broadcasts SET status = ? WHERE id = ? AND status = ?", (CANCELLED, broadcast_id, RUNNING)
+        ).rowcount > 0
+
+    def get(self, broadcast_id: int):
+        rows = storage.query(
+            "SELECT admin_id, from_chat_id, message_id, segment, status, progress_chat_id, progress_message_id "
+            "FROM broadcasts WHERE id = ?", (broadcast_id,)
+        )
+        return rows[0] if rows else None
+
+    def recipients(self, segment: str, after: int) -> list:
+        """user_id получателей шарда после курсора, по возрастанию"""
+        days = BROADCAST_SEGMENTS.get(segment, ("", 0))[1]
+        since = time.time() - days * 86400 if days else None
+        return sorted(
+            uid for uid, info in user_info.items()
+            if uid > after and (since is None or to_epoch(info.get("last_activity")) >= since)
+        )
+
+    async def deliver(self, user_id: int, from_chat_id: int, message_id: int) -> str:
+        """Отправляет копию одному пользователю: sent, unreachable или failed"""
+        try:
+            await bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+            return "sent"
+        except TelegramForbiddenError as e:
+            reason = str(e)
+        except TelegramBadRequest as e:
+            if "chat not found" not in str(e).lower():
+                logging.error(f"Ошибка рассылки пользователю {user_id}: {str(e)}")
+                return "failed"
+            reason = str(e)
+        except Exception as e:
+            logging.error(f"Ошибка рассылки пользователю {user_id}: {str(e)}")
+            return "failed"
+        storage.kv_set(UNREACHABLE_NAMESPACE, str(user_id), json.dumps({"reason": reason, "at": time.time()}))
+        return "unreachable"
+
+    async def run_part(self, payload: dict):
+        broadcast_id = payload["id"]
+        shard = shard_state["index"]
+        row = self.get(broadcast_id)
+        if row is None:
+            return
+        # Число шардов могло измениться с момента запуска рассылки
+        await self.sync_parts(broadcast_id)
+        if payload.get("shard", shard) != shard:
+            # Задача шарда, которого больше нет: своя часть этого шарда идёт своей задачей
+            await self.finish_if_done(broadcast_id)
+            return
+        _, from_chat_id, message_id, segment, _, _, _ = row
+        cursor, total = storage.query(
+            "SELECT cursor, total FROM broadcast_parts WHERE broadcast_id = ? AND shard = ?",
+            (broadcast_id, shard)
+        )[0]
+        pending = self.recipients(segment, cursor)
+        if total is None:
+            storage.execute(
+                "UPDATE broadcast_parts SET total = ? WHERE broadcast_id = ? AND shard = ?",
+                (len(pending), broadcast_id, shard)
+            )
+
+        started = time.monotonic()
+        with outbound_priority(PRIORITY_BULK):
+            for start in range(0, len(pending), config.BROADCAST_CHUNK_SIZE):
+                if self.get(broadcast_id)[4] != RUNNING:
+                    break
+                if start and (jobs.closing or time.monotonic() - started > config.BROADCAST_SLICE_SECONDS):
+                    # Уступаем воркер другим задачам и штатной остановке; продолжим с курсора
+                    raise RetryLater(0)
+                chunk = pending[start:start + config.BROADCAST_CHUNK_SIZE]
+                results = await asyncio.gather(*(self.deliver(uid, from_chat_id, message_id) for uid in chunk))
+                storage.execute(
+                    "UPDATE broadcast_parts SET cursor = ?, sent = sent + ?, failed = failed + ?, "
+                    "unreachable = unreachable + ? WHERE broadcast_id = ? AND shard = ?",
+                    (chunk[-1], results.count("sent"), results.count("failed"), results.count("unreachable"),
+                     broadcast_id, shard)
+                )
+                await self.report(broadcast_id)
+
+        storage.execute(
+            "UPDATE broadcast_parts SET done = 1 WHERE broadcast_id = ? AND shard = ?", (broadcast_id, shard)
+        )
+        await self.finish_if_done(broadcast_id)
+
+    async def finish_if_done(self, broadcast_id: int):
+        remaining = storage.query(
+            "SELECT COUNT(*) FROM broadcast_parts WHERE broadcast_id = ? AND done = 0", (broadcast_id,)
+        )[0][0]
+        if remaining == 0:
+            storage.execute("UPDATE broadcasts SET status = ? WHERE id = ? AND status = ?", (DONE, broadcast_id, RUNNING))
+            await self.report(broadcast_id, final=True)
+
+    async def report(self, broadcast_id: int, final: bool = False):
+        """Обновляет сообщение с прогрессом у администратора. Из всех шардов
+        обновляет тот, кто первым захватил интервал BROADCAST_PROGRESS_INTERVAL"""
+        now = time.time()
+        claimed = storage.execute(
+            "UPDATE broadcasts SET reported_at = ? WHERE id = ? AND reported_at <= ?",
+            (now, broadcast_id, now if final else now - config.BROADCAST_PROGRESS_INTERVAL)
+        ).rowcount
+        if not claimed:
+            return
+        row = self.get(broadcast_id)
+        if row is None or row[6] is None:
+            return
+        text, keyboard = self.progress_text(broadcast_id), self.progress_markup(broadcast_id, row[4])
+        try:
+            await bot.edit_message_text(text, chat_id=row[5], message_id=row[6], reply_markup=keyboard)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.error(f"Ошибка обновления прогресса рассылки #{broadcast_id}: {str(e)}")
+
+    def progress_text(self, broadcast_id: int) -> str:
+        row = self.get(broadcast_id)
+        total, sent, failed, unreachable, done, parts = storage.query(
+            "SELECT SUM(COALESCE(total, 0)), SUM(sent), SUM(failed), SUM(unreachable), SUM(done), COUNT(*) "
+            "FROM broadcast_parts WHERE broadcast_id = ?", (broadcast_id,)
+        )[0]
+        status = {RUNNING: "⏳ идёт", DONE: "✅ завершена", CANCELLED: "⏹ остановлена"}.get(row[4], row[4])
+        processed = sent + failed + unreachable
+        percent = processed / total * 100 if total else 0.0
+        return (
+            f"📢 Рассылка #{broadcast_id} ({BROADCAST_SEGMENTS.get(row[3], (row[3],))[0]}): {status}\n"
+            f"Обработано: {processed} из {total} ({percent:.0f}%), шардов готово {done}/{parts}\n"
+            f"✅ Доставлено: {sent}\n"
+            f"🚫 Недоступны: {unreachable}\n"
+            f"❌ Ошибки: {failed}"
+        )
+
+    def progress_markup(self, broadcast_id: int, status: str) -> InlineKeyboardMarkup:
+        if status == RUNNING:
+            buttons = [[
+                InlineKeyboardButton(text="🔄 Обновить", callback_data=f"admin_bc:status:{broadcast_id}"),
+                InlineKeyboardButton(text="⏹ Остановить", callback_data=f"admin_bc:stop:{broadcast_id}")
+            ]]
+        else:
+            buttons = []
+            unreachable = self.unreachable_count()
+            if unreachable:
+                buttons.append([InlineKeyboardButton(
+                    text=f"🧹 Удалить недоступных ({unreachable})", callback_data="admin_bc:cleanup"
+                )])
+        buttons.append([InlineKeyboardButton(text="↩️ В меню", callback_data="admin_main_menu")])
+        return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    def unreachable_count(self) -> int:
+        return storage.kv_count(UNREACHABLE_NAMESPACE)
+
+    async def request_cleanup(self):
+        """Удаление данных недоступных пользователей - на каждом шарде свои"""
+        for shard in range(shard_state["count"]):
+            await jobs.enqueue_async("broadcast_cleanup", {}, shard=shard)
+
+    async def cleanup(self, payload: dict):
+        removed = 0
+        for key, value in storage.kv_items(UNREACHABLE_NAMESPACE):
+            user_id = int(key)
+            if not owns_key(user_id):
+                continue
+            storage.kv_delete(UNREACHABLE_NAMESPACE, key)
+            info = user_info.get(user_id)
+            # Пользователь мог вернуться после неудачной доставки
+            if info is None or to_epoch(info.get("last_activity")) > json.loads(value)["at"]:
+                continue
+            del user_info[user_id]
+            user_settings.pop(user_id, None)
+            clear_history(user_id)
+            user_index.mark(user_id)
+            removed += 1
+        if removed:
+            save_users()
+        logging.info(f"Удалены данные недоступных пользователей: {removed}")
+
+
+broadcaster = Broadcaster()
+jobs.handler("broadcast")(broadcaster.run_part)
+jobs.handler("broadcast_cleanup")(broadcaster.cleanup)
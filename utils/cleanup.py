@@ -1,17 +1,15 @@
 # utils/cleanup.py
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from database import temp_file_store
+import config
+from utils.expiring import expiring_stores
 
-# Функция очистки временного хранилища
+# Функция очистки временных данных: каждый словарь удаляет только истёкшие записи
 async def cleanup_temp_store():
     while True:
-        now = datetime.now()
-        expired = [
-            key for key, data in temp_file_store.items()
-            if (now - data["timestamp"]).total_seconds() > 86400  # 24 часа
-        ]
-        for key in expired:
-            del temp_file_store[key]
-        await asyncio.sleep(3600)  # Проверяем каждые 1 час
\ No newline at end of file
+        await asyncio.sleep(config.EPHEMERAL_SWEEP_INTERVAL)
+        for store in expiring_stores:
+            try:
+                store.expire()
+            except Exception as e:
+                logging.error(f"Ошибка очистки {store.name}: {str(e)}")
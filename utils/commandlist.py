@@ -16,6 +16,7 @@ admin_commands = user_commands + [
     BotCommand(command="translatetoeng", description="🔍 Перевести текст на Английский"),
     BotCommand(command="generateaudio", description="🎙️ Сгенерировать аудио из текста"),
     BotCommand(command="transcribe", description="🎤 Распознать речь из аудиофайла"),
+    BotCommand(command="voicechat", description="🗣 Голосовой режим общения"),
     BotCommand(command="imagesettings", description="⚙️ Настройки изображения"),
     BotCommand(command="analysissettings", description="🔎 Настройки анализа"),
     BotCommand(command="help", description="📝 Список команд"),
@@ -36,6 +37,7 @@ ADMIN_HELP_TXT = """
 ============================
 /provider - 🔄 Модель GPT
 /imagesettings - ⚙️ Настройки изображения
+/voicechat - 🗣 Голосовой режим
 ============================
 /clear - 🧹 Очистка истории
 """
@@ -11,13 +11,17 @@ from database import (  save_users, load_users, save_blocked_users,
                         image_requests, last_image_requests,
                         user_states, admin_states, blocked_users,
                         user_analysis_states, user_analysis_settings,
-                        user_transcribe_states)
+                        user_transcribe_states, pending_chat_messages)
 from services.admin import is_admin
 from utils.commandlist import user_commands, admin_commands, ADMIN_HELP_TXT, USER_HELP_TXT
 from utils.helpers import translate_to_english, translate_to_russian
 from services.tgapi import bot
+from utils.inflight import inflight
+from utils.jobqueue import jobs
+from utils.dispatch import StateRouter
+from utils.history_stats import clear_history
 
-router = Router()
+router = StateRouter()
 
 ##########################################
 ########### Обработчики команд ###########
@@ -32,7 +36,7 @@ async def set_commands_for_user(user_id: int):
 
 
 # Модифицированный обработчик /start
-@router.message(Command("start"))
+@router.command("start")
 async def cmd_start(message: Message):
     user_id = message.from_user.id
     user_states[user_id] = None  # Сбрасываем состояние
@@ -41,21 +45,27 @@ async def cmd_start(message: Message):
     await message.answer("Привет! Я бот с функциями AI. Могу общаться и генерировать изображения, если нужна дополнительная информация используйте /help.")
 
 # Обработчик команды /clear
-@router.message(Command("clear"))
+@router.command("clear")
 async def cmd_clear(message: Message):
     user_id = message.from_user.id
-    if user_id in user_history:
-        del user_history[user_id]
+    # Выполняющиеся запросы и фоновые задачи (транскрибация) пользователя
+    cancelled = inflight.cancel(user_id, reason="clear") + jobs.cancel_queued(user_id)
+    for key in [key for key in pending_chat_messages if key[1] == user_id]:
+        pending_chat_messages.pop(key, None)
+    clear_history(user_id)
     user_settings[user_id] = {
         "model": "flux",
         "width": 1080,
         "height": 1920
     }
-    await message.answer("✅ История диалога очищена и настройки сброшены на значения по умолчанию.")
+    text = "✅ История диалога очищена и настройки сброшены на значения по умолчанию."
+    if cancelled:
+        text += f"\nОстановлено незавершённых запросов: {cancelled}"
+    await message.answer(text)
 
 
 # Модифицированный обработчик /help
-@router.message(Command("help"))
+@router.command("help")
 async def cmd_help(message: Message):
     user_id = message.from_user.id
     await set_commands_for_user(user_id)  # Обновляем команды при запросе помощи
@@ -65,7 +75,7 @@ async def cmd_help(message: Message):
         help_text = USER_HELP_TXT
     await message.answer(help_text)
 
-@router.message(Command("translate"))
+@router.command("translate")
 async def cmd_translate(message: Message):
     if not message.reply_to_message or not message.reply_to_message.text:
         await message.answer("❌ Ответьте на текстовое сообщение командой `/translate`")
@@ -81,7 +91,7 @@ async def cmd_translate(message: Message):
     )
 
 # Обработчик команды /image
-@router.message(Command("image"))
+@router.command("image")
 async def cmd_image(message: Message):
     await message.answer("🖼 Пожалуйста, введите описание изображения, которое вы хотите сгенерировать:")
     user_id = message.from_user.id
@@ -90,7 +100,7 @@ async def cmd_image(message: Message):
     image_requests[user_id] = []  # Инициализируем историю запросов на изображение
 
 # Обработчик /provider
-@router.message(Command("provider"))
+@router.command("provider")
 async def cmd_provider(message: Message):
     user_id = message.from_user.id
     current = user_settings.get(user_id, {}).get("provider", config.DEFAULT_PROVIDER)
@@ -103,13 +113,13 @@ async def cmd_provider(message: Message):
     await message.answer("Выберите провайдера для текста:", reply_markup=keyboard)
 
 # Обработчик команды /maketext
-@router.message(Command("maketext"))
+@router.command("maketext")
 async def cmd_maketext(message: Message):
     # Сохраняем сообщение, чтобы удалить его позже
     sent_message = await message.answer("🎤 Пожалуйста, отправьте аудиофайл (форматы: aac, amr, flac, m4a, mp3, mp4, mpeg, ogg, wav) до 512Mb.")
     user_states[message.from_user.id] = "waiting_for_audio_file"  # Устанавливаем состояние ожидания
 
-@router.message(Command("translatetoeng"))
+@router.command("translatetoeng")
 async def cmd_translate(message: Message):
     if not message.reply_to_message or not message.reply_to_message.text:
         await message.answer("❌ Ответьте на текстовое сообщение командой `/translatetoeng`")
@@ -123,7 +133,7 @@ async def cmd_translate(message: Message):
         f"{translated_text}"
     )
 
-@router.message(Command("translatetoru"))
+@router.command("translatetoru")
 async def cmd_translate(message: Message):
     if not message.reply_to_message or not message.reply_to_message.text:
         await message.answer("❌ Ответьте на текстовое сообщение командой `/translatetoru`")
@@ -138,7 +148,7 @@ async def cmd_translate(message: Message):
     )
 
 # Обработчик выбора провайдера
-@router.callback_query(lambda query: query.data.startswith("provider_"))
+@router.callback(prefix="provider_")
 async def handle_provider_selection(query: CallbackQuery):
     user_id = query.from_user.id
     provider_name = query.data.split("_", 1)[1]
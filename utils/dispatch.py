@@ -0,0 +1,197 @@
+# utils/dispatch.py
+import logging
+from aiogram import Bot, Router
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.types import Message, CallbackQuery
+from config import ADMINS
+from database import (user_states, user_settings, admin_states, blocked_users,
+                      user_analysis_states, user_transcribe_states)
+
+#####################################################
+########### Диспетчер по состояниям #################
+
+# Типы содержимого сообщения
+TEXT = "text"
+IMAGE = "image"                    # фото или документ-изображение
+VOICE = "voice"                    # голосовое или аудиосообщение
+AUDIO_DOCUMENT = "audio_document"  # аудиофайл, отправленный документом
+OTHER = "other"
+ANY = "*"
+
+# Состояния пользователя
+ADMIN_INPUT = "admin_input"              # администратор вводит данные для действия админки
+BLOCKED = "blocked"
+AUDIO_TRANSCRIBE = "audio_transcribe"    # ждём аудио после /transcribe
+VOICE_CHAT = "voice_chat"                # включён голосовой режим
+IMAGE_DESCRIPTION = "image_description"  # ждём описание изображения
+IMAGE_ANALYSIS = "image_analysis"        # ждём изображение после /analyze
+ADMIN_REPLY = "admin_reply"              # ответ на сообщение администратора
+
+
+def is_blocked(user_id: int) -> bool:
+    # В блок-листе встречаются и числовые, и строковые ключи (после загрузки из JSON)
+    return user_id in blocked_users or str(user_id) in blocked_users
+
+
+def _reply_author(message: Message):
+    reply = message.reply_to_message
+    return reply.from_user.id if reply and reply.from_user else None
+
+
+# Проверки состояний в порядке приоритета: выигрывает первое состояние,
+# для которого есть обработчик этого типа содержимого
+STATE_CHECKS = (
+    (ADMIN_INPUT, lambda user_id, message: user_id in ADMINS and user_id in admin_states),
+    (BLOCKED, lambda user_id, message: is_blocked(user_id)),
+    (AUDIO_TRANSCRIBE, lambda user_id, message: user_transcribe_states.get(user_id) == "waiting_for_audio_transcribe"),
+    (VOICE_CHAT, lambda user_id, message: bool(user_settings.get(user_id, {}).get("voice_chat"))),
+    (IMAGE_DESCRIPTION, lambda user_id, message: user_states.get(user_id) == "waiting_for_image_description"),
+    (IMAGE_ANALYSIS, lambda user_id, message: user_analysis_states.get(user_id) == "waiting_for_image_analysis"),
+    (ADMIN_REPLY, lambda user_id, message: _reply_author(message) in ADMINS),
+)
+# Состояния, которые действуют и на команды
+COMMAND_STATES = (BLOCKED,)
+
+
+def content_type(message: Message) -> str:
+    if message.text:
+        return TEXT
+    if message.photo:
+        return IMAGE
+    if message.voice or message.audio:
+        return VOICE
+    if message.document:
+        mime_type = message.document.mime_type or ""
+        if mime_type.startswith("image/"):
+            return IMAGE
+        if mime_type.startswith("audio/"):
+            return AUDIO_DOCUMENT
+    return OTHER
+
+
+# Допустимые окончания префиксов callback data
+PREFIX_SEPARATORS = ("_", ":")
+
+
+class StateRouter:
+    """Обработчики одного модуля; попадают в общий индекс через StateDispatcher.include_router"""
+
+    def __init__(self):
+        self.commands = []   # (команда, обработчик)
+        self.messages = []   # (состояние, тип содержимого, обработчик)
+        self.callbacks = []  # (data или префикс, это префикс, обработчик)
+
+    def command(self, *names: str):
+        def decorator(handler):
+            self.commands.extend((name, handler) for name in names)
+            return handler
+        return decorator
+
+    def message(self, *contents: str, state: str = None):
+        """Сообщение с одним из типов содержимого; state=None - пользователь без особого состояния"""
+        def decorator(handler):
+            self.messages.extend((state, content, handler) for content in contents)
+            return handler
+        return decorator
+
+    def callback(self, data: str = None, prefix: str = None):
+        """Точное значение callback data или префикс, заканчивающийся на "_" или ":" """
+        if prefix is not None and prefix[-1:] not in PREFIX_SEPARATORS:
+            raise ValueError(f"Префикс callback должен заканчиваться на _ или : ({prefix})")
+        def decorator(handler):
+            if data is not None:
+                self.callbacks.append((data, False, handler))
+            if prefix is not None:
+                self.callbacks.append((prefix, True, handler))
+            return handler
+        return decorator
+
+
+class StateDispatcher:
+    """Единственный обработчик сообщений и callback-запросов в aiogram.
+
+    Обработчик выбирается по индексам, а не перебором фильтров:
+    команда -> обработчик; (состояние, тип содержимого) -> обработчик;
+    callback data -> обработчик, затем префиксы data от длинного к короткому.
+    Стоимость выбора не зависит от числа зарегистрированных обработчиков.
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.handlers = {}          # (состояние, тип содержимого) -> обработчик
+        self.callbacks = {}
+        self.callback_prefixes = {}
+        self.router = Router(name="state_dispatch")
+        self.router.message.register(self.on_message)
+        self.router.callback_query.register(self.on_callback)
+
+    @staticmethod
+    def _add(index: dict, key, handler):
+        if key in index:
+            raise ValueError(f"Обработчик для {key} уже зарегистрирован: {index[key].__qualname__}")
+        index[key] = handler
+
+    def include_router(self, router: StateRouter):
+        for name, handler in router.commands:
+            self._add(self.commands, name, handler)
+        for state, content, handler in router.messages:
+            self._add(self.handlers, (state, content), handler)
+        for data, is_prefix, handler in router.callbacks:
+            self._add(self.callback_prefixes if is_prefix else self.callbacks, data, handler)
+
+    def _lookup(self, state, content):
+        return self.handlers.get((state, content)) or self.handlers.get((state, ANY))
+
+    async def resolve_command(self, message: Message, bot: Bot):
+        text = message.text or ""
+        if not text.startswith("/"):
+            return None
+        name, _, mention = text.split(maxsplit=1)[0][1:].partition("@")
+        handler = self.commands.get(name)
+        if handler is not None and mention:
+            # Команда другому боту в группе
+            me = await bot.me()
+            if not me.username or mention.lower() != me.username.lower():
+                return None
+        return handler
+
+    async def resolve_message(self, message: Message, bot: Bot):
+        content = content_type(message)
+        user_id = message.from_user.id if message.from_user else None
+        command = await self.resolve_command(message, bot)
+        if user_id is not None:
+            for state, check in STATE_CHECKS:
+                if command is not None and state not in COMMAND_STATES:
+                    continue
+                # Сначала индекс: проверка состояния может обращаться к общему хранилищу
+                handler = self._lookup(state, content)
+                if handler is not None and check(user_id, message):
+                    return handler
+        return command or self._lookup(None, content)
+
+    def resolve_callback(self, data: str):
+        handler = self.callbacks.get(data)
+        if handler is not None:
+            return handler
+        for i in range(len(data) - 1, -1, -1):
+            if data[i] in PREFIX_SEPARATORS:
+                handler = self.callback_prefixes.get(data[:i + 1])
+                if handler is not None:
+                    return handler
+        return None
+
+    async def on_message(self, message: Message, bot: Bot):
+        handler = await self.resolve_message(message, bot)
+        if handler is None:
+            raise SkipHandler()
+        return await handler(message)
+
+    async def on_callback(self, callback: CallbackQuery):
+        handler = self.resolve_callback(callback.data or "")
+        if handler is None:
+            logging.warning(f"Нет обработчика для callback: {callback.data}")
+            raise SkipHandler()
+        return await handler(callback)
+
+
+state_dispatcher = StateDispatcher()
@@ -0,0 +1,145 @@
+# utils/expiring.py
+import time
+import heapq
+import itertools
+from collections.abc import MutableMapping
+
+#####################################################
+########### Словари с временем жизни ################
+
+# Все словари с истечением срока: их обходит фоновая очистка и статистика админки
+expiring_stores = []
+
+
+def register_expiring(store):
+    """Добавляет словарь в общую очистку. Нужны name, stats и expire()"""
+    expiring_stores.append(store)
+    return store
+
+
+class ExpiringDict(MutableMapping):
+    """Словарь, записи которого живут ttl секунд.
+
+    Сроки лежат в min-куче (срок, номер, ключ), поэтому удаление истёкших
+    записей стоит O(log n) на запись, без обхода всего словаря. sliding=True
+    продлевает срок при каждом чтении: новый срок пишется только в словарь
+    сроков, а запись кучи переставляется, когда доходит до вершины - так на
+    ключ всегда приходится одна живая запись в куче. При превышении max_size
+    вытесняется запись с ближайшим сроком.
+    Изменения вложенных объектов (список, set) срок не продлевают - только
+    присваивание или чтение через [] / get() при sliding=True.
+    """
+
+    def __init__(self, name: str, ttl: float, max_size: int = None, sliding: bool = False):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sliding = sliding
+        self.data = {}
+        self.expiry = {}  # ключ -> [срок, номер записи в куче]
+        self.heap = []    # (срок на момент добавления, номер, ключ)
+        self.counter = itertools.count()
+        self.stats = {"expired": 0, "evicted": 0}
+        register_expiring(self)
+
+    def _alive(self, key, now: float) -> bool:
+        entry = self.expiry.get(key)
+        if entry is None:
+            return False
+        if entry[0] <= now:
+            self._remove(key)
+            self.stats["expired"] += 1
+            return False
+        return True
+
+    def _remove(self, key):
+        # Запись в куче остаётся и пропускается при извлечении по номеру
+        del self.data[key]
+        del self.expiry[key]
+
+    def _pop_earliest(self, now: float = None):
+        """Снимает с кучи запись с ближайшим сроком; при now - только истёкшую.
+        Возвращает ключ или None"""
+        heap = self.heap
+        while heap:
+            deadline, seq, key = heap[0]
+            entry = self.expiry.get(key)
+            if entry is None or entry[1] != seq:
+                heapq.heappop(heap)
+                continue
+            if entry[0] > deadline:
+                # Срок продлевали: переставляем запись на актуальное место
+                heapq.heapreplace(heap, (entry[0], seq, key))
+                continue
+            if now is not None and deadline > now:
+                return None
+            heapq.heappop(heap)
+            return key
+        return None
+
+    def expire(self, now: float = None) -> int:
+        """Удаляет истёкшие записи, возвращает их количество"""
+        now = time.monotonic() if now is None else now
+        removed = 0
+        while (key := self._pop_earliest(now)) is not None:
+            self._remove(key)
+            removed += 1
+        self.stats["expired"] += removed
+        # Записи удалённых ключей копятся в куче, пересобираем её при раздувании
+        if len(self.heap) > 2 * len(self.data) + 64:
+            self.heap = [(entry[0], entry[1], key) for key, entry in self.expiry.items()]
+            heapq.heapify(self.heap)
+        return removed
+
+    def __getitem__(self, key):
+        now = time.monotonic()
+        if not self._alive(key, now):
+            raise KeyError(key)
+        if self.sliding:
+            self.expiry[key][0] = now + self.ttl
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        entry = self.expiry.get(key)
+        if entry is not None:
+            entry[0] = now + self.ttl
+        else:
+            seq = next(self.counter)
+            self.expiry[key] = [now + self.ttl, seq]
+            heapq.heappush(self.heap, (now + self.ttl, seq, key))
+        self.data[key] = value
+        self.expire(now)
+        if self.max_size is not None:
+            while len(self.data) > self.max_size:
+                self._remove(self._pop_earliest())
+                self.stats["evicted"] += 1
+
+    def __delitem__(self, key):
+        if not self._alive(key, time.monotonic()):
+            raise KeyError(key)
+        self._remove(key)
+
+    def __contains__(self, key):
+        # Проверка наличия срок не продлевает
+        return self._alive(key, time.monotonic())
+
+    def __iter__(self):
+        self.expire()
+        return iter(list(self.data))
+
+    def __len__(self):
+        self.expire()
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+        self.expiry.clear()
+        self.heap.clear()
+
+
+def expiring_stats_text() -> str:
+    lines = ["🧹 Временные данные (записей / истекло / вытеснено):"]
+    for store in expiring_stores:
+        lines.append(f"• {store.name}: {len(store)} / {store.stats['expired']} / {store.stats['evicted']}")
+    return "\n".join(lines)
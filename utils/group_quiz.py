@@ -0,0 +1,379 @@
+# utils/group_quiz.py
+import json
+import time
+import heapq
+import asyncio
+import logging
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+import config
+from services.tgapi import bot
+from database import owns_key
+from utils.storage import storage
+from utils.timer_wheel import TimerWheel
+
+#####################################################
+########### Групповая викторина #####################
+
+# Этапы игры
+LOBBY = "lobby"        # Сбор игроков
+QUESTION = "question"  # Идёт приём ответов
+REVEAL = "reveal"      # Ответ показан, пауза перед следующим вопросом
+
+# Таймеры игры - ключи (вид, chat_id) в колесе
+DEADLINE = "deadline"  # Конец текущего этапа
+BOARD = "board"        # Отложенное обновление сообщения игры
+
+# Имён игроков в одном сообщении, не больше
+NAMES_SHOWN = 15
+
+
+class GroupQuiz:
+    """Групповые викторины всех чатов процесса.
+
+    Игра - компактный словарь (игроки id -> [имя, очки], текущий вопрос,
+    ответы, срок этапа), копия которого лежит в таблице group_quiz, поэтому
+    идущие игры переживают перезапуск. Вопрос с кнопками - одно сообщение;
+    отвечают все игроки сразу, пока не истёк срок или пока не ответили все.
+    Сроки всех игр и отложенные обновления - таймеры одного колеса, а не
+    задача на чат. Ответ только меняет словарь: число ответивших в сообщении
+    игры обновляется одной правкой не чаще раза в GROUP_QUIZ_BOARD_INTERVAL.
+    """
+
+    def __init__(self):
+        self.games = {}   # chat_id -> игра
+        self.locks = {}   # chat_id -> блокировка: сообщения игры меняет один обработчик
+        self.wheel = TimerWheel("⏱ Таймеры викторин", config.GROUP_QUIZ_TICK, config.GROUP_QUIZ_WHEEL_SLOTS)
+        self.wheel.on_fire(self.on_timer)
+        self.source = None
+        self.schema_ready = False
+        self.stats = {"games": 0, "questions": 0, "answers": 0}
+
+    def question_source(self, source):
+        """async source(chat_id, category) -> вопрос или None"""
+        self.source = source
+        return source
+
+    #####################################################
+    # Хранение
+
+    def ensure_schema(self):
+        if self.schema_ready:
+            return
+        storage.execute("CREATE TABLE IF NOT EXISTS group_quiz (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL)")
+        self.schema_ready = True
+
+    def _snapshot(self, chat_id: int):
+        game = self.games.get(chat_id)
+        return None if game is None else json.dumps(game, ensure_ascii=False)
+
+    def _write(self, chat_id: int, state):
+        self.ensure_schema()
+        if state is None:
+            storage.execute("DELETE FROM group_quiz WHERE chat_id = ?", (chat_id,))
+        else:
+            storage.execute("INSERT OR REPLACE INTO group_quiz (chat_id, state) VALUES (?, ?)", (chat_id, state))
+
+    def save(self, chat_id: int):
+        self._write(chat_id, self._snapshot(chat_id))
+
+    async def save_async(self, chat_id: int):
+        """Снимок игры берётся в цикле событий, запись в SQLite - в потоке.
+        Этапы одной игры идут под её блокировкой, поэтому записи не обгоняют друг друга"""
+        await asyncio.to_thread(self._write, chat_id, self._snapshot(chat_id))
+
+    def save_all(self):
+        """Сохраняет ответы, ещё не записанные отложенным обновлением"""
+        for chat_id in list(self.games):
+            self.save(chat_id)
+
+    def restore(self):
+        """Загружает игры своих чатов после перезапуска и ставит их сроки"""
+        self.ensure_schema()
+        for chat_id, state in storage.query("SELECT chat_id, state FROM group_quiz"):
+            if not owns_key(chat_id):
+                continue
+            game = self.games[chat_id] = json.loads(state)
+            self.wheel.schedule((DEADLINE, chat_id), game["deadline"])
+        if self.games:
+            logging.info(f"Восстановлено групповых викторин: {len(self.games)}")
+
+    #####################################################
+    # Действия игроков
+
+    async def create(self, chat_id: int, host_id: int, host_name: str, category: str) -> bool:
+        if chat_id in self.games:
+            return False
+        game = self.games[chat_id] = {
+            "status": LOBBY,
+            "category": category,
+            "host": host_id,
+            "players": {str(host_id): [host_name, 0]},
+            "round": 0,
+            "question": None,
+            "answers": {},
+            "deadline": 0,
+            "message_id": None,
+        }
+        try:
+            message = await bot.send_message(chat_id, self.lobby_text(game), reply_markup=self.lobby_markup())
+        except Exception:
+            self.games.pop(chat_id, None)
+            raise
+        game["message_id"] = message.message_id
+        self.stats["games"] += 1
+        self.set_deadline(chat_id, game, time.time() + config.GROUP_QUIZ_LOBBY_SECONDS)
+        await self.save_async(chat_id)
+        return True
+
+    def join(self, chat_id: int, user_id: int, name: str) -> str:
+        game = self.games.get(chat_id)
+        if game is None:
+            return "❌ Викторина не начата."
+        if str(user_id) in game["players"]:
+            return "Вы уже участвуете!"
+        game["players"][str(user_id)] = [name, 0]
+        self.touch(chat_id)
+        return "Вы присоединились к викторине!"
+
+    def answer(self, chat_id: int, user_id: int, name: str, round_: int, letter: str) -> str:
+        game = self.games.get(chat_id)
+        if game is None or game["status"] != QUESTION or game["round"] != round_:
+            return "⌛ Этот вопрос уже закрыт."
+        key = str(user_id)
+        if key in game["answers"]:
+            return "Ваш ответ уже принят."
+        # Ответ без нажатия «Присоединиться» тоже засчитывается
+        game["players"].setdefault(key, [name, 0])
+        game["answers"][key] = letter
+        self.stats["answers"] += 1
+        if len(game["answers"]) >= len(game["players"]):
+            # Ответили все - не ждём конца срока
+            self.set_deadline(chat_id, game, time.time())
+        else:
+            self.touch(chat_id)
+        return "✅ Ответ принят."
+
+    def start_now(self, chat_id: int, user_id: int) -> str:
+        """Начать игру (в лобби) или закрыть текущий вопрос досрочно - только ведущий"""
+        game = self.games.get(chat_id)
+        if game is None:
+            return "❌ Викторина не начата."
+        if user_id != game["host"]:
+            return "Это может сделать только тот, кто начал викторину."
+        if game["status"] not in (LOBBY, QUESTION):
+            return "Следующий вопрос уже загружается."
+        self.set_deadline(chat_id, game, time.time())
+        return "▶️ Поехали!"
+
+    async def stop(self, chat_id: int, user_id: int) -> str:
+        game = self.games.get(chat_id)
+        if game is None:
+            return "❌ Викторина не идёт."
+        if user_id != game["host"]:
+            return "Остановить викторину может только тот, кто её начал."
+        async with self.lock(chat_id):
+            if self.games.get(chat_id) is game:
+                await self.finish(chat_id, game)
+        return "🛑 Викторина остановлена."
+
+    #####################################################
+    # Таймеры
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        return self.locks.setdefault(chat_id, asyncio.Lock())
+
+    def set_deadline(self, chat_id: int, game: dict, when: float):
+        game["deadline"] = when
+        self.wheel.schedule((DEADLINE, chat_id), when)
+
+    def touch(self, chat_id: int):
+        """Обновление сообщения игры откладывается: все изменения за интервал - одна правка"""
+        if (BOARD, chat_id) not in self.wheel:
+            self.wheel.schedule((BOARD, chat_id), time.time() + config.GROUP_QUIZ_BOARD_INTERVAL)
+
+    async def on_timer(self, key):
+        kind, chat_id = key
+        game = self.games.get(chat_id)
+        if game is None:
+            return
+        async with self.lock(chat_id):
+            if self.games.get(chat_id) is not game:
+                return
+            try:
+                if kind == BOARD:
+                    await self.update_board(chat_id, game)
+                elif time.time() < game["deadline"]:
+                    # Срок перенесли, пока ждали блокировку
+                    return
+                elif game["status"] == QUESTION:
+                    await self.reveal(chat_id, game)
+                elif game["status"] == LOBBY:
+                    await self.begin(chat_id, game)
+                else:
+                    await self.ask(chat_id, game)
+                if kind == DEADLINE:
+                    game.pop("failures", None)
+            except TelegramForbiddenError as e:
+                # Бота удалили из чата - игру продолжать некому
+                logging.warning(f"Групповая викторина в чате {chat_id} прервана: {str(e)}")
+                await self.drop(chat_id)
+            except Exception as e:
+                if kind == BOARD:
+                    # Табло обновится при следующем изменении или смене этапа
+                    logging.warning(f"Не удалось обновить табло викторины в чате {chat_id}: {str(e)}")
+                else:
+                    await self.stage_failed(chat_id, game, e)
+
+    async def stage_failed(self, chat_id: int, game: dict, error: Exception):
+        """Этап не прошёл: без нового срока игра зависла бы до /stopquiz.
+        Повторяем этап с растущей паузой, после GROUP_QUIZ_MAX_RETRIES - завершаем игру"""
+        if self.games.get(chat_id) is not game:
+            return  # Игра уже завершена этапом, который упал на последнем сообщении
+        failures = game["failures"] = game.get("failures", 0) + 1
+        if failures <= config.GROUP_QUIZ_MAX_RETRIES:
+            logging.warning(f"Ошибка этапа викторины в чате {chat_id} (попытка {failures}): {str(error)}")
+            self.set_deadline(chat_id, game, time.time() + config.GROUP_QUIZ_RETRY_DELAY * 2 ** (failures - 1))
+            await self.save_async(chat_id)
+            return
+        logging.error(f"Групповая викторина в чате {chat_id} завершена после ошибок: {str(error)}")
+        try:
+            await self.finish(chat_id, game)
+        except Exception as e:
+            # Игра уже удалена, не удалось только отправить итоги
+            logging.warning(f"Не удалось отправить итоги викторины в чате {chat_id}: {str(e)}")
+
+    #####################################################
+    # Этапы игры
+
+    async def update_board(self, chat_id: int, game: dict):
+        if game["status"] == LOBBY:
+            await self.edit(chat_id, game, self.lobby_text(game), self.lobby_markup())
+        elif game["status"] == QUESTION:
+            await self.edit(chat_id, game, self.question_text(game), self.question_markup(game))
+        await self.save_async(chat_id)
+
+    async def begin(self, chat_id: int, game: dict):
+        self.wheel.cancel((BOARD, chat_id))
+        await self.edit(chat_id, game, self.lobby_text(game, started=True))
+        await self.ask(chat_id, game)
+
+    async def ask(self, chat_id: int, game: dict):
+        question = await self.source(chat_id, game["category"])
+        if question is None:
+            await bot.send_message(chat_id, "⚠️ Не удалось загрузить вопрос, викторина завершена.")
+            await self.finish(chat_id, game)
+            return
+        game.update(status=QUESTION, round=game["round"] + 1, question=question, answers={})
+        message = await bot.send_message(chat_id, self.question_text(game), reply_markup=self.question_markup(game))
+        game["message_id"] = message.message_id
+        self.stats["questions"] += 1
+        self.set_deadline(chat_id, game, time.time() + config.GROUP_QUIZ_ANSWER_SECONDS)
+        await self.save_async(chat_id)
+
+    async def reveal(self, chat_id: int, game: dict):
+        self.wheel.cancel((BOARD, chat_id))
+        correct = game["question"]["correct"]
+        winners = [key for key, letter in game["answers"].items() if letter == correct]
+        for key in winners:
+            game["players"][key][1] += 1
+        game["status"] = REVEAL
+        await self.edit(chat_id, game, self.reveal_text(game, winners))
+        if game["round"] >= config.GROUP_QUIZ_QUESTIONS:
+            await self.finish(chat_id, game)
+            return
+        self.set_deadline(chat_id, game, time.time() + config.GROUP_QUIZ_PAUSE_SECONDS)
+        await self.save_async(chat_id)
+
+    async def finish(self, chat_id: int, game: dict):
+        await self.drop(chat_id)
+        if game["round"]:
+            await bot.send_message(chat_id, self.results_text(game))
+        else:
+            await self.edit(chat_id, game, "❌ Викторина отменена.")
+
+    async def drop(self, chat_id: int):
+        self.games.pop(chat_id, None)
+        self.locks.pop(chat_id, None)
+        self.wheel.cancel((DEADLINE, chat_id))
+        self.wheel.cancel((BOARD, chat_id))
+        await self.save_async(chat_id)
+
+    async def edit(self, chat_id: int, game: dict, text: str, markup: InlineKeyboardMarkup = None):
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=game["message_id"], reply_markup=markup)
+        except TelegramBadRequest as e:
+            # Сообщение не изменилось или удалено - игра продолжается
+            if "message is not modified" not in str(e):
+                logging.warning(f"Не удалось обновить сообщение викторины в чате {chat_id}: {str(e)}")
+
+    #####################################################
+    # Тексты и кнопки
+
+    @staticmethod
+    def names(players: dict, keys) -> str:
+        keys = list(keys)
+        shown = ", ".join(players[key][0] for key in keys[:NAMES_SHOWN])
+        return shown + (f" и ещё {len(keys) - NAMES_SHOWN}" if len(keys) > NAMES_SHOWN else "")
+
+    def lobby_text(self, game: dict, started: bool = False) -> str:
+        text = (
+            f"🎮 Викторина для группы: {game['category']}\n"
+            f"Вопросов: {config.GROUP_QUIZ_QUESTIONS}, на ответ {config.GROUP_QUIZ_ANSWER_SECONDS} сек.\n\n"
+            f"Игроки ({len(game['players'])}): {self.names(game['players'], game['players'])}\n\n"
+        )
+        if started:
+            return text + "▶️ Игра началась!"
+        return text + (
+            f"Нажмите «Присоединиться». Игра начнётся через {config.GROUP_QUIZ_LOBBY_SECONDS} сек "
+            f"или по кнопке «Начать»."
+        )
+
+    @staticmethod
+    def lobby_markup() -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Присоединиться", callback_data="gquiz:join")],
+            [InlineKeyboardButton(text="▶️ Начать", callback_data="gquiz:start"),
+             InlineKeyboardButton(text="❌ Отмена", callback_data="gquiz:stop")]
+        ])
+
+    def question_text(self, game: dict) -> str:
+        return (
+            f"👥 Вопрос {game['round']}/{config.GROUP_QUIZ_QUESTIONS}:\n{game['question']['question']}\n\n"
+            f"⏳ На ответ {config.GROUP_QUIZ_ANSWER_SECONDS} сек. "
+            f"Ответили: {len(game['answers'])} из {len(game['players'])}"
+        )
+
+    @staticmethod
+    def question_markup(game: dict) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"{key}) {value}", callback_data=f"gquiz:answer:{game['round']}:{key}")]
+            for key, value in game["question"]["options"].items()
+        ])
+
+    def reveal_text(self, game: dict, winners: list) -> str:
+        question = game["question"]
+        correct = question["correct"]
+        return (
+            f"👥 Вопрос {game['round']}/{config.GROUP_QUIZ_QUESTIONS}:\n{question['question']}\n\n"
+            f"✅ Правильный ответ: {correct}) {question['options'].get(correct, '')}\n"
+            f"Угадали ({len(winners)} из {len(game['answers'])}): {self.names(game['players'], winners) or '—'}\n\n"
+            f"{self.standings(game)}"
+        )
+
+    @staticmethod
+    def standings(game: dict, top: int = 5) -> str:
+        leaders = heapq.nlargest(top, game["players"].values(), key=lambda player: player[1])
+        return "\n".join(f"{place}. {name}: {score}" for place, (name, score) in enumerate(leaders, 1))
+
+    def results_text(self, game: dict) -> str:
+        return f"🏆 Результаты групповой викторины:\n\n{self.standings(game, config.GROUP_QUIZ_RESULTS_TOP)}"
+
+    def stats_text(self) -> str:
+        return (
+            f"👥 Групповые викторины: идёт {len(self.games)}, начато {self.stats['games']}, "
+            f"вопросов {self.stats['questions']}, ответов {self.stats['answers']}; {self.wheel.stats_text()}"
+        )
+
+
+group_quiz = GroupQuiz()
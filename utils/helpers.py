@@ -15,6 +15,7 @@ from bs4 import BeautifulSoup
 from pydub import AudioSegment
 from database import user_history, user_settings
 from langdetect import detect
+from utils.singleflight import translation_flight
 from database import (  save_users, load_users, save_blocked_users,
                         user_history, user_settings, user_info,
                         user_states, admin_states, blocked_users,
@@ -22,33 +23,6 @@ from database import (  save_users, load_users, save_blocked_users,
                         user_transcribe_states, temp_file_store )
 
 
-# Сохранение истории пользователя
-def save_user_info(user: types.User):
-    user_id = user.id
-    if user_id not in user_info:
-        user_info[user_id] = {
-            'username': user.username,
-            'first_name': user.first_name,
-            'last_name': user.last_name,
-            'date_joined': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'last_activity': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-    else:
-        # Обновляем только изменяемые поля
-        user_info[user_id].update({
-            'username': user.username,
-            'first_name': user.first_name,
-            'last_name': user.last_name
-        })
-
-# Обновление истории активности пользователя
-async def update_user_activity(user: types.User):
-    user_id = user.id
-    if user_id in user_info:
-        user_info[user_id]['last_activity'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    else:
-        save_user_info(user)
-
 def is_admin(user_id: int):
     return user_id in config.ADMINS
 
@@ -164,6 +138,10 @@ async def translate_to_english(text):
     if detected_lang != "ru":
         return text  # Не переводим, если не русский
     
+    # Одинаковые одновременные переводы выполняются одним запросом
+    return await translation_flight.do(text, lambda: request_translation_to_english(text))
+
+async def request_translation_to_english(text):
     try:
         # Используем рабочую модель
         async with aiohttp.ClientSession() as session:
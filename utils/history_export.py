@@ -0,0 +1,88 @@
+# utils/history_export.py
+import os
+import gzip
+import json
+import html
+from datetime import datetime, timedelta
+from database import user_history
+from utils.history_stats import HISTORY_TYPE_NAMES
+
+#####################################################
+########### Выгрузка истории в файл #################
+
+EXPORT_FORMATS = ("jsonl", "html")
+EXPORT_DIR = "temp"
+
+HTML_HEADER = """<!DOCTYPE html>
+<html lang="ru"><head><meta charset="utf-8"><title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 900px; margin: 2em auto; }}
+.entry {{ border-bottom: 1px solid #ddd; padding: .6em 0; }}
+.meta {{ color: #777; font-size: .85em; }}
+pre {{ white-space: pre-wrap; margin: .3em 0; }}
+</style></head><body><h1>{title}</h1>
+"""
+HTML_FOOTER = "<p class=\"meta\">Записей: {count}</p></body></html>\n"
+
+# Поля, которые выводятся в заголовке записи, а не в теле
+HTML_META_FIELDS = ("type", "role", "timestamp")
+
+
+def iter_entries(user_id: int, since: datetime = None, until: datetime = None, types=None):
+    """Записи истории с фильтром по датам и типам. Записи без даты
+    попадают в выгрузку только без фильтра по датам"""
+    since = since.isoformat() if since else None
+    until = until.isoformat() if until else None
+    for entry in user_history.get(user_id, ()):
+        if types and entry.get("type", "text") not in types:
+            continue
+        if since or until:
+            timestamp = str(entry.get("timestamp", ""))
+            if not timestamp or (since and timestamp < since) or (until and timestamp >= until):
+                continue
+        yield entry
+
+
+def iter_jsonl(entries):
+    for entry in entries:
+        yield json.dumps(entry, ensure_ascii=False) + "\n"
+
+
+def iter_html(entries, title: str):
+    yield HTML_HEADER.format(title=html.escape(title))
+    count = 0
+    for entry in entries:
+        count += 1
+        entry_type = entry.get("type", "text")
+        meta = " · ".join(html.escape(str(part)) for part in (
+            HISTORY_TYPE_NAMES.get(entry_type, entry_type), entry.get("role"), entry.get("timestamp")
+        ) if part)
+        body = "".join(
+            f"<pre><b>{html.escape(str(key))}:</b> {html.escape(str(value))}</pre>"
+            for key, value in entry.items() if key not in HTML_META_FIELDS
+        )
+        yield f'<div class="entry"><div class="meta">{meta}</div>{body}</div>\n'
+    yield HTML_FOOTER.format(count=count)
+
+
+def export_history(user_id: int, fmt: str, since: datetime = None, until: datetime = None, types=None) -> str:
+    """Пишет историю в сжатый gzip файл по частям, не собирая её в памяти.
+    Возвращает путь к файлу; удаляет файл вызывающий"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"history_{user_id}_{datetime.now():%Y%m%d_%H%M%S}.{fmt}.gz")
+    entries = iter_entries(user_id, since, until, types)
+    chunks = iter_jsonl(entries) if fmt == "jsonl" else iter_html(entries, f"История пользователя {user_id}")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return path
+
+
+def period_start(days: int):
+    """Начало периода в days дней, включая сегодня; 0 - без ограничения"""
+    if not days:
+        return None
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=days - 1)
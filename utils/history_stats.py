@@ -0,0 +1,197 @@
+# utils/history_stats.py
+import json
+import time
+import heapq
+import asyncio
+import logging
+from datetime import date, timedelta
+from collections import Counter
+import config
+from database import user_history, user_info, shard_state
+from utils.storage import storage
+from utils.user_index import user_index
+
+#####################################################
+########### Статистика истории ######################
+
+# Подписи типов записей истории в админке
+HISTORY_TYPE_NAMES = {
+    "text": "💬 Текст",
+    "image": "🖼 Изображения",
+    "analysis": "🔍 Анализ",
+    "transcribe": "🎤 Транскрибация",
+    "audio": "🎙️ Аудио",
+}
+
+
+class HistoryStats:
+    """Счётчики по истории, которые обновляются при каждой записи в историю.
+
+    totals - записей по типам, per_user - записей у пользователя, top -
+    пользователи с наибольшим числом записей (не больше STATS_TOP_USERS),
+    daily - дата -> записей по типам за последние STATS_DAYS дней.
+    Счётчик пользователя при добавлении только растёт, поэтому в top можно
+    попасть, лишь обогнав последнего; полный пересчёт top нужен только при
+    очистке истории. После запуска всё пересобирается из user_history один
+    раз (rebuild), дни берутся из timestamp записей.
+    """
+
+    def __init__(self, top_size: int, days: int):
+        self.top_size = top_size
+        self.days = days
+        self.totals = Counter()
+        self.per_user = Counter()
+        self.top = []      # user_id по убыванию числа записей
+        self.daily = {}    # "YYYY-MM-DD" -> Counter по типам
+
+    def rebuild(self):
+        self.totals.clear()
+        self.per_user.clear()
+        self.daily.clear()
+        first_day = (date.today() - timedelta(days=self.days - 1)).isoformat()
+        for user_id, history in user_history.items():
+            self.per_user[user_id] = len(history)
+            for entry in history:
+                entry_type = entry.get("type", "text")
+                self.totals[entry_type] += 1
+                day = str(entry.get("timestamp", ""))[:10]
+                if day >= first_day:
+                    self.daily.setdefault(day, Counter())[entry_type] += 1
+        self._rebuild_top()
+
+    def _rebuild_top(self):
+        self.top = [uid for uid, count in heapq.nlargest(self.top_size, self.per_user.items(), key=lambda x: x[1]) if count]
+
+    def add(self, user_id: int, entry: dict):
+        entry_type = entry.get("type", "text")
+        self.totals[entry_type] += 1
+        self.per_user[user_id] += 1
+        day = str(entry.get("timestamp", ""))[:10] or date.today().isoformat()
+        bucket = self.daily.get(day)
+        if bucket is None:
+            bucket = self.daily[day] = Counter()
+            self._prune_days()
+        bucket[entry_type] += 1
+        self._promote(user_id)
+
+    def _promote(self, user_id: int):
+        top = self.top
+        if user_id not in top:
+            if len(top) >= self.top_size and self.per_user[user_id] <= self.per_user[top[-1]]:
+                return
+            top.append(user_id)
+        top.sort(key=self.per_user.__getitem__, reverse=True)
+        del top[self.top_size:]
+
+    def _prune_days(self):
+        first_day = (date.today() - timedelta(days=self.days - 1)).isoformat()
+        for day in [day for day in self.daily if day < first_day]:
+            del self.daily[day]
+
+    def remove_user(self, user_id: int, history: list):
+        """Учитывает удаление истории пользователя (/clear). Суточная статистика
+        использования сохраняется до перезапуска"""
+        for entry in history:
+            self.totals[entry.get("type", "text")] -= 1
+        self.per_user.pop(user_id, None)
+        if user_id in self.top:
+            self._rebuild_top()
+
+    def usage(self, days: int, daily: dict = None) -> Counter:
+        """Записи по типам за последние days дней (включая сегодня)"""
+        daily = self.daily if daily is None else daily
+        result = Counter()
+        today = date.today()
+        for offset in range(days):
+            bucket = daily.get((today - timedelta(days=offset)).isoformat())
+            if bucket:
+                result.update(bucket)
+        return result
+
+    def usage_text(self, daily: dict = None) -> str:
+        today, week = self.usage(1, daily), self.usage(7, daily)
+        lines = ["📅 Использование (сегодня / 7 дней):"]
+        for entry_type in sorted(set(today) | set(week) | set(HISTORY_TYPE_NAMES)):
+            name = HISTORY_TYPE_NAMES.get(entry_type, entry_type)
+            lines.append(f"• {name}: {today[entry_type]} / {week[entry_type]}")
+        return "\n".join(lines)
+
+    def snapshot(self) -> dict:
+        """Счётчики процесса в виде, пригодном для JSON и сложения с другими шардами"""
+        return {
+            "users": len(user_info),
+            "totals": dict(self.totals),
+            "daily": {day: dict(bucket) for day, bucket in self.daily.items()},
+            # Профили других шардов недоступны, поэтому вместе с топом храним имена
+            "top": [[uid, self.per_user[uid], _profile(uid)] for uid in self.top],
+            "updated": time.time(),
+        }
+
+
+def _profile(user_id: int) -> dict:
+    info = user_info.get(user_id) or {}
+    return {key: info.get(key) for key in ("first_name", "last_name", "username")}
+
+
+history_stats = HistoryStats(config.STATS_TOP_USERS, config.STATS_DAYS)
+
+
+def append_history(user_id: int, *entries: dict):
+    """Добавляет записи в историю пользователя и учитывает их в статистике"""
+    history = user_history.setdefault(user_id, [])
+    for entry in entries:
+        history.append(entry)
+        history_stats.add(user_id, entry)
+    user_index.mark(user_id)
+
+
+def clear_history(user_id: int):
+    history = user_history.pop(user_id, None)
+    if history is not None:
+        history_stats.remove_user(user_id, history)
+        user_index.mark(user_id)
+
+
+# Счётчики шардов в общем хранилище: ключ - номер шарда
+STATS_NAMESPACE = "shard_stats"
+
+
+def _publish(snapshot: dict) -> list:
+    """Записывает счётчики своего шарда и возвращает публикации всех шардов"""
+    storage.kv_set(STATS_NAMESPACE, str(shard_state["index"]), json.dumps(snapshot, ensure_ascii=False))
+    return storage.kv_items(STATS_NAMESPACE)
+
+
+async def collect_stats() -> dict:
+    """Сводная статистика по всем шардам. Свой шард публикуется заново,
+    остальные берутся из последней публикации (не старше STATS_PUBLISH_INTERVAL).
+    В ответе shards - сколько шардов учтено, oldest - время самой старой публикации"""
+    # Снимок берём в цикле событий, в поток уходит только работа с хранилищем
+    snapshot = history_stats.snapshot()
+    if shard_state["count"] <= 1:
+        return {**snapshot, "shards": 1, "oldest": snapshot["updated"]}
+    rows = await asyncio.to_thread(_publish, snapshot)
+    merged = {"users": 0, "totals": Counter(), "daily": {}, "top": [], "shards": 0, "oldest": time.time()}
+    for key, value in rows:
+        if int(key) >= shard_state["count"]:
+            continue  # Шард от запуска с большим числом воркеров
+        snapshot = json.loads(value)
+        merged["users"] += snapshot["users"]
+        merged["totals"].update(snapshot["totals"])
+        for day, bucket in snapshot["daily"].items():
+            merged["daily"].setdefault(day, Counter()).update(bucket)
+        merged["top"].extend(snapshot["top"])
+        merged["shards"] += 1
+        merged["oldest"] = min(merged["oldest"], snapshot["updated"])
+    # Пользователи шардов не пересекаются, поэтому топ - лучшие из топов шардов
+    merged["top"] = heapq.nlargest(history_stats.top_size, merged["top"], key=lambda item: item[1])
+    return merged
+
+
+async def stats_publish_task():
+    while True:
+        try:
+            await asyncio.to_thread(_publish, history_stats.snapshot())
+        except Exception as e:
+            logging.error(f"Ошибка публикации статистики шарда: {str(e)}")
+        await asyncio.sleep(config.STATS_PUBLISH_INTERVAL)
@@ -0,0 +1,146 @@
+# utils/image_cache.py
+import asyncio
+import logging
+import numpy as np
+from io import BytesIO
+from PIL import Image
+from collections import OrderedDict
+import config
+
+#######################################################
+########### Перцептивный хеш изображения ##############
+
+# Размеры для pHash: уменьшаем до 32x32, берём низкие частоты 8x8 -> 64 бита
+PHASH_IMAGE_SIZE = 32
+PHASH_LOW_FREQ = 8
+# Количество полос для поиска ближайших соседей (64 бита / 8 = 8 бит на полосу)
+HASH_BANDS = 8
+BAND_BITS = 64 // HASH_BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Матрица DCT-II размера n x n"""
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+_DCT = _dct_matrix(PHASH_IMAGE_SIZE)
+
+
+def compute_phash(image_bytes: bytes) -> int:
+    """Считает 64-битный pHash изображения"""
+    image = Image.open(BytesIO(image_bytes)).convert("L")
+    image = image.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.float64)
+    dct = _DCT @ pixels @ _DCT.T
+    low = dct[:PHASH_LOW_FREQ, :PHASH_LOW_FREQ].flatten()
+    # Постоянную составляющую не учитываем при расчёте медианы
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+#######################################################
+########### Кеш результатов анализа ###################
+
+class ImageAnalysisCache:
+    """Кеш описаний изображений по pHash, уровню качества и тексту запроса.
+
+    Поиск соседей идёт по полосам хеша: при расстоянии Хэмминга меньше
+    количества полос хотя бы одна полоса совпадает полностью, поэтому
+    достаточно проверить кандидатов из корзин совпадающих полос.
+    """
+
+    def __init__(self, max_size: int, max_distance: int):
+        if max_distance >= HASH_BANDS:
+            raise ValueError(f"max_distance должен быть меньше {HASH_BANDS}")
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.entries = OrderedDict()  # ((quality, prompt), phash) -> описание
+        self.bands = {}               # ((quality, prompt), номер полосы, значение) -> set(phash)
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _band_keys(self, variant: tuple, phash: int):
+        for band in range(HASH_BANDS):
+            yield (variant, band, (phash >> (band * BAND_BITS)) & BAND_MASK)
+
+    def get(self, phash: int, quality: str, prompt: str):
+        """Возвращает сохранённое описание для идентичного или похожего изображения.
+        Описания для разных запросов (краткое и подробное) не смешиваются"""
+        variant = (quality, prompt)
+        key = (variant, phash)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        best_hash, best_distance = None, self.max_distance + 1
+        for band_key in self._band_keys(variant, phash):
+            for candidate in self.bands.get(band_key, ()):
+                distance = hamming_distance(phash, candidate)
+                if distance < best_distance:
+                    best_hash, best_distance = candidate, distance
+
+        if best_hash is None:
+            self.misses += 1
+            return None
+
+        best_key = (variant, best_hash)
+        self.entries.move_to_end(best_key)
+        self.hits += 1
+        self.near_hits += 1
+        return self.entries[best_key]
+
+    def put(self, phash: int, quality: str, prompt: str, analysis: str):
+        variant = (quality, prompt)
+        key = (variant, phash)
+        if key not in self.entries:
+            for band_key in self._band_keys(variant, phash):
+                self.bands.setdefault(band_key, set()).add(phash)
+        self.entries[key] = analysis
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        (variant, phash), _ = self.entries.popitem(last=False)
+        for band_key in self._band_keys(variant, phash):
+            bucket = self.bands.get(band_key)
+            if bucket is not None:
+                bucket.discard(phash)
+                if not bucket:
+                    del self.bands[band_key]
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0.0
+
+    def stats_text(self) -> str:
+        return (
+            f"🧠 Кеш анализа: {len(self.entries)} записей, "
+            f"попаданий {self.hits} (похожих {self.near_hits}), промахов {self.misses}, "
+            f"hit rate {self.hit_rate():.1f}%"
+        )
+
+
+analysis_cache = ImageAnalysisCache(
+    max_size=config.ANALYSIS_CACHE_SIZE,
+    max_distance=config.ANALYSIS_CACHE_MAX_DISTANCE
+)
+
+
+async def lookup_cached_analysis(image_bytes: bytes, quality: str, prompt: str):
+    """Возвращает (phash, описание из кеша или None)"""
+    try:
+        phash = await asyncio.to_thread(compute_phash, image_bytes)
+    except Exception as e:
+        logging.warning(f"Не удалось посчитать pHash изображения: {str(e)}")
+        return None, None
+    return phash, analysis_cache.get(phash, quality, prompt)
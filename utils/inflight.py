@@ -0,0 +1,103 @@
+# utils/inflight.py
+import time
+import asyncio
+import logging
+import functools
+from contextlib import contextmanager
+from collections import Counter
+
+#####################################################
+########### Реестр выполняющихся запросов ###########
+
+# Новый запрос того же вида отменяет предыдущий
+LATEST_WINS = "latest_wins"
+# Запрос отменяется только явно: /clear, /stopquiz
+CANCEL_ON_CLEAR = "cancel_on_clear"
+
+INFLIGHT_POLICIES = {
+    "chat": CANCEL_ON_CLEAR,
+    "voice": LATEST_WINS,
+    "image": CANCEL_ON_CLEAR,
+    "regenerate": LATEST_WINS,
+    "tts": LATEST_WINS,
+    "analyze": CANCEL_ON_CLEAR,
+    "transcribe": CANCEL_ON_CLEAR,
+    "quiz": CANCEL_ON_CLEAR,
+}
+
+
+class InflightRegistry:
+    """Задачи пользователей, которые сейчас ходят к провайдерам.
+
+    Отмена прерывает задачу на ближайшем await: запрос к g4f, загрузка
+    изображения или транскрибация дальше не выполняются, слот планировщика
+    освобождается.
+    """
+
+    def __init__(self):
+        self.tasks = {}  # user_id -> {сервис: {задача: время старта}}
+        self.cancelled = Counter()  # (сервис, причина) -> количество
+        self.cancelled_seconds = 0.0  # Сколько уже шли отменённые запросы
+
+    @contextmanager
+    def track(self, user_id: int, service: str):
+        task = asyncio.current_task()
+        if INFLIGHT_POLICIES.get(service) == LATEST_WINS:
+            self.cancel(user_id, (service,), reason="superseded")
+        services = self.tasks.setdefault(user_id, {})
+        services.setdefault(service, {})[task] = time.monotonic()
+        try:
+            yield
+        finally:
+            running = services.get(service, {})
+            running.pop(task, None)
+            if not running:
+                services.pop(service, None)
+            if not services and self.tasks.get(user_id) is services:
+                del self.tasks[user_id]
+
+    def tracked(self, service: str):
+        """Декоратор обработчика: user_id берётся из from_user сообщения или callback"""
+        def decorator(handler):
+            @functools.wraps(handler)
+            async def wrapper(event, *args, **kwargs):
+                with self.track(event.from_user.id, service):
+                    return await handler(event, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def cancel(self, user_id: int, services=None, reason: str = "clear") -> int:
+        """Отменяет запросы пользователя (все или указанных сервисов), возвращает их число"""
+        current = asyncio.current_task()
+        now = time.monotonic()
+        count = 0
+        for service, running in list(self.tasks.get(user_id, {}).items()):
+            if services is not None and service not in services:
+                continue
+            for task, started in list(running.items()):
+                if task is current or task.done():
+                    continue
+                task.cancel()
+                count += 1
+                self.cancelled[(service, reason)] += 1
+                self.cancelled_seconds += now - started
+        if count:
+            logging.info(f"Отменено запросов пользователя {user_id}: {count} ({reason})")
+        return count
+
+    def active(self) -> int:
+        return sum(len(running) for services in self.tasks.values() for running in services.values())
+
+    def stats_text(self) -> str:
+        total = sum(self.cancelled.values())
+        by_service = Counter()
+        for (service, _), count in self.cancelled.items():
+            by_service[service] += count
+        details = ", ".join(f"{service} {count}" for service, count in by_service.most_common()) or "нет"
+        return (
+            f"✂️ Отменено запросов: {total} ({details}), выполняется сейчас {self.active()}, "
+            f"прервано на {self.cancelled_seconds:.0f} с. работы"
+        )
+
+
+inflight = InflightRegistry()
@@ -0,0 +1,292 @@
+# utils/jobqueue.py
+import os
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import config
+from utils.storage import storage
+from utils.sharding import shard_for
+from utils.inflight import inflight, INFLIGHT_POLICIES, CANCEL_ON_CLEAR
+from database import shard_state
+
+#####################################################
+########### Очередь фоновых задач (SQLite) ##########
+
+# Статусы задач
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+DEAD = "dead"  # Исчерпаны попытки, задача ждёт разбора администратором
+CANCELLED = "cancelled"  # Отменена пользователем (/clear)
+
+
+class RetryLater(Exception):
+    """Задача не упала, а ещё не готова (например, внешний сервис обрабатывает файл)"""
+
+    def __init__(self, delay: float):
+        super().__init__(f"повтор через {delay} с.")
+        self.delay = delay
+
+
+class JobQueue:
+    """Персистентная очередь задач с выполнением «хотя бы один раз».
+
+    Задача берётся воркером в аренду на JOBS_LEASE_SECONDS и продлевает её,
+    пока выполняется. Если процесс упал, аренда истекает и задачу забирает
+    другой воркер (в том числе после перезапуска). Ошибка - повтор с
+    экспоненциальной задержкой, после JOBS_MAX_ATTEMPTS попыток - статус dead.
+    Обработчики должны переносить повторное выполнение.
+
+    Задачу пользователя (route_key = user_id) выполняет шард, которому
+    пользователь принадлежит сейчас (shard_for, как и для обновлений), даже
+    если число шардов изменилось, пока задача ждала: история и настройки
+    пользователя живут в памяти его шарда. Остальные задачи выполняет шард
+    shard % число шардов. Задачу пользователя с сервисом inflight можно
+    отменить через /clear: ожидающая получает статус cancelled, выполняемая
+    прерывается.
+    """
+
+    def __init__(self):
+        self.handlers = {}  # вид задачи -> (обработчик, уведомление о провале, сервис inflight)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.wakeup = None
+        self.closing = False
+        self.schema_ready = False
+        self.stats = {"done": 0, "failed": 0, "dead": 0, "cancelled": 0}
+        storage.register_function("shard_for", 2, shard_for)
+
+    def handler(self, kind: str, on_dead=None, inflight_service: str = None):
+        """Регистрирует обработчик задач вида kind: async def handler(payload: dict).
+        on_dead(payload, error) вызывается, когда попытки исчерпаны; inflight_service -
+        под каким сервисом выполняющаяся задача видна в реестре inflight (для отмены)"""
+        def decorator(func):
+            self.handlers[kind] = (func, on_dead, inflight_service)
+            return func
+        return decorator
+
+    def ensure_schema(self):
+        if self.schema_ready:
+            return
+        storage.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, shard INTEGER NOT NULL DEFAULT 0, "
+            "route_key INTEGER, "
+            "idempotency_key TEXT UNIQUE, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, "
+            "run_at REAL NOT NULL, lease_until REAL, lease_owner TEXT, last_error TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        # Таблица могла быть создана до появления route_key
+        columns = {row[1] for row in storage.query("PRAGMA table_info(jobs)")}
+        if "route_key" not in columns:
+            storage.execute("ALTER TABLE jobs ADD COLUMN route_key INTEGER")
+        storage.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_at)")
+        self.schema_ready = True
+
+    def enqueue(self, kind: str, payload: dict, idempotency_key: str = None,
+                max_attempts: int = None, delay: float = 0, shard: int = None, route_key: int = None) -> int:
+        """Ставит задачу в очередь. Повтор с тем же ключом возвращает уже созданную задачу.
+        route_key - id пользователя, задачу выполнит его шард; иначе shard - шард-исполнитель,
+        по умолчанию текущий. Транзакция выполняется в текущем потоке - из обработчиков
+        нужно вызывать enqueue_async"""
+        job_id = self._insert(kind, payload, idempotency_key, max_attempts, delay, shard, route_key)
+        self._wake()
+        return job_id
+
+    async def enqueue_async(self, kind: str, payload: dict, idempotency_key: str = None,
+                            max_attempts: int = None, delay: float = 0, shard: int = None,
+                            route_key: int = None) -> int:
+        """enqueue с транзакцией в потоке: BEGIN IMMEDIATE может ждать блокировку записи
+        другого шарда до STORAGE_BUSY_TIMEOUT, цикл событий на это время не встаёт"""
+        job_id = await asyncio.to_thread(
+            self._insert, kind, payload, idempotency_key, max_attempts, delay, shard, route_key
+        )
+        self._wake()
+        return job_id
+
+    def _wake(self):
+        # Только из цикла событий: asyncio.Event не потокобезопасен
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _insert(self, kind, payload, idempotency_key, max_attempts, delay, shard, route_key) -> int:
+        self.ensure_schema()
+        if route_key is not None:
+            shard = shard_for(route_key, shard_state["count"])
+        now = time.time()
+        with storage.transaction() as conn:
+            if idempotency_key is not None:
+                row = conn.execute("SELECT id FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+                if row:
+                    return row[0]
+            cursor = conn.execute(
+                "INSERT INTO jobs (kind, shard, route_key, idempotency_key, payload, status, max_attempts, run_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, shard_state["index"] if shard is None else shard, route_key, idempotency_key,
+                 json.dumps(payload, ensure_ascii=False), QUEUED,
+                 max_attempts or config.JOBS_MAX_ATTEMPTS, now + delay, now, now)
+            )
+            return cursor.lastrowid
+
+    def claim(self):
+        """Берёт в аренду готовую задачу или задачу с истекшей арендой"""
+        now = time.time()
+        with storage.transaction() as conn:
+            row = conn.execute(
+                "SELECT id, kind, payload, attempts, max_attempts, route_key FROM jobs "
+                "WHERE ((status = ? AND run_at <= ?) OR (status = ? AND lease_until < ?)) "
+                "AND CASE WHEN route_key IS NULL THEN shard % ? ELSE shard_for(route_key, ?) END = ? "
+                "ORDER BY run_at LIMIT 1",
+                (QUEUED, now, RUNNING, now, shard_state["count"], shard_state["count"], shard_state["index"])
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, lease_owner = ?, updated_at = ? "
+                "WHERE id = ?",
+                (RUNNING, now + config.JOBS_LEASE_SECONDS, self.owner, now, row[0])
+            )
+        job_id, kind, payload, attempts, max_attempts, route_key = row
+        return job_id, kind, json.loads(payload), attempts + 1, max_attempts, route_key
+
+    def _update(self, job_id: int, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        storage.execute(
+            f"UPDATE jobs SET {columns} WHERE id = ? AND lease_owner = ?",
+            (*fields.values(), job_id, self.owner)
+        )
+
+    async def _set(self, job_id: int, **fields):
+        # Запись ждёт блокировку других процессов - не в цикле событий
+        await asyncio.to_thread(self._update, job_id, **fields)
+
+    async def _keep_lease(self, job_id: int):
+        while True:
+            await asyncio.sleep(config.JOBS_LEASE_SECONDS / 3)
+            await self._set(job_id, lease_until=time.time() + config.JOBS_LEASE_SECONDS)
+
+    @staticmethod
+    async def _call(handler, payload: dict, route_key, service):
+        if route_key is None or service is None:
+            return await handler(payload)
+        with inflight.track(route_key, service):
+            return await handler(payload)
+
+    async def _execute(self, job):
+        job_id, kind, payload, attempts, max_attempts, route_key = job
+        handler, on_dead, service = self.handlers.get(kind, (None, None, None))
+        lease = asyncio.create_task(self._keep_lease(job_id))
+        try:
+            if handler is None:
+                raise RuntimeError(f"Нет обработчика для задач вида {kind}")
+            # Отдельная задача: отмена через inflight прерывает только обработчик, а не воркер
+            await asyncio.create_task(self._call(handler, payload, route_key, service))
+        except RetryLater as e:
+            # Ожидание готовности не считается попыткой
+            await self._set(job_id, status=QUEUED, attempts=attempts - 1, run_at=time.time() + e.delay, lease_owner=None)
+        except asyncio.CancelledError:
+            if not asyncio.current_task().cancelling():
+                # Отменил пользователь (/clear), воркер продолжает работу
+                self.stats["cancelled"] += 1
+                await self._set(job_id, status=CANCELLED, lease_owner=None)
+                return
+            # Процесс останавливается: вернём задачу в очередь без штрафа (синхронно - задача уже отменена)
+            self._update(job_id, status=QUEUED, attempts=attempts - 1, run_at=time.time(), lease_owner=None)
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка задачи {kind} #{job_id} (попытка {attempts}/{max_attempts}): {str(e)}")
+            if attempts >= max_attempts:
+                self.stats["dead"] += 1
+                await self._set(job_id, status=DEAD, last_error=str(e), lease_owner=None)
+                if on_dead is not None:
+                    try:
+                        await on_dead(payload, str(e))
+                    except Exception as notify_error:
+                        logging.error(f"Ошибка уведомления о провале задачи #{job_id}: {str(notify_error)}")
+            else:
+                self.stats["failed"] += 1
+                backoff = min(config.JOBS_BACKOFF_MAX, config.JOBS_BACKOFF_BASE * 2 ** (attempts - 1))
+                await self._set(job_id, status=QUEUED, last_error=str(e), lease_owner=None,
+                                run_at=time.time() + backoff * random.uniform(0.8, 1.2))
+        else:
+            self.stats["done"] += 1
+            await self._set(job_id, status=DONE, last_error=None, lease_owner=None)
+        finally:
+            lease.cancel()
+
+    async def _worker(self):
+        while not self.closing:
+            try:
+                job = await asyncio.to_thread(self.claim)
+            except Exception as e:
+                logging.error(f"Ошибка чтения очереди задач: {str(e)}")
+                job = None
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=config.JOBS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(job)
+
+    async def run(self):
+        """Запускает воркеры; незавершённые до перезапуска задачи подхватываются по аренде"""
+        self.ensure_schema()
+        self.wakeup = asyncio.Event()
+        await asyncio.to_thread(self.purge)
+        workers = [asyncio.create_task(self._worker()) for _ in range(config.JOBS_WORKERS)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    def close(self):
+        """Просит воркеры остановиться после текущих задач; новые задачи не берутся"""
+        self.closing = True
+        self._wake()
+
+    def purge(self):
+        """Удаляет выполненные задачи старше срока хранения"""
+        storage.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (DONE, CANCELLED, time.time() - config.JOBS_RETENTION_DAYS * 86400)
+        )
+
+    def cancel_queued(self, user_id: int) -> int:
+        """Отменяет ожидающие задачи пользователя, которые /clear должен останавливать"""
+        kinds = [kind for kind, (_, _, service) in self.handlers.items()
+                 if INFLIGHT_POLICIES.get(service) == CANCEL_ON_CLEAR]
+        if not kinds:
+            return 0
+        self.ensure_schema()
+        count = storage.execute(
+            f"UPDATE jobs SET status = ?, updated_at = ? WHERE route_key = ? AND status = ? "
+            f"AND kind IN ({', '.join('?' * len(kinds))})",
+            (CANCELLED, time.time(), user_id, QUEUED, *kinds)
+        ).rowcount
+        self.stats["cancelled"] += count
+        return count
+
+    def requeue_dead(self) -> int:
+        """Возвращает упавшие задачи в очередь с новым запасом попыток"""
+        return storage.execute(
+            "UPDATE jobs SET status = ?, attempts = 0, run_at = ?, updated_at = ? WHERE status = ?",
+            (QUEUED, time.time(), time.time(), DEAD)
+        ).rowcount
+
+    def stats_text(self) -> str:
+        self.ensure_schema()
+        counts = dict(storage.query("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+        return (
+            f"🧾 Фоновые задачи: в очереди {counts.get(QUEUED, 0)}, выполняется {counts.get(RUNNING, 0)}, "
+            f"готово {counts.get(DONE, 0)}, упало {counts.get(DEAD, 0)}, отменено {counts.get(CANCELLED, 0)}"
+        )
+
+
+jobs = JobQueue()
@@ -0,0 +1,161 @@
+# utils/lifecycle.py
+import json
+import time
+import signal
+import asyncio
+import logging
+import inspect
+import config
+from database import owns_key
+from utils.storage import storage
+from utils.inflight import inflight
+from middlewares.outbound import outbound_priority, PRIORITY_BULK
+
+#####################################################
+########### Штатная остановка бота ##################
+
+# Пространство имён хранилища: пользователи, чьи запросы прервала остановка
+INTERRUPTED_NAMESPACE = "interrupted"
+
+
+class Lifecycle:
+    """Остановка по SIGTERM/SIGINT без потери работы.
+
+    Порядок: прекращаем приём обновлений, даём начатым обновлениям и фоновым
+    задачам доработать до SHUTDOWN_DRAIN_TIMEOUT, оставшиеся отменяем и
+    запоминаем, чьи запросы прервались, затем сохраняем данные и закрываем сессии.
+    """
+
+    def __init__(self):
+        self.stopping = None
+        self.updates = set()     # задачи, обрабатывающие обновления
+        self.background = []     # (имя, задача, функция мягкой остановки)
+        self.shutdown_hooks = []
+
+    def setup(self, handle_sigint: bool = True):
+        """Ставит обработчики сигналов. Воркерам шардов SIGINT не нужен:
+        Ctrl+C получает вся группа процессов, а останавливает их главный процесс"""
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            if sig == signal.SIGINT and not handle_sigint:
+                signal.signal(sig, signal.SIG_IGN)
+                continue
+            try:
+                loop.add_signal_handler(sig, self.request_stop, sig.name)
+            except NotImplementedError:
+                # Windows: add_signal_handler недоступен
+                signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(
+                    self.request_stop, signal.Signals(signum).name))
+
+    def request_stop(self, reason: str = "stop"):
+        if not self.stopping.is_set():
+            logging.info(f"Получен сигнал {reason}, начинаем остановку")
+            self.stopping.set()
+
+    def spawn(self, coro, name: str, stop=None):
+        """Фоновая задача. stop() просит её завершиться самой - тогда её ждут
+        вместе с обновлениями, иначе задача отменяется сразу"""
+        task = asyncio.create_task(coro, name=name)
+        self.background.append((name, task, stop))
+        return task
+
+    def on_shutdown(self, hook):
+        """Функция (обычная или async), вызываемая после дренажа: сохранение, закрытие сессий"""
+        self.shutdown_hooks.append(hook)
+
+    async def track_update(self, handler, event, data):
+        """Внешняя мидлварь обновлений: учитывает обработку, которую нужно дождаться"""
+        task = asyncio.current_task()
+        self.updates.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            self.updates.discard(task)
+
+    async def serve(self, intake, stop_intake=None):
+        """Принимает обновления до сигнала, затем штатно останавливается.
+        stop_intake() - мягкая остановка приёма, иначе задача приёма отменяется"""
+        intake_task = asyncio.create_task(intake)
+        stop_task = asyncio.create_task(self.stopping.wait())
+        await asyncio.wait({intake_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        stop_task.cancel()
+        if not intake_task.done():
+            if stop_intake is not None:
+                result = stop_intake()
+                if inspect.isawaitable(result):
+                    await result
+            else:
+                intake_task.cancel()
+        try:
+            await intake_task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Ошибка приёма обновлений: {str(e)}")
+        await self.shutdown()
+
+    async def shutdown(self):
+        started = time.monotonic()
+        for name, task, stop in self.background:
+            if stop is not None:
+                stop()
+        draining = {task for task in self.updates if not task.done()}
+        draining |= {task for _, task, stop in self.background if stop is not None and not task.done()}
+        pending = set()
+        if draining:
+            logging.info(f"Дожидаемся завершения задач: {len(draining)}")
+            _, pending = await asyncio.wait(draining, timeout=config.SHUTDOWN_DRAIN_TIMEOUT)
+        self.record_interrupted(pending)
+
+        leftovers = pending | {task for _, task, _ in self.background if not task.done()}
+        for task in leftovers:
+            task.cancel()
+        if leftovers:
+            await asyncio.gather(*leftovers, return_exceptions=True)
+
+        for hook in self.shutdown_hooks:
+            try:
+                result = hook()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logging.error(f"Ошибка при остановке ({getattr(hook, '__qualname__', hook)}): {str(e)}")
+        logging.info(f"Бот остановлен за {time.monotonic() - started:.1f} с.")
+
+    def record_interrupted(self, pending: set):
+        """Запоминает пользователей, чьи запросы не успели завершиться"""
+        if not pending:
+            return
+        interrupted = {}
+        for user_id, services in list(inflight.tasks.items()):
+            for service, running in services.items():
+                if any(task in pending for task in running):
+                    interrupted.setdefault(user_id, []).append(service)
+        for user_id, services in interrupted.items():
+            try:
+                storage.kv_set(INTERRUPTED_NAMESPACE, str(user_id),
+                               json.dumps({"services": services, "at": time.time()}))
+            except Exception as e:
+                logging.error(f"Ошибка записи прерванного запроса {user_id}: {str(e)}")
+        logging.warning(
+            f"Не успели завершиться: задач {len(pending)}, запросы пользователей: "
+            + (", ".join(f"{uid} ({', '.join(services)})" for uid, services in interrupted.items()) or "нет")
+        )
+
+
+lifecycle = Lifecycle()
+
+
+async def notify_interrupted(bot):
+    """После запуска предлагает пользователям повторить прерванные остановкой запросы"""
+    with outbound_priority(PRIORITY_BULK):
+        for key, _ in storage.kv_items(INTERRUPTED_NAMESPACE):
+            user_id = int(key)
+            # Уведомляет шард, которому принадлежит пользователь, и только один раз
+            if not owns_key(user_id) or not storage.kv_delete(INTERRUPTED_NAMESPACE, key):
+                continue
+            try:
+                await bot.send_message(user_id, "⚠️ Бот перезапускался, и ваш последний запрос был прерван. Пожалуйста, повторите его.")
+            except Exception as e:
+                logging.error(f"Ошибка уведомления о прерванном запросе {user_id}: {str(e)}")
@@ -0,0 +1,200 @@
+# utils/quiz_bank.py
+import re
+import json
+import time
+import hashlib
+import numpy as np
+import config
+from utils.storage import storage
+
+#####################################################
+########### Хеши и MinHash вопросов #################
+
+# MinHash: QUIZ_MINHASH_SIZE хеш-функций вида (a * x + b) mod p над хешами слов
+MINHASH_PRIME = (1 << 61) - 1
+_rng = np.random.default_rng(20240613)  # Фиксированное зерно: подписи совпадают между процессами и запусками
+MINHASH_A = _rng.integers(1, 1 << 31, size=config.QUIZ_MINHASH_SIZE, dtype=np.uint64)
+MINHASH_B = _rng.integers(0, 1 << 31, size=config.QUIZ_MINHASH_SIZE, dtype=np.uint64)
+
+# Частые слова вопросов, которые не говорят о содержании
+QUESTION_STOPWORDS = {
+    "как", "какой", "какая", "какое", "какие", "каком", "какого", "кто", "что", "где",
+    "когда", "сколько", "чей", "чья", "чем", "это", "был", "была", "было", "были",
+    "является", "называется", "самый", "самая", "самое", "году",
+}
+WORD_STEM_LENGTH = 5  # Грубая замена стемминга: слова сравниваются по первым буквам
+
+
+def normalize_question(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def question_hash(question: dict) -> int:
+    """Стабильный 64-битный хеш текста вопроса (встроенный hash() меняется при перезапуске)"""
+    digest = hashlib.blake2b(normalize_question(question["question"]).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def question_shingles(text: str) -> set:
+    """Основы значимых слов: перефразированный вопрос сохраняет большую их часть"""
+    words = normalize_question(text).split()
+    return {word[:WORD_STEM_LENGTH] for word in words if len(word) > 2 and word not in QUESTION_STOPWORDS}
+
+
+def minhash_signature(question: dict) -> np.ndarray:
+    shingles = question_shingles(question["question"] + " " + " ".join(question.get("options", {}).values()))
+    if not shingles:
+        return np.zeros(config.QUIZ_MINHASH_SIZE, dtype=np.uint32)
+    values = np.array([
+        int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "big") for s in shingles
+    ], dtype=np.uint64)
+    hashed = (values[:, None] * MINHASH_A[None, :] + MINHASH_B[None, :]) % MINHASH_PRIME
+    return (hashed.min(axis=0) & 0xFFFFFFFF).astype(np.uint32)
+
+
+def signature_from_blob(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.uint32)
+
+
+def max_similarity(signature: np.ndarray, others: np.ndarray) -> float:
+    """Наибольшая оценка сходства Жаккара с любой из подписей others (n x размер)"""
+    if not len(others):
+        return 0.0
+    return float((others == signature).mean(axis=1).max())
+
+
+#####################################################
+########### Банк вопросов викторины #################
+
+class QuestionBank:
+    """Заранее сгенерированные вопросы по категориям в общем хранилище.
+
+    Выдача вопроса - выборка и удаление строки в SQLite, без обращения к
+    модели. Пополнением занимается фоновая задача: когда в категории
+    остаётся меньше нижней границы, её добивают до целевой глубины.
+    Хранилище общее, поэтому банк переживает перезапуск и общий для шардов.
+
+    Повторы отсеиваются по стабильному хешу текста и по MinHash-подписи
+    (перефразированный вопрос): новый вопрос не попадает в банк, если похож
+    на лежащий там, и не выдаётся пользователю, если похож на виденный им в
+    этой категории. Виденные хранятся в quiz_seen (хеш + 4 * QUIZ_MINHASH_SIZE
+    байт подписи, не больше QUIZ_SEEN_LIMIT на пользователя и категорию),
+    поэтому сравнение - один векторный проход numpy по небольшой выборке.
+    """
+
+    def __init__(self):
+        self.schema_ready = False
+        self.stats = {"served": 0, "empty": 0, "added": 0, "duplicates": 0, "near_duplicates": 0}
+
+    def ensure_schema(self):
+        if self.schema_ready:
+            return
+        columns = {row[1] for row in storage.query("PRAGMA table_info(quiz_bank)")}
+        if columns and "signature" not in columns:
+            # Старый банк с текстовыми хешами: вопросы не переносим, пополнение наберёт новые
+            storage.execute("DROP TABLE quiz_bank")
+        storage.execute(
+            "CREATE TABLE IF NOT EXISTS quiz_bank ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, category TEXT NOT NULL, hash INTEGER NOT NULL, "
+            "question TEXT NOT NULL, created_at REAL NOT NULL, signature BLOB NOT NULL, UNIQUE (category, hash))"
+        )
+        storage.execute(
+            "CREATE TABLE IF NOT EXISTS quiz_seen ("
+            "user_id INTEGER NOT NULL, category TEXT NOT NULL, hash INTEGER NOT NULL, "
+            "signature BLOB NOT NULL, seen_at REAL NOT NULL, "
+            "PRIMARY KEY (user_id, category, hash)) WITHOUT ROWID"
+        )
+        self.schema_ready = True
+
+    def depth(self, category: str) -> int:
+        self.ensure_schema()
+        return storage.query("SELECT COUNT(*) FROM quiz_bank WHERE category = ?", (category,))[0][0]
+
+    @staticmethod
+    def _signatures(rows) -> np.ndarray:
+        if not rows:
+            return np.empty((0, config.QUIZ_MINHASH_SIZE), dtype=np.uint32)
+        return np.stack([signature_from_blob(blob) for blob in rows])
+
+    def add(self, category: str, questions: list) -> int:
+        """Добавляет вопросы, пропуская повторы и перефразы лежащих в банке.
+        Возвращает число добавленных"""
+        self.ensure_schema()
+        added = 0
+        now = time.time()
+        with storage.transaction() as conn:
+            bank = self._signatures([row[0] for row in conn.execute(
+                "SELECT signature FROM quiz_bank WHERE category = ?", (category,)
+            )])
+            for question in questions:
+                signature = minhash_signature(question)
+                if max_similarity(signature, bank) >= config.QUIZ_DEDUPE_THRESHOLD:
+                    self.stats["near_duplicates"] += 1
+                    continue
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO quiz_bank (category, hash, question, created_at, signature) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (category, question_hash(question), json.dumps(question, ensure_ascii=False), now,
+                     signature.tobytes())
+                ).rowcount
+                if not inserted:
+                    self.stats["duplicates"] += 1
+                    continue
+                added += 1
+                bank = np.vstack([bank, signature])
+        self.stats["added"] += added
+        return added
+
+    def pop(self, category: str, user_id: int):
+        """Забирает из банка вопрос, который пользователь не видел ни дословно,
+        ни в перефразированном виде, и запоминает его как виденный.
+        Остальные вопросы остаются для других"""
+        self.ensure_schema()
+        with storage.transaction() as conn:
+            seen_rows = conn.execute(
+                "SELECT hash, signature FROM quiz_seen WHERE user_id = ? AND category = ?", (user_id, category)
+            ).fetchall()
+            seen_hashes = {row[0] for row in seen_rows}
+            seen = self._signatures([row[1] for row in seen_rows])
+            rows = conn.execute(
+                "SELECT id, hash, question, signature FROM quiz_bank WHERE category = ? ORDER BY id LIMIT ?",
+                (category, config.QUIZ_BANK_SCAN_LIMIT)
+            ).fetchall()
+            for row_id, hash_, text, blob in rows:
+                if hash_ in seen_hashes:
+                    continue
+                signature = signature_from_blob(blob)
+                if max_similarity(signature, seen) >= config.QUIZ_DEDUPE_THRESHOLD:
+                    continue
+                conn.execute("DELETE FROM quiz_bank WHERE id = ?", (row_id,))
+                self._mark_seen(conn, user_id, category, hash_, signature)
+                self.stats["served"] += 1
+                return json.loads(text)
+        self.stats["empty"] += 1
+        return None
+
+    @staticmethod
+    def _mark_seen(conn, user_id: int, category: str, hash_: int, signature: np.ndarray):
+        conn.execute(
+            "INSERT OR REPLACE INTO quiz_seen (user_id, category, hash, signature, seen_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, category, hash_, signature.tobytes(), time.time())
+        )
+        # Храним только последние QUIZ_SEEN_LIMIT вопросов пользователя в категории
+        conn.execute(
+            "DELETE FROM quiz_seen WHERE user_id = ? AND category = ? AND hash IN ("
+            "SELECT hash FROM quiz_seen WHERE user_id = ? AND category = ? "
+            "ORDER BY seen_at DESC LIMIT -1 OFFSET ?)",
+            (user_id, category, user_id, category, config.QUIZ_SEEN_LIMIT)
+        )
+
+    def stats_text(self) -> str:
+        self.ensure_schema()
+        total = storage.query("SELECT COUNT(*) FROM quiz_bank")[0][0]
+        return (
+            f"❓ Банк вопросов: {total}, выдано {self.stats['served']}, "
+            f"не хватило {self.stats['empty']}, добавлено {self.stats['added']}, "
+            f"повторов {self.stats['duplicates']}, перефразов {self.stats['near_duplicates']}"
+        )
+
+
+quiz_bank = QuestionBank()
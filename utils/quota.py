@@ -0,0 +1,253 @@
+# utils/quota.py
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+import config
+from aiogram.types import Update
+from database import (user_settings, user_states, user_analysis_states,
+                      user_transcribe_states, shard_state)
+from utils.storage import storage
+from utils.dispatch import state_dispatcher
+
+#####################################################
+########### Квоты пользователей (token bucket) ######
+
+# Сервисы, расход которых ограничивается
+SERVICES = ("chat", "image", "tts", "analyze", "transcribe")
+SERVICE_INDEX = {name: index for index, name in enumerate(SERVICES)}
+SERVICE_NAMES = {
+    "chat": "💬 Чат",
+    "image": "🖼 Изображения",
+    "tts": "🎙️ Озвучка",
+    "analyze": "🔍 Анализ изображений",
+    "transcribe": "🎤 Распознавание речи",
+}
+
+# Запись состояния корзины: user_id, сервис, остаток токенов, время обновления
+BUCKET_RECORD = struct.Struct("<qBfd")
+# Пространство имён тарифов в общем хранилище
+TIERS_NAMESPACE = "quota_tiers"
+# Тарифы пользователей: назначает админ любого шарда, читает шард пользователя
+USER_TIERS_NAMESPACE = "quota_user_tiers"
+
+
+class QuotaManager:
+    """Корзины токенов на пару (пользователь, сервис).
+
+    В памяти хранятся только неполные корзины: отсутствие записи означает,
+    что у пользователя полный запас. Тарифы: ёмкость корзины и пополнение
+    в час для каждого сервиса; 0 в час - сервис без ограничений.
+    """
+
+    def __init__(self):
+        self.tiers = {}     # тариф -> {индекс сервиса: (ёмкость, токенов в секунду)}
+        self.user_tiers = {}  # user_id -> тариф, если он не по умолчанию
+        self.buckets = {}   # (user_id, индекс сервиса) -> (токены, время обновления)
+        self.tiers_checked = 0.0
+        self.stats = {"allowed": 0, "rejected": 0}
+
+    # Тарифы
+    def tier_definitions(self) -> dict:
+        """Тарифы из config с правками администраторов из общего хранилища"""
+        tiers = {name: dict(limits) for name, limits in config.QUOTA_TIERS.items()}
+        for name, value in storage.kv_items(TIERS_NAMESPACE):
+            tiers.setdefault(name, {}).update(json.loads(value))
+        return tiers
+
+    def user_tier_assignments(self) -> dict:
+        """Назначенные администраторами тарифы пользователей из общего хранилища"""
+        return {int(user_id): tier for user_id, tier in storage.kv_items(USER_TIERS_NAMESPACE)}
+
+    def reload_tiers(self, definitions: dict = None, assignments: dict = None):
+        compiled = {}
+        definitions = self.tier_definitions() if definitions is None else definitions
+        self.user_tiers = self.user_tier_assignments() if assignments is None else assignments
+        for name, limits in definitions.items():
+            compiled[name] = {
+                SERVICE_INDEX[service]: (capacity, per_hour / 3600)
+                for service, (capacity, per_hour) in limits.items()
+                if service in SERVICE_INDEX and per_hour > 0
+            }
+        self.tiers = compiled
+        self.tiers_checked = time.monotonic()
+
+    def set_limit(self, tier: str, service: str, capacity: int, per_hour: int):
+        """Меняет лимит тарифа; через общее хранилище правка доходит до всех процессов"""
+        stored = storage.kv_get(TIERS_NAMESPACE, tier)
+        limits = json.loads(stored) if stored else {}
+        limits[service] = [capacity, per_hour]
+        storage.kv_set(TIERS_NAMESPACE, tier, json.dumps(limits))
+        self.reload_tiers()
+
+    def set_user_tier(self, user_id: int, tier: str):
+        """Назначает тариф пользователю; шард пользователя увидит его при обновлении тарифов"""
+        storage.kv_set(USER_TIERS_NAMESPACE, str(user_id), tier)
+        self.user_tiers[user_id] = tier
+
+    def user_tier(self, user_id: int) -> str:
+        tier = self.user_tiers.get(user_id)
+        if tier is not None:
+            return tier
+        # Тариф, назначенный до переноса в общее хранилище
+        return user_settings.get(user_id, {}).get("tier", config.QUOTA_DEFAULT_TIER)
+
+    # Проверка
+    def acquire(self, user_id: int, service: str) -> float:
+        """Списывает токен. Возвращает 0, если запрос разрешён, иначе секунды до пополнения.
+        Хранилище не читает: тарифы обновляет quota_tiers_task"""
+        if not self.tiers_checked:
+            self.reload_tiers()
+        index = SERVICE_INDEX[service]
+        limits = self.tiers.get(self.user_tier(user_id), {}).get(index)
+        if limits is None:
+            return 0.0
+        capacity, rate = limits
+        key = (user_id, index)
+        now = time.time()
+        bucket = self.buckets.get(key)
+        tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            self.stats["rejected"] += 1
+            return (1 - tokens) / rate
+        self.buckets[key] = (tokens - 1, now)
+        self.stats["allowed"] += 1
+        return 0.0
+
+    def refund(self, user_id: int, service: str):
+        """Возвращает токен, если запрос не дошёл до провайдера"""
+        key = (user_id, SERVICE_INDEX[service])
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            self.buckets[key] = (bucket[0] + 1, bucket[1])
+
+    def remaining(self, user_id: int, service: str):
+        limits = self.tiers.get(self.user_tier(user_id), {}).get(SERVICE_INDEX[service])
+        if limits is None:
+            return None
+        capacity, rate = limits
+        bucket = self.buckets.get((user_id, SERVICE_INDEX[service]))
+        if bucket is None:
+            return capacity
+        return int(min(capacity, bucket[0] + (time.time() - bucket[1]) * rate))
+
+    # Сохранение состояния
+    def state_file(self) -> str:
+        if shard_state["count"] > 1:
+            base, ext = os.path.splitext(config.QUOTA_STATE_FILE)
+            return f"{base}.shard{shard_state['index']}{ext}"
+        return config.QUOTA_STATE_FILE
+
+    def _prune(self):
+        # Пополнившиеся корзины не храним
+        now = time.time()
+        for key, (tokens, updated) in list(self.buckets.items()):
+            user_id, index = key
+            limits = self.tiers.get(self.user_tier(user_id), {}).get(index)
+            if limits is None or tokens + (now - updated) * limits[1] >= limits[0]:
+                del self.buckets[key]
+
+    def save_state(self):
+        self._prune()
+        path = self.state_file()
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as f:
+            for (user_id, index), (tokens, updated) in self.buckets.items():
+                f.write(BUCKET_RECORD.pack(user_id, index, tokens, updated))
+        os.replace(temp_path, path)
+
+    def load_state(self):
+        self.reload_tiers()
+        path = self.state_file()
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            self.buckets = {
+                (user_id, index): (tokens, updated)
+                for user_id, index, tokens, updated in BUCKET_RECORD.iter_unpack(
+                    data[:len(data) - len(data) % BUCKET_RECORD.size])
+            }
+            self._prune()
+            logging.info(f"Загружено состояние квот: {len(self.buckets)} корзин")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки состояния квот: {str(e)}")
+
+    def stats_text(self) -> str:
+        return (
+            f"🎚 Квоты: пропущено {self.stats['allowed']}, отклонено {self.stats['rejected']}, "
+            f"неполных корзин {len(self.buckets)}"
+        )
+
+
+quota = QuotaManager()
+
+
+async def quota_tiers_task():
+    """Перечитывает тарифы в потоке: правки администратора из других процессов
+    доходят без обращения к SQLite в мидлвари"""
+    while True:
+        await asyncio.sleep(config.QUOTA_TIERS_REFRESH)
+        try:
+            definitions = await asyncio.to_thread(quota.tier_definitions)
+            quota.reload_tiers(definitions, await asyncio.to_thread(quota.user_tier_assignments))
+        except Exception as e:
+            logging.error(f"Ошибка обновления тарифов: {str(e)}")
+
+
+async def quota_persist_task():
+    while True:
+        await asyncio.sleep(config.QUOTA_SAVE_INTERVAL)
+        try:
+            quota.save_state()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения квот: {str(e)}")
+
+
+def classify_service(update: Update):
+    """Определяет, к какому платному сервису приведёт обновление (без сетевых запросов)"""
+    message = update.message
+    if message is not None and message.from_user is not None:
+        user_id = message.from_user.id
+        if message.text:
+            if message.text.startswith("/"):
+                # Незарегистрированная команда уходит в обработчик чата и тарифицируется как чат
+                name = message.text.split(maxsplit=1)[0][1:].partition("@")[0]
+                if name in state_dispatcher.commands:
+                    return None
+            state = user_states.get(user_id)
+            if state == "waiting_for_image_description":
+                return "image"
+            if state is None:
+                return "chat"
+            return None
+        if message.photo or (message.document and (message.document.mime_type or "").startswith("image/")):
+            if user_analysis_states.get(user_id) == "waiting_for_image_analysis":
+                return "analyze"
+            return None
+        if message.voice or message.audio:
+            if (user_transcribe_states.get(user_id) == "waiting_for_audio_transcribe"
+                    or user_settings.get(user_id, {}).get("voice_chat")):
+                return "transcribe"
+        return None
+    query = update.callback_query
+    if query is not None and query.data:
+        if query.data.startswith("regenerate:"):
+            return "image"
+        if query.data.startswith("analyze_now_"):
+            return "analyze"
+        if query.data.startswith("voice_") and query.data != "voice_cancel":
+            return "tts"
+    return None
+
+
+def format_wait(seconds: float) -> str:
+    if seconds < 60:
+        return f"{int(seconds) + 1} сек."
+    if seconds < 3600:
+        return f"{int(seconds // 60) + 1} мин."
+    return f"{seconds / 3600:.1f} ч."
@@ -0,0 +1,205 @@
+# utils/scheduler.py
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+import config
+
+#####################################################
+########### Планировщик запросов к провайдерам ######
+
+class QueueFull(Exception):
+    """У пользователя слишком много запросов в очереди"""
+
+
+class QueueNotice:
+    """Сообщение пользователю о его месте в очереди"""
+
+    def __init__(self, message):
+        self.message = message
+        self.sent = None
+        self.closed = False
+        self.lock = asyncio.Lock()
+
+    async def update(self, position: int):
+        async with self.lock:
+            if self.closed:
+                return
+            text = f"⏳ Запрос в очереди, позиция: {position}"
+            try:
+                if self.sent is None:
+                    self.sent = await self.message.answer(text)
+                else:
+                    await self.sent.edit_text(text)
+            except Exception as e:
+                logging.warning(f"Не удалось обновить позицию в очереди: {str(e)}")
+
+    async def close(self):
+        async with self.lock:
+            self.closed = True
+            if self.sent is not None:
+                try:
+                    await self.sent.delete()
+                except Exception:
+                    pass
+
+
+class _Waiter:
+    __slots__ = ("user_id", "future", "notice", "position", "shown", "updater", "queued_at")
+
+    def __init__(self, user_id, notice):
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.notice = notice
+        self.position = None  # текущая позиция
+        self.shown = None     # позиция, которую видит пользователь
+        self.updater = None   # задача, обновляющая сообщение о позиции
+        self.queued_at = time.monotonic()
+
+
+class FairPool:
+    """Пул с ограничением одновременных запросов.
+
+    Ожидающие раскладываются по очередям пользователей, очередь на
+    свободный слот обходится по кругу: следующий слот получает следующий
+    пользователь, а не следующий запрос.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.queues = OrderedDict()  # user_id -> deque[_Waiter]
+        self.notify_tasks = set()
+        self.stats = {"started": 0, "queued": 0, "rejected": 0, "max_wait": 0.0}
+
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _order(self) -> list:
+        """Порядок, в котором ожидающие получат слоты"""
+        queues = list(self.queues.values())
+        order = []
+        depth = max((len(queue) for queue in queues), default=0)
+        for k in range(depth):
+            for queue in queues:
+                if k < len(queue):
+                    order.append(queue[k])
+        return order
+
+    def _notify(self):
+        for position, waiter in enumerate(self._order(), start=1):
+            if waiter.notice is None:
+                continue
+            waiter.position = position
+            if waiter.updater is None and waiter.shown != position:
+                waiter.updater = self._spawn(self._show_position(waiter))
+
+    async def _show_position(self, waiter: _Waiter):
+        """Обновляет сообщение о позиции не чаще раза в SCHEDULER_NOTICE_INTERVAL:
+        при длинной очереди каждая выдача слота иначе стоила бы правки у всех ожидающих"""
+        try:
+            while waiter.shown != waiter.position and not waiter.future.done():
+                waiter.shown = waiter.position
+                await waiter.notice.update(waiter.shown)
+                await asyncio.sleep(config.SCHEDULER_NOTICE_INTERVAL)
+        finally:
+            waiter.updater = None
+
+    def _grant(self):
+        while self.active < self.limit and self.queues:
+            user_id, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self.queues.move_to_end(user_id)  # Следующий слот - следующему пользователю
+            else:
+                del self.queues[user_id]
+            if waiter.future.done():
+                continue
+            self.active += 1
+            self.stats["max_wait"] = max(self.stats["max_wait"], time.monotonic() - waiter.queued_at)
+            waiter.future.set_result(None)
+        self._notify()
+
+    def _remove(self, waiter: _Waiter):
+        queue = self.queues.get(waiter.user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            del self.queues[waiter.user_id]
+        self._notify()
+
+    async def acquire(self, user_id: int, notice: QueueNotice = None, bounded: bool = True):
+        if self.active < self.limit and not self.queues:
+            self.active += 1
+            self.stats["started"] += 1
+            return
+        queue = self.queues.get(user_id)
+        if bounded and queue and len(queue) >= config.SCHEDULER_MAX_QUEUED_PER_USER:
+            self.stats["rejected"] += 1
+            raise QueueFull("Слишком много запросов в очереди, дождитесь ответа на предыдущие.")
+        waiter = _Waiter(user_id, notice)
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        queue.append(waiter)
+        self.stats["queued"] += 1
+        self._notify()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот уже выдан, но задача отменена - возвращаем его
+                self.release()
+            else:
+                self._remove(waiter)
+            raise
+        finally:
+            if notice is not None:
+                # Без await: отмена после выдачи слота не должна его потерять
+                self._spawn(notice.close())
+        self.stats["started"] += 1
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.notify_tasks.add(task)
+        task.add_done_callback(self.notify_tasks.discard)
+        return task
+
+    def release(self):
+        self.active -= 1
+        self._grant()
+
+
+class Scheduler:
+    """Именованные пулы для разных видов запросов (chat, image, analyze, tts, transcribe)"""
+
+    def __init__(self, pools: dict):
+        self.pools = {name: FairPool(name, limit) for name, limit in pools.items()}
+
+    @asynccontextmanager
+    async def slot(self, pool: str, user_id: int, notice: QueueNotice = None, bounded: bool = True):
+        """Ждёт свободный слот в пуле; bounded=False для внутренних частей одного запроса"""
+        fair_pool = self.pools[pool]
+        await fair_pool.acquire(user_id, notice, bounded)
+        try:
+            yield
+        finally:
+            fair_pool.release()
+
+    def stats_text(self) -> str:
+        lines = ["🗂 Очереди запросов:"]
+        for pool in self.pools.values():
+            lines.append(
+                f"  {pool.name}: активно {pool.active}/{pool.limit}, ждут {pool.waiting()}, "
+                f"всего {pool.stats['started']}, отклонено {pool.stats['rejected']}, "
+                f"макс. ожидание {pool.stats['max_wait']:.1f} с."
+            )
+        return "\n".join(lines)
+
+
+scheduler = Scheduler(config.SCHEDULER_POOLS)
@@ -0,0 +1,189 @@
+# utils/sharding.py
+import time
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+import config
+from aiogram import Bot, Dispatcher
+
+#####################################################
+########### Распределение обновлений по процессам ###
+
+# Поля обновления с сообщением (отправитель в from, у постов каналов - только чат)
+MESSAGE_UPDATE_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                         "business_message", "edited_business_message")
+# Поля обновления, в которых есть пользователь
+USER_UPDATE_FIELDS = ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+                      "poll_answer", "my_chat_member", "chat_member", "chat_join_request")
+# Обновления групповой викторины: её состояние общее для чата, данные пользователей они не меняют
+CHAT_SCOPED_COMMANDS = ("/quiz", "/next", "/stopquiz")
+CHAT_SCOPED_CALLBACKS = ("gquiz:",)
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping, Veach): при изменении числа шардов
+    переезжает только 1/N ключей"""
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for(key: int, shards: int) -> int:
+    if shards <= 1:
+        return 0
+    return jump_hash(int(key), shards)
+
+
+def _chat_scoped_command(message: dict) -> bool:
+    command = (message.get("text") or "").split(maxsplit=1)[0:1]
+    return bool(command) and command[0].split("@", 1)[0] in CHAT_SCOPED_COMMANDS
+
+
+def update_shard_key(update: dict) -> int:
+    """Ключ шардирования - id пользователя: его данные (user_info, история,
+    настройки, квоты) есть только у одного процесса, в том числе когда он
+    пишет в группе. Групповая викторина идёт по id чата - в личке он
+    совпадает с id пользователя"""
+    for field in MESSAGE_UPDATE_FIELDS:
+        message = update.get(field)
+        if message:
+            if "from" not in message or _chat_scoped_command(message):
+                return message["chat"]["id"]
+            return message["from"]["id"]
+    callback = update.get("callback_query")
+    if callback:
+        message = callback.get("message")
+        if message and "chat" in message and (callback.get("data") or "").startswith(CHAT_SCOPED_CALLBACKS):
+            return message["chat"]["id"]
+        return callback["from"]["id"]
+    for field in USER_UPDATE_FIELDS:
+        obj = update.get(field)
+        if obj:
+            user = obj.get("from") or obj.get("user")
+            if user:
+                return user["id"]
+            if "chat" in obj:
+                return obj["chat"]["id"]
+    return 0
+
+
+class ShardRouter:
+    """Главный процесс: запускает воркеры и раздаёт им обновления"""
+
+    def __init__(self, count: int, worker_target):
+        self.count = count
+        self.worker_target = worker_target
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = []
+        self.processes = []
+        self.restarts = []  # Время перезапусков каждого воркера
+        self.stopping = False
+
+    def start(self):
+        for index in range(self.count):
+            self.queues.append(self.context.Queue())
+            self.processes.append(None)
+            self.restarts.append(deque())
+            self._start_worker(index)
+        logging.info(f"Запущено воркеров: {self.count}")
+
+    def _start_worker(self, index: int):
+        # Очередь остаётся прежней: перезапущенный воркер дочитает накопившиеся обновления
+        process = self.context.Process(
+            target=self.worker_target,
+            args=(index, self.count, self.queues[index]),
+            name=f"shard-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def dispatch(self, update: dict):
+        index = shard_for(update_shard_key(update), self.count)
+        self.queues[index].put(update)
+
+    def alive(self) -> bool:
+        return all(process.is_alive() for process in self.processes)
+
+    def supervise(self):
+        """Перезапускает упавшие воркеры. Если воркер падает чаще
+        SHARD_MAX_RESTARTS раз за SHARD_RESTART_WINDOW, бросает RuntimeError"""
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if self.stopping or process.is_alive():
+                continue
+            restarts = self.restarts[index]
+            while restarts and now - restarts[0] > config.SHARD_RESTART_WINDOW:
+                restarts.popleft()
+            if len(restarts) >= config.SHARD_MAX_RESTARTS:
+                raise RuntimeError(f"Воркер {process.name} постоянно падает (код {process.exitcode})")
+            restarts.append(now)
+            logging.error(f"Воркер {process.name} завершился с кодом {process.exitcode}, перезапускаем")
+            self._start_worker(index)
+
+    async def watch(self, on_failure):
+        """Проверяет воркеры раз в SHARD_CHECK_INTERVAL; on_failure(причина) - когда перезапуск не помогает"""
+        while not self.stopping:
+            await asyncio.sleep(config.SHARD_CHECK_INTERVAL)
+            try:
+                self.supervise()
+            except RuntimeError as e:
+                logging.critical(str(e))
+                on_failure(str(e))
+                return
+
+    def stop(self, timeout: float = 30):
+        self.stopping = True
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning(f"Воркер {process.name} не завершился, останавливаем принудительно")
+                process.terminate()
+
+
+async def run_polling_master(dp: Dispatcher, bot: Bot, router: ShardRouter):
+    """Long polling в главном процессе с раздачей обновлений по шардам"""
+    allowed_updates = dp.resolve_used_update_types()
+    await bot.delete_webhook(drop_pending_updates=False)
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logging.error(f"Ошибка получения обновлений: {str(e)}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            router.dispatch(update.model_dump(mode="json", exclude_unset=True))
+            offset = update.update_id + 1
+
+
+async def run_shard_worker(dp: Dispatcher, bot: Bot, queue, tasks: set = None):
+    """Цикл воркера: читает обновления из очереди до None и обрабатывает их.
+    Задачи обработки складываются в tasks, чтобы их можно было дождаться при остановке"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(config.SHARD_WORKER_CONCURRENCY)
+    if tasks is None:
+        tasks = set()
+
+    async def feed(update):
+        async with semaphore:
+            try:
+                await dp.feed_raw_update(bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка обработки обновления: {str(e)}")
+
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            break
+        task = asyncio.create_task(feed(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
@@ -0,0 +1,62 @@
+# utils/singleflight.py
+import asyncio
+
+#####################################################
+########### Объединение одинаковых запросов #########
+
+class SingleFlight:
+    """Одновременные вызовы с одинаковым ключом разделяют один запрос к провайдеру.
+
+    Запрос выполняется в отдельной задаче: результат или исключение получают
+    все ожидающие. Отмена одного из ожидающих не прерывает запрос для
+    остальных; запрос отменяется, только когда ждать его больше некому.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = {}    # ключ -> задача запроса
+        self.waiters = {}  # ключ -> число ожидающих
+        self.stats = {"calls": 0, "shared": 0}
+
+    async def do(self, key, factory):
+        """factory - функция без аргументов, возвращающая корутину запроса"""
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self.calls[key] = task
+            self.waiters[key] = 0
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.stats["calls"] += 1
+        else:
+            self.stats["shared"] += 1
+        self.waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self.waiters.get(key) == 1 and self.calls.get(key) is task:
+                # Последний ожидающий ушёл - запрос больше никому не нужен
+                self._forget(key, task)
+                task.cancel()
+            raise
+        finally:
+            if self.calls.get(key) is task:
+                self.waiters[key] -= 1
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+            del self.waiters[key]
+
+    def stats_text(self) -> str:
+        return f"{self.name}: запросов {self.stats['calls']}, объединено {self.stats['shared']}"
+
+
+translation_flight = SingleFlight("перевод")
+image_flight = SingleFlight("изображения")
+audio_flight = SingleFlight("озвучка")
+analysis_flight = SingleFlight("анализ")
+
+
+def stats_text() -> str:
+    flights = (translation_flight, image_flight, audio_flight, analysis_flight)
+    return "🔗 Объединение запросов: " + "; ".join(flight.stats_text() for flight in flights)
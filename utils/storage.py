@@ -0,0 +1,266 @@
+# utils/storage.py
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+import config
+
+#####################################################
+########### Общее локальное хранилище (SQLite) ######
+
+class Storage:
+    """Хранилище на SQLite в режиме WAL, общее для всех процессов бота"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.functions = {}  # имя -> (число аргументов, функция) для SQL
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Соединение не переживает fork, поэтому в каждом процессе открываем своё
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=config.STORAGE_BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            for name, (nargs, func) in self.functions.items():
+                conn.create_function(name, nargs, func, deterministic=True)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def register_function(self, name: str, nargs: int, func):
+        """Добавляет функцию Python в SQL; регистрируется в каждом соединении процесса"""
+        with self.lock:
+            self.functions[name] = (nargs, func)
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.create_function(name, nargs, func, deterministic=True)
+
+    def execute(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def query(self, sql: str, params=()) -> list:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция с блокировкой записи на время выполнения блока"""
+        with self.lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    # Простое хранилище ключ-значение по пространствам имён
+    def kv_get(self, namespace: str, key: str):
+        rows = self.query("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        return rows[0][0] if rows else None
+
+    def kv_set(self, namespace: str, key: str, value: str):
+        self.execute(
+            "INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+            (namespace, key, value)
+        )
+
+    def kv_delete(self, namespace: str, key: str) -> bool:
+        return self.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).rowcount > 0
+
+    def kv_items(self, namespace: str) -> list:
+        return self.query("SELECT key, value FROM kv WHERE namespace = ?", (namespace,))
+
+    def kv_count(self, namespace: str) -> int:
+        return self.query("SELECT COUNT(*) FROM kv WHERE namespace = ?", (namespace,))[0][0]
+
+    def kv_clear(self, namespace: str):
+        self.execute("DELETE FROM kv WHERE namespace = ?", (namespace,))
+
+
+storage = Storage(config.STORAGE_PATH)
+
+# Версии словарей с кешем: namespace -> счётчик изменений
+VERSIONS_NAMESPACE = "_versions"
+
+
+class SharedDict(MutableMapping):
+    """Словарь, который до подключения хранилища живёт в памяти процесса,
+    а после attach() читает и пишет напрямую в общее хранилище.
+
+    Ключи и значения сериализуются в JSON (тип ключа сохраняется).
+    Изменения вложенных объектов нужно записывать присваиванием.
+    При ttl значение хранится как [значение, срок по time.time()]: срок
+    общий для всех процессов, истёкшие записи не видны и удаляются expire().
+    cached=True (для словарей, которые читаются на каждом обновлении и
+    редко меняются): чтение идёт из копии в памяти процесса, которая
+    перечитывается целиком, когда меняется версия словаря в хранилище.
+    Версия проверяется не чаще раза в SHARED_CACHE_CHECK_INTERVAL, каждая
+    запись её увеличивает, поэтому изменение в другом процессе видно с
+    задержкой не больше этого интервала.
+    """
+
+    def __init__(self, namespace: str, ttl: float = None, cached: bool = False):
+        if ttl and cached:
+            raise ValueError("Кеш поддерживается только для словарей без ttl")
+        self.namespace = namespace
+        self.name = namespace
+        self.ttl = ttl
+        self.cached = cached
+        self.local = {}
+        self.storage = None
+        self.snapshot = None  # Копия содержимого хранилища (cached)
+        self.version = None
+        self.checked = 0.0
+        self.stats = {"expired": 0, "evicted": 0}
+
+    def attach(self, storage: Storage, publish: bool = False):
+        """Переключает словарь на общее хранилище.
+        publish=True переносит туда текущее содержимое (делает главный процесс)"""
+        if publish:
+            with storage.transaction():
+                storage.kv_clear(self.namespace)
+                for key, value in self.local.items():
+                    storage.kv_set(self.namespace, json.dumps(key), json.dumps(value, ensure_ascii=False))
+                self._bump(storage)
+        self.storage = storage
+        self.local = {}
+        self.snapshot = None
+
+    def _bump(self, storage: Storage):
+        if self.cached:
+            storage.execute(
+                "INSERT INTO kv (namespace, key, value) VALUES (?, ?, '1') "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                (VERSIONS_NAMESPACE, self.namespace)
+            )
+
+    @contextmanager
+    def _write(self):
+        """Изменение в хранилище; у словаря с кешем - вместе с новой версией"""
+        if not self.cached:
+            yield
+            return
+        with self.storage.transaction():
+            yield
+            self._bump(self.storage)
+        self.snapshot = None
+
+    def _cache(self) -> dict:
+        now = time.monotonic()
+        if self.snapshot is None or now - self.checked >= config.SHARED_CACHE_CHECK_INTERVAL:
+            version = self.storage.kv_get(VERSIONS_NAMESPACE, self.namespace)
+            if self.snapshot is None or version != self.version:
+                self.snapshot = {
+                    json.loads(key): json.loads(value) for key, value in self.storage.kv_items(self.namespace)
+                }
+                self.version = version
+            self.checked = now
+        return self.snapshot
+
+    def _wrap(self, value):
+        return [value, time.time() + self.ttl] if self.ttl else value
+
+    def _expired(self, raw) -> bool:
+        return bool(self.ttl) and raw[1] <= time.time()
+
+    def _raw_items(self) -> list:
+        if self.storage is None:
+            return list(self.local.items())
+        if self.cached:
+            return list(self._cache().items())
+        return [(json.loads(key), json.loads(value)) for key, value in self.storage.kv_items(self.namespace)]
+
+    def __getitem__(self, key):
+        if self.storage is None:
+            raw = self.local[key]
+        elif self.cached:
+            raw = self._cache()[key]
+        else:
+            value = self.storage.kv_get(self.namespace, json.dumps(key))
+            if value is None:
+                raise KeyError(key)
+            raw = json.loads(value)
+        if self._expired(raw):
+            raise KeyError(key)
+        return raw[0] if self.ttl else raw
+
+    def __setitem__(self, key, value):
+        if self.storage is None:
+            self.local[key] = self._wrap(value)
+        else:
+            with self._write():
+                self.storage.kv_set(self.namespace, json.dumps(key), json.dumps(self._wrap(value), ensure_ascii=False))
+
+    def __delitem__(self, key):
+        if self.storage is None:
+            del self.local[key]
+            return
+        with self._write():
+            deleted = self.storage.kv_delete(self.namespace, json.dumps(key))
+        if not deleted:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter([key for key, _ in self.items()])
+
+    def __len__(self):
+        if self.ttl:
+            return len(self.items())
+        if self.storage is None:
+            return len(self.local)
+        if self.cached:
+            return len(self._cache())
+        return self.storage.kv_count(self.namespace)
+
+    def items(self):
+        if not self.ttl:
+            return self._raw_items()
+        return [(key, raw[0]) for key, raw in self._raw_items() if not self._expired(raw)]
+
+    def expire(self) -> int:
+        """Удаляет истёкшие записи (для словарей с ttl)"""
+        if not self.ttl:
+            return 0
+        removed = 0
+        if self.storage is None:
+            for key, raw in list(self.local.items()):
+                if self._expired(raw):
+                    del self.local[key]
+                    removed += 1
+        else:
+            for key, value in self.storage.kv_items(self.namespace):
+                if self._expired(json.loads(value)):
+                    # Удаляем только если запись не перезаписал другой процесс
+                    removed += self.storage.execute(
+                        "DELETE FROM kv WHERE namespace = ? AND key = ? AND value = ?",
+                        (self.namespace, key, value)
+                    ).rowcount
+        self.stats["expired"] += removed
+        return removed
+
+    def clear(self):
+        if self.storage is None:
+            self.local.clear()
+        else:
+            with self._write():
+                self.storage.kv_clear(self.namespace)
+
+    def copy(self) -> dict:
+        return dict(self.items())
@@ -0,0 +1,89 @@
+# utils/timer_wheel.py
+import math
+import time
+import asyncio
+import logging
+
+#####################################################
+########### Колесо таймеров #########################
+
+class TimerWheel:
+    """Хешированное колесо таймеров: одна задача на все отложенные события.
+
+    Время делится на такты по tick секунд; таймер лежит в ячейке
+    (номер такта) % slots вместе с номером своего такта, поэтому добавление,
+    перенос и отмена - O(1), а каждый такт просматривает одну ячейку.
+    Ключ таймера уникален: повторный schedule() переносит таймер.
+    Сработавшие таймеры вызывают handler(key) отдельными задачами, чтобы
+    медленный обработчик не задерживал остальные.
+    """
+
+    def __init__(self, name: str, tick: float, slots: int):
+        self.name = name
+        self.tick = tick
+        self.slots = slots
+        self.wheel = [{} for _ in range(slots)]  # ячейка -> {ключ: номер такта}
+        self.timers = {}                          # ключ -> номер такта
+        self.current = int(time.time() // tick)   # последний обработанный такт
+        self.handler = None
+        self.running = set()
+        self.stats = {"fired": 0, "errors": 0}
+
+    def on_fire(self, handler):
+        """Обработчик сработавших таймеров: async handler(key)"""
+        self.handler = handler
+        return handler
+
+    def schedule(self, key, when: float):
+        """Ставит или переносит таймер на момент when (time.time())"""
+        self.cancel(key)
+        target = max(math.ceil(when / self.tick), self.current + 1)
+        self.wheel[target % self.slots][key] = target
+        self.timers[key] = target
+
+    def cancel(self, key) -> bool:
+        target = self.timers.pop(key, None)
+        if target is None:
+            return False
+        del self.wheel[target % self.slots][key]
+        return True
+
+    def __contains__(self, key) -> bool:
+        return key in self.timers
+
+    def _due(self, now_tick: int) -> list:
+        due = []
+        # Если отстали больше чем на оборот, достаточно просмотреть каждую ячейку один раз
+        for tick in range(self.current + 1, min(now_tick, self.current + self.slots) + 1):
+            slot = self.wheel[tick % self.slots]
+            for key in [key for key, target in slot.items() if target <= now_tick]:
+                del slot[key]
+                del self.timers[key]
+                due.append(key)
+        self.current = now_tick
+        return due
+
+    async def _fire(self, key):
+        try:
+            await self.handler(key)
+            self.stats["fired"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logging.error(f"Ошибка таймера {self.name} {key}: {str(e)}", exc_info=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(max((self.current + 1) * self.tick - time.time(), 0))
+            now_tick = int(time.time() // self.tick)
+            if now_tick <= self.current:
+                continue
+            for key in self._due(now_tick):
+                task = asyncio.create_task(self._fire(key))
+                self.running.add(task)
+                task.add_done_callback(self.running.discard)
+
+    def stats_text(self) -> str:
+        return (
+            f"{self.name}: таймеров {len(self.timers)}, сработало {self.stats['fired']}, "
+            f"ошибок {self.stats['errors']}"
+        )
@@ -0,0 +1,199 @@
+# utils/tts_cache.py
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+import config
+
+###################################################
+########### Дисковый кеш синтеза речи #############
+
+class TTSCache:
+    """LRU-кеш озвучки на диске с ограничением по суммарному размеру.
+
+    Для каждого ключа помимо файла хранится file_id Telegram, чтобы
+    повторная отправка не требовала ни синтеза, ни загрузки файла.
+    Изменения индекса только помечают его (dirty); на диск он пишется
+    фоновой задачей раз в TTS_CACHE_SAVE_INTERVAL и при остановке, через
+    временный файл и os.replace. Файлы аудио читаются и пишутся в потоке.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_entries: int = 20000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+        self._open(directory, max_bytes)
+
+    def _open(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.index = OrderedDict()  # ключ -> {"size": int, "file_id": str | None}
+        self.total_bytes = 0
+        self.dirty = False
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def configure_shard(self, index: int, count: int):
+        """У каждого шарда свой каталог и индекс, общий лимит делится между шардами:
+        иначе шарды затирают индекс друг друга и удаляют чужие файлы"""
+        if count > 1:
+            self._open(os.path.join(config.TTS_CACHE_DIR, f"shard{index}"), config.TTS_CACHE_MAX_BYTES // count)
+
+    @staticmethod
+    def make_key(text: str, voice: str, model: str = None, audio_format: str = None) -> str:
+        normalized = " ".join(text.split())
+        model = model or config.TTS_MODEL
+        audio_format = audio_format or config.AUDIO_FORMAT
+        raw = f"{model}\0{voice}\0{audio_format}\0{normalized}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.{config.AUDIO_FORMAT}")
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = []
+        except json.JSONDecodeError:
+            logging.error("Индекс кеша озвучки повреждён, создаём новый")
+            entries = []
+        # Записи сохранены в порядке от давно использованных к недавним
+        for key, size, file_id in entries:
+            if size and not os.path.exists(self._path(key)):
+                size = 0
+            self.index[key] = {"size": size, "file_id": file_id}
+            self.total_bytes += size
+
+    def _take_entries(self):
+        """Снимок изменившегося индекса для записи; None - записывать нечего"""
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return [[key, entry["size"], entry["file_id"]] for key, entry in self.index.items()]
+
+    def _write_index(self, path: str, entries: list):
+        # Сбой посреди записи не должен стирать индекс: пишем во временный файл и подменяем
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(temp_path, path)
+        except Exception as e:
+            self.dirty = True
+            logging.error(f"Ошибка сохранения индекса кеша озвучки: {str(e)}")
+
+    def save_index(self):
+        entries = self._take_entries()
+        if entries is not None:
+            self._write_index(self.index_path, entries)
+
+    async def save_index_async(self):
+        # Снимок берётся в цикле событий, запись файла - в потоке
+        entries = self._take_entries()
+        if entries is not None:
+            await asyncio.to_thread(self._write_index, self.index_path, entries)
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    @staticmethod
+    def _remove_files(paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def get(self, key: str):
+        """Возвращает байты аудио или None"""
+        entry = self.index.get(key)
+        if not entry or not entry["size"]:
+            self.misses += 1
+            return None
+        try:
+            data = await asyncio.to_thread(self._read_file, self._path(key))
+        except OSError:
+            # Пока файл читался, запись могла уйти при вытеснении
+            if self.index.get(key) is entry:
+                self.total_bytes -= entry["size"]
+                entry["size"] = 0
+                self.dirty = True
+            self.misses += 1
+            return None
+        if key in self.index:
+            self.index.move_to_end(key)
+            # Порядок LRU тоже часть индекса: без этого после перезапуска он теряется
+            self.dirty = True
+        self.hits += 1
+        return data
+
+    def get_file_id(self, key: str):
+        entry = self.index.get(key)
+        if entry and entry["file_id"]:
+            self.index.move_to_end(key)
+            self.dirty = True
+            self.file_id_hits += 1
+            return entry["file_id"]
+        return None
+
+    async def put(self, key: str, data: bytes):
+        try:
+            await asyncio.to_thread(self._write_file, self._path(key), data)
+        except OSError as e:
+            logging.error(f"Ошибка записи в кеш озвучки: {str(e)}")
+            return
+        entry = self.index.setdefault(key, {"size": 0, "file_id": None})
+        self.total_bytes += len(data) - entry["size"]
+        entry["size"] = len(data)
+        self.index.move_to_end(key)
+        self.dirty = True
+        evicted = self._evict()
+        if evicted:
+            await asyncio.to_thread(self._remove_files, evicted)
+
+    def set_file_id(self, key: str, file_id):
+        entry = self.index.setdefault(key, {"size": 0, "file_id": None})
+        entry["file_id"] = file_id
+        self.index.move_to_end(key)
+        self.dirty = True
+        # Здесь вытеснение срабатывает только по числу записей - редко, файлы удаляем сразу
+        self._remove_files(self._evict())
+
+    def _evict(self) -> list:
+        """Убирает из индекса давно использованные записи вместе с их file_id,
+        возвращает пути файлов, которые нужно удалить"""
+        evicted = []
+        while self.index and (self.total_bytes > self.max_bytes or len(self.index) > self.max_entries):
+            key, entry = self.index.popitem(last=False)
+            if entry["size"]:
+                evicted.append(self._path(key))
+                self.total_bytes -= entry["size"]
+        return evicted
+
+    def stats_text(self) -> str:
+        return (
+            f"🎙️ Кеш озвучки: {len(self.index)} записей, {self.total_bytes / 1024 / 1024:.1f} MB, "
+            f"с диска {self.hits}, по file_id {self.file_id_hits}, промахов {self.misses}"
+        )
+
+
+tts_cache = TTSCache(config.TTS_CACHE_DIR, config.TTS_CACHE_MAX_BYTES)
+
+
+async def tts_cache_flush_task():
+    while True:
+        await asyncio.sleep(config.TTS_CACHE_SAVE_INTERVAL)
+        await tts_cache.save_index_async()
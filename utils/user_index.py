@@ -0,0 +1,131 @@
+# utils/user_index.py
+from bisect import bisect_left, insort
+from datetime import datetime
+from database import user_info, user_history
+
+#####################################################
+########### Индексы пользователей для админки #######
+
+# Порядки сортировки списка пользователей
+SORT_ACTIVITY = "a"
+SORT_MESSAGES = "m"
+SORT_JOINED = "j"
+SORT_NAMES = {
+    SORT_ACTIVITY: "по активности",
+    SORT_MESSAGES: "по сообщениям",
+    SORT_JOINED: "по дате регистрации",
+}
+
+
+def to_epoch(value) -> float:
+    # Время в user_info: секунды epoch, у старых записей - строка "%Y-%m-%d %H:%M:%S"
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class UserIndex:
+    """Отсортированные списки (ключ, user_id) для постраничного вывода.
+
+    Страница - срез списка, поэтому её стоимость не зависит от числа
+    пользователей. Изменения не применяются сразу: mark() запоминает
+    пользователя, а refresh() перед выводом переставляет только отмеченных
+    (bisect). Поиск - по отсортированным словам из username, имени и фамилии:
+    bisect до префикса и перебор совпадений до нужного количества.
+    """
+
+    def __init__(self):
+        self.orders = {SORT_ACTIVITY: [], SORT_MESSAGES: [], SORT_JOINED: []}
+        self.words = []     # (слово, user_id)
+        self.entries = {}   # user_id -> (ключи по порядкам, слова)
+        self.dirty = set()
+        self.built = False
+
+    def mark(self, user_id: int):
+        self.dirty.add(user_id)
+
+    def _entry(self, user_id: int):
+        info = user_info.get(user_id)
+        if info is None:
+            return None
+        keys = {
+            SORT_ACTIVITY: (to_epoch(info.get("last_activity")), user_id),
+            SORT_MESSAGES: (len(user_history.get(user_id, ())), user_id),
+            SORT_JOINED: (to_epoch(info.get("date_joined")), user_id),
+        }
+        words = {
+            (str(word).lower().lstrip("@"), user_id)
+            for word in (info.get("username"), info.get("first_name"), info.get("last_name"))
+            if word
+        }
+        return keys, words
+
+    @staticmethod
+    def _discard(items: list, item):
+        i = bisect_left(items, item)
+        if i < len(items) and items[i] == item:
+            del items[i]
+
+    def refresh(self):
+        """Применяет накопленные изменения"""
+        if not self.built:
+            self.entries = {uid: entry for uid in user_info if (entry := self._entry(uid)) is not None}
+            for order, items in self.orders.items():
+                items[:] = sorted(keys[order] for keys, _ in self.entries.values())
+            self.words = sorted(word for _, words in self.entries.values() for word in words)
+            self.dirty.clear()
+            self.built = True
+            return
+        dirty, self.dirty = self.dirty, set()
+        for user_id in dirty:
+            old = self.entries.pop(user_id, None)
+            new = self._entry(user_id)
+            if old is not None:
+                for order, items in self.orders.items():
+                    if new is None or new[0][order] != old[0][order]:
+                        self._discard(items, old[0][order])
+                for word in old[1] - (new[1] if new else set()):
+                    self._discard(self.words, word)
+            if new is not None:
+                for order, items in self.orders.items():
+                    if old is None or new[0][order] != old[0][order]:
+                        insort(items, new[0][order])
+                for word in new[1] - (old[1] if old else set()):
+                    insort(self.words, word)
+                self.entries[user_id] = new
+
+    def count(self) -> int:
+        self.refresh()
+        return len(self.entries)
+
+    def page(self, order: str, page: int, size: int) -> list:
+        """user_id страницы, от больших значений ключа к меньшим"""
+        self.refresh()
+        items = self.orders[order]
+        end = len(items) - page * size
+        return [uid for _, uid in reversed(items[max(end - size, 0):max(end, 0)])]
+
+    def search(self, prefix: str, offset: int, limit: int) -> tuple:
+        """Пользователи, у которых username, имя или фамилия начинаются с prefix.
+        Возвращает (user_id страницы, есть ли ещё)"""
+        self.refresh()
+        prefix = prefix.lower().lstrip("@")
+        found, seen = [], set()
+        i = bisect_left(self.words, (prefix,))
+        while i < len(self.words) and self.words[i][0].startswith(prefix):
+            user_id = self.words[i][1]
+            i += 1
+            if user_id in seen:
+                continue
+            seen.add(user_id)
+            if len(seen) > offset + limit:
+                return found, True
+            if len(seen) > offset:
+                found.append(user_id)
+        return found, False
+
+
+user_index = UserIndex()
@@ -0,0 +1,133 @@
+# utils/webhook.py
+import asyncio
+import logging
+import config
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+#####################################################
+########### Приём обновлений через webhook ##########
+
+# Признак готовности инстанса принимать трафик
+webhook_state = {"ready": False}
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Отвечает Telegram 200 сразу, а обработку ведёт в фоне
+    с ограничением количества одновременно обрабатываемых обновлений.
+    Задачи складываются в tasks ещё до ожидания слота: обновление, на которое
+    Telegram уже получил ответ, при остановке нужно дождаться, даже если оно в очереди"""
+
+    def __init__(self, *args, max_concurrency: int, tasks: set = None, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tasks = set() if tasks is None else tasks
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        async with self.semaphore:
+            await super()._background_feed_update(bot, update)
+
+
+async def handle_liveness(request: web.Request):
+    return web.json_response({"status": "alive"})
+
+async def handle_readiness(request: web.Request):
+    if webhook_state["ready"]:
+        return web.json_response({"status": "ready"})
+    return web.json_response({"status": "not ready"}, status=503)
+
+
+def create_webhook_app(dp: Dispatcher, bot: Bot, tasks: set = None) -> web.Application:
+    app = web.Application()
+
+    async def on_startup(bot: Bot):
+        # При нескольких инстансах за балансировщиком webhook ставит только один из них
+        if config.WEBHOOK_SET_ON_STARTUP:
+            await bot.set_webhook(
+                url=f"{config.WEBHOOK_BASE_URL}{config.WEBHOOK_PATH}",
+                secret_token=config.WEBHOOK_SECRET or None,
+                drop_pending_updates=False
+            )
+            logging.info(f"Webhook установлен: {config.WEBHOOK_BASE_URL}{config.WEBHOOK_PATH}")
+        webhook_state["ready"] = True
+
+    async def on_shutdown(bot: Bot):
+        webhook_state["ready"] = False
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    BoundedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=config.WEBHOOK_SECRET or None,
+        max_concurrency=config.WEBHOOK_MAX_CONCURRENCY,
+        tasks=tasks
+    ).register(app, path=config.WEBHOOK_PATH)
+    app.router.add_get(config.LIVENESS_PATH, handle_liveness)
+    app.router.add_get(config.READINESS_PATH, handle_readiness)
+
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def create_sharded_webhook_app(bot: Bot, router) -> web.Application:
+    """Webhook главного процесса: обновления не обрабатываются, а раздаются воркерам"""
+    app = web.Application()
+
+    async def handle_update(request: web.Request):
+        if config.WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.WEBHOOK_SECRET:
+            return web.Response(status=401, text="Unauthorized")
+        router.dispatch(await request.json())
+        return web.Response()
+
+    async def handle_sharded_readiness(request: web.Request):
+        if webhook_state["ready"] and router.alive():
+            return web.json_response({"status": "ready"})
+        return web.json_response({"status": "not ready"}, status=503)
+
+    async def on_startup(app: web.Application):
+        if config.WEBHOOK_SET_ON_STARTUP:
+            await bot.set_webhook(
+                url=f"{config.WEBHOOK_BASE_URL}{config.WEBHOOK_PATH}",
+                secret_token=config.WEBHOOK_SECRET or None,
+                drop_pending_updates=False
+            )
+            logging.info(f"Webhook установлен: {config.WEBHOOK_BASE_URL}{config.WEBHOOK_PATH}")
+        webhook_state["ready"] = True
+
+    async def on_shutdown(app: web.Application):
+        webhook_state["ready"] = False
+        await bot.session.close()
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.router.add_post(config.WEBHOOK_PATH, handle_update)
+    app.router.add_get(config.LIVENESS_PATH, handle_liveness)
+    app.router.add_get(config.READINESS_PATH, handle_sharded_readiness)
+    return app
+
+
+async def serve_app(app: web.Application):
+    """Запускает aiohttp-сервер и работает до отмены задачи"""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=config.WEBAPP_HOST, port=config.WEBAPP_PORT)
+    await site.start()
+    logging.info(f"Webhook-сервер запущен на {config.WEBAPP_HOST}:{config.WEBAPP_PORT}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, tasks: set = None):
+    await serve_app(create_webhook_app(dp, bot, tasks))
+
+
+async def run_sharded_webhook(bot: Bot, router):
+    await serve_app(create_sharded_webhook_app(bot, router))